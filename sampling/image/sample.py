@@ -1,5 +1,6 @@
 from accelerate import Accelerator, DataLoaderConfiguration
 import argparse
+import functools
 import math
 import os
 from pathlib import Path
@@ -17,7 +18,13 @@ from xdiffusion.datasets.utils import load_dataset
 from xdiffusion.diffusion.ddpm import GaussianDiffusion_DDPM
 from xdiffusion.diffusion import DiffusionModel
 from xdiffusion.diffusion.cascade import GaussianDiffusionCascade
-from xdiffusion.lora import load_lora_weights
+from xdiffusion.distributed_sampling import (
+    SampleShardWriter,
+    gather_samples,
+    get_sample_range,
+    seed_process,
+)
+from xdiffusion.lora import load_lora_weights, merge_loras, swap_loras
 from xdiffusion.samplers import ddim, ancestral, base
 
 OUTPUT_NAME = "output/image/sample"
@@ -31,8 +38,11 @@ def sample_model(
     checkpoint_path: str,
     sampling_steps: int,
     sampler_config_path: str,
-    lora_path: str,
+    lora_paths: List[str],
     dataset_name: str,
+    distributed: bool = False,
+    batch_size: int = 64,
+    seed: int = 0,
 ):
     global OUTPUT_NAME
     OUTPUT_NAME = f"{OUTPUT_NAME}/{dataset_name}/{str(Path(config_path).stem)}"
@@ -65,8 +75,13 @@ def sample_model(
         mixed_precision="no",
     )
 
-    # Move the model and the optimizer to the accelerator as well.
-    diffusion_model = accelerator.prepare(diffusion_model)
+    if distributed:
+        # Every process samples independently, so the model is only placed
+        # on the device, rather than wrapped for distributed training.
+        diffusion_model = diffusion_model.to(accelerator.device)
+    else:
+        # Move the model and the optimizer to the accelerator as well.
+        diffusion_model = accelerator.prepare(diffusion_model)
 
     if sampler_config_path:
         sampler = instantiate_from_config(
@@ -76,8 +91,18 @@ def sample_model(
         # Use the sampler the model was trained with.
         sampler = None
 
+    if distributed:
+        sample_fn = functools.partial(
+            sample_distributed,
+            accelerator=accelerator,
+            batch_size=batch_size,
+            seed=seed,
+        )
+    else:
+        sample_fn = sample
+
     # Save and sample the final step.
-    sample(
+    sample_fn(
         diffusion_model=diffusion_model,
         config=config,
         num_samples=num_samples,
@@ -86,18 +111,29 @@ def sample_model(
         dataset_name=dataset_name,
     )
 
-    if lora_path:
-        # Load the lora weights
-        print("Sampling with loras.")
-        load_lora_weights(diffusion_model, lora_path=lora_path)
-
-        sample(
+    for lora_idx, lora_path in enumerate(lora_paths):
+        if lora_idx == 0:
+            # Load the lora weights, and fold them into the base weights
+            # so that sampling runs at the speed of the base model.
+            print("Sampling with loras.")
+            load_lora_weights(diffusion_model, lora_path=lora_path)
+            merge_loras(diffusion_model)
+        else:
+            # Switch to the next lora without reloading the base checkpoint.
+            print(f"Sampling with loras from {lora_path}.")
+            swap_loras(diffusion_model, lora_path)
+
+        sample_fn(
             diffusion_model=diffusion_model,
             config=config,
             num_samples=num_samples,
             num_sampling_steps=sampling_steps,
             sampler=sampler,
-            base_name="sample_lora",
+            base_name=(
+                "sample_lora"
+                if len(lora_paths) == 1
+                else f"sample_lora_{Path(lora_path).stem}"
+            ),
             dataset_name=dataset_name,
         )
 
@@ -159,6 +195,81 @@ def sample(
             fp.write(f"{context['text_prompts'][i]} ")
 
 
+def sample_distributed(
+    diffusion_model: DiffusionModel,
+    config: DotConfig,
+    sampler: base.ReverseProcessSampler,
+    dataset_name: str,
+    accelerator: Accelerator,
+    num_samples: int = 64,
+    num_sampling_steps: Optional[int] = None,
+    base_name: str = "sample",
+    batch_size: int = 64,
+    seed: int = 0,
+    max_grid_samples: int = 64,
+):
+    """Splits the samples across the accelerate processes.
+
+    Each process generates its share of the samples in batches of batch_size,
+    and writes them as individual PNGs into its own shard of
+    {OUTPUT_NAME}/{base_name}, with a manifest of the samples and their
+    prompts merged at the end. If there are at most max_grid_samples samples,
+    they are also gathered into a single image grid, like sample().
+    """
+    device = accelerator.device
+    if "super_resolution" in config:
+        assert False, "Not supported yet."
+
+    output_path = f"{OUTPUT_NAME}/{base_name}"
+    writer = SampleShardWriter(output_path, accelerator=accelerator)
+    start, end = get_sample_range(
+        num_samples, accelerator.num_processes, accelerator.process_index
+    )
+    seed_process(seed)
+
+    _, convert_labels_to_prompts = load_dataset(
+        dataset_name=dataset_name, config=config.data, split="train"
+    )
+
+    rank_samples = []
+    for batch_start in range(start, end, batch_size):
+        batch_end = min(batch_start + batch_size, end)
+        classes = torch.randint(
+            0,
+            config.data.num_classes,
+            size=(batch_end - batch_start,),
+            device=device,
+        )
+        prompts = convert_labels_to_prompts(classes)
+        context = {"text_prompts": prompts, "classes": classes}
+
+        samples, _ = diffusion_model.sample(
+            num_samples=batch_end - batch_start,
+            context=context,
+            num_sampling_steps=num_sampling_steps,
+            sampler=sampler,
+        )
+        writer.write_images(
+            samples, start_index=batch_start, prompts=prompts, classes=classes
+        )
+        if num_samples <= max_grid_samples:
+            rank_samples.append(samples)
+
+    manifest_path = writer.finalize()
+    if num_samples <= max_grid_samples:
+        samples = gather_samples(accelerator, rank_samples)
+        if accelerator.is_main_process:
+            utils.save_image(
+                samples,
+                str(f"{OUTPUT_NAME}/{base_name}.png"),
+                nrow=int(math.sqrt(num_samples)),
+            )
+
+    if accelerator.is_main_process:
+        print(
+            f"Saved {num_samples} samples from {accelerator.num_processes} "
+            f"processes to {manifest_path}"
+        )
 
 
 def main(override=None):
@@ -172,8 +283,15 @@ def main(override=None):
     parser.add_argument("--checkpoint", type=str, default="")
     parser.add_argument("--sampling_steps", type=int, default=1000)
     parser.add_argument("--sampler_config_path", type=str, default="")
-    parser.add_argument("--lora_path", type=str, default="")
+    parser.add_argument("--lora_path", type=str, nargs="*", default=[])
     parser.add_argument("--dataset_name", type=str, required=True)
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        help="Split the samples across the processes of `accelerate launch`.",
+    )
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
 
     args = parser.parse_args()
 
@@ -184,8 +302,11 @@ def main(override=None):
         checkpoint_path=args.checkpoint,
         sampling_steps=args.sampling_steps,
         sampler_config_path=args.sampler_config_path,
-        lora_path=args.lora_path,
+        lora_paths=args.lora_path,
         dataset_name=args.dataset_name,
+        distributed=args.distributed,
+        batch_size=args.batch_size,
+        seed=args.seed,
     )
 
 
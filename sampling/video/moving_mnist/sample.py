@@ -9,12 +9,18 @@ from typing import List, Optional
 
 from xdiffusion.diffusion import DiffusionModel
 from xdiffusion.diffusion.ddpm import GaussianDiffusion_DDPM
+from xdiffusion.distributed_sampling import (
+    SampleShardWriter,
+    gather_samples,
+    get_sample_range,
+    seed_process,
+)
 from xdiffusion.samplers import ddim, ancestral, rectified_flow, base, schemes
+from xdiffusion.samplers.long_video import LongVideoGenerator
 from xdiffusion.utils import (
     instantiate_from_config,
     load_yaml,
     DotConfig,
-    normalize_to_neg_one_to_one,
     video_tensor_to_gif,
 )
 
@@ -29,6 +35,10 @@ def sample_model(
     checkpoint_path: str,
     sampler: str,
     sampling_scheme_path: str,
+    save_intermediate_steps: bool = False,
+    distributed: bool = False,
+    batch_size: int = 8,
+    seed: int = 0,
 ):
     global OUTPUT_NAME
     OUTPUT_NAME = f"{OUTPUT_NAME}/{str(Path(config_path).stem)}"
@@ -56,8 +66,13 @@ def sample_model(
         mixed_precision="no",
     )
 
-    # Move the model and the optimizer to the accelerator as well.
-    diffusion_model = accelerator.prepare(diffusion_model)
+    if distributed:
+        # Every process samples independently, so the model is only placed
+        # on the device, rather than wrapped for distributed training.
+        diffusion_model = diffusion_model.to(accelerator.device)
+    else:
+        # Move the model and the optimizer to the accelerator as well.
+        diffusion_model = accelerator.prepare(diffusion_model)
 
     if sampler == "ddim":
         sampler = ddim.DDIMSampler()
@@ -76,6 +91,21 @@ def sample_model(
             sampling_scheme_config.sampling_scheme.to_dict()
         )
 
+    if distributed:
+        assert (
+            sampling_scheme is None
+        ), "Sampling schemes are not supported with distributed sampling."
+        sample_distributed(
+            diffusion_model=diffusion_model,
+            config=config,
+            num_samples=num_samples,
+            sampler=sampler,
+            accelerator=accelerator,
+            batch_size=batch_size,
+            seed=seed,
+        )
+        return
+
     # Save and sample the final step.
     sample(
         diffusion_model=diffusion_model,
@@ -83,6 +113,7 @@ def sample_model(
         num_samples=num_samples,
         sampler=sampler,
         sampling_scheme=sampling_scheme,
+        save_intermediate_steps=save_intermediate_steps,
     )
 
 
@@ -92,6 +123,7 @@ def sample(
     sampler: base.ReverseProcessSampler,
     num_samples: int = 64,
     sampling_scheme: Optional[schemes.SamplingSchemeBase] = None,
+    save_intermediate_steps: bool = False,
 ):
     device = next(diffusion_model.parameters()).device
 
@@ -110,84 +142,26 @@ def sample(
     if sampling_scheme is not None:
         # Starts unconditionally
         assert sampling_scheme.num_observations == 0
-        frame_indices_iterator = iter(sampling_scheme)
 
-        # Unconditional conditioning for the first step. Note that
-        # this is (B, T, C, H, W), not the normal channels first.
+        # Generate the video window by window, following the sampling scheme.
         s = config.data.image_size
         image_size = [s[0], s[1]] if isinstance(s, list) else [s, s]
-        samples = torch.zeros(
-            size=(
-                num_samples,
-                sampling_scheme.video_length,
-                config.data.num_channels,
-                image_size[0],
-                image_size[1],
+        generator = LongVideoGenerator(
+            diffusion_model,
+            encode_fn=(
+                diffusion_model.encode_to_latents
+                if "latent_encoder" in config.diffusion.to_dict()
+                else None
             ),
+            intermediate_output_path=OUTPUT_NAME if save_intermediate_steps else None,
+        )
+        samples = generator.generate(
+            sampling_scheme,
+            num_samples=num_samples,
+            frame_shape=(config.data.num_channels, image_size[0], image_size[1]),
+            context=context,
+            sampler=sampler,
         )
-        step = 0
-        while True:
-            # ignored for non-adaptive sampling schemes
-            frame_indices_iterator.set_videos(samples.to(device))
-            try:
-                obs_frame_indices, latent_frame_indices, temporal_mask = next(
-                    frame_indices_iterator
-                )
-            except StopIteration:
-                break
-
-            frame_indices = torch.cat(
-                [torch.tensor(obs_frame_indices), torch.tensor(latent_frame_indices)],
-                dim=1,
-            ).long()
-            x0 = torch.stack(
-                [samples[i, fi] for i, fi in enumerate(frame_indices)], dim=0
-            ).clone()
-            obs_mask = (
-                torch.cat(
-                    [
-                        torch.ones_like(torch.tensor(obs_frame_indices)),
-                        torch.zeros_like(torch.tensor(latent_frame_indices)),
-                    ],
-                    dim=1,
-                )
-                .view(num_samples, -1, 1, 1, 1)
-                .float()
-            )
-            latent_mask = 1 - obs_mask
-
-            # Move tensors to the correct device
-            x0, observed_mask, latent_mask, frame_indices = (
-                t.to(device) for t in [x0, obs_mask, latent_mask, frame_indices]
-            )
-
-            # Run the network. Ensure everything is still channels first
-            context["x0"] = normalize_to_neg_one_to_one(x0.permute(0, 2, 1, 3, 4))
-            context["frame_indices"] = frame_indices
-            context["observed_mask"] = observed_mask.permute(0, 2, 1, 3, 4)
-            context["latent_mask"] = latent_mask.permute(0, 2, 1, 3, 4)
-            context["video_mask"] = temporal_mask.to(device)
-
-            local_samples, _ = diffusion_model.sample(
-                num_samples=num_samples, context=context, sampler=sampler
-            )
-            video_tensor_to_gif(
-                local_samples,
-                str(f"{OUTPUT_NAME}/interim_sample_step_{step}.gif"),
-            )
-
-            local_samples = local_samples.permute(0, 2, 1, 3, 4)
-            for i, li in enumerate(latent_frame_indices):
-                samples[i, li] = local_samples[i, -len(li) :].cpu()
-
-            video_tensor_to_gif(
-                samples.permute(0, 2, 1, 3, 4),
-                str(f"{OUTPUT_NAME}/sample_step_{step}.gif"),
-            )
-            step += 1
-
-        # Make samples channels first again
-        samples = samples.permute(0, 2, 1, 3, 4)
     else:
         samples, _ = diffusion_model.sample(
             num_samples=num_samples,
@@ -216,6 +190,70 @@ def sample(
             fp.write(f"{context['text_prompts'][i]} ")
 
 
+def sample_distributed(
+    diffusion_model: DiffusionModel,
+    config: DotConfig,
+    sampler: base.ReverseProcessSampler,
+    accelerator: Accelerator,
+    num_samples: int = 64,
+    batch_size: int = 8,
+    seed: int = 0,
+    max_grid_samples: int = 64,
+):
+    """Splits the samples across the accelerate processes.
+
+    Each process generates its share of the samples in batches of batch_size,
+    and writes them as individual GIFs into its own shard of {OUTPUT_NAME}/sample,
+    with a manifest of the samples and their prompts merged at the end. If there
+    are at most max_grid_samples samples, they are also gathered into a single
+    GIF grid, like sample().
+    """
+    device = accelerator.device
+    if "super_resolution" in config:
+        assert False, "Not supported yet."
+
+    writer = SampleShardWriter(f"{OUTPUT_NAME}/sample", accelerator=accelerator)
+    start, end = get_sample_range(
+        num_samples, accelerator.num_processes, accelerator.process_index
+    )
+    seed_process(seed)
+
+    rank_samples = []
+    for batch_start in range(start, end, batch_size):
+        batch_end = min(batch_start + batch_size, end)
+        classes = torch.randint(
+            0,
+            config.data.num_classes,
+            size=(batch_end - batch_start, 2),
+            device=device,
+        )
+        prompts = convert_labels_to_prompts(classes)
+        context = {"text_prompts": prompts, "classes": classes}
+
+        samples, _ = diffusion_model.sample(
+            num_samples=batch_end - batch_start,
+            context=context,
+            sampler=sampler,
+        )
+        writer.write_videos(
+            samples, start_index=batch_start, prompts=prompts, classes=classes
+        )
+        if num_samples <= max_grid_samples:
+            rank_samples.append(samples)
+
+    manifest_path = writer.finalize()
+    if num_samples <= max_grid_samples:
+        samples = gather_samples(accelerator, rank_samples)
+        if accelerator.is_main_process:
+            video_tensor_to_gif(samples, str(f"{OUTPUT_NAME}/sample.gif"))
+
+    if accelerator.is_main_process:
+        print(
+            f"Saved {num_samples} samples from {accelerator.num_processes} "
+            f"processes to {manifest_path}"
+        )
+
+
 def convert_labels_to_prompts(labels: torch.Tensor) -> List[str]:
     """Converts MNIST class labels to text prompts.
 
@@ -257,6 +295,18 @@ def main(override=None):
     parser.add_argument("--checkpoint", type=str, default="")
     parser.add_argument("--sampler", type=str, default="ancestral")
     parser.add_argument("--sampling_scheme_path", type=str, default="")
+    parser.add_argument(
+        "--save_intermediate_steps",
+        action="store_true",
+        help="Save GIFs of each step of the sampling scheme.",
+    )
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        help="Split the samples across the processes of `accelerate launch`.",
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
     args = parser.parse_args()
 
     sample_model(
@@ -266,6 +316,10 @@ def main(override=None):
         checkpoint_path=args.checkpoint,
         sampler=args.sampler,
         sampling_scheme_path=args.sampling_scheme_path,
+        save_intermediate_steps=args.save_intermediate_steps,
+        distributed=args.distributed,
+        batch_size=args.batch_size,
+        seed=args.seed,
     )
 
 
@@ -0,0 +1,129 @@
+"""Speed vs. quality benchmark for the transformer block cache.
+
+Samples from a DiT family configuration without the block cache, and then with
+the block cache at each of the given thresholds, starting from the same initial
+noise. Reports the latency, the cache hit rate (the fraction of score network
+calls which skipped the block stack), and the deviation from the uncached
+samples.
+
+The score networks zero initialize their output layers, so use a trained
+checkpoint for meaningful hit rates and deviations.
+
+Usage:
+    python tools/benchmarks/block_cache.py --config_path configs/image/mnist/dit.yaml --checkpoint_path output/image/mnist/dit/diffusion-60000.pt
+"""
+
+import argparse
+import time
+import torch
+from typing import List, Optional
+
+from xdiffusion.diffusion.ddpm import GaussianDiffusion_DDPM
+from xdiffusion.utils import get_obj_from_str, load_yaml
+
+
+def benchmark(
+    config_path: str,
+    checkpoint_path: Optional[str],
+    policy: str,
+    thresholds: List[float],
+    batch_size: int,
+    num_sampling_steps: Optional[int],
+    force_cpu: bool,
+):
+    device = (
+        torch.device("cuda")
+        if torch.cuda.is_available() and not force_cpu
+        else torch.device("cpu")
+    )
+    config = load_yaml(config_path)
+    num_classes = config.data.num_classes if "num_classes" in config.data else 10
+    classes = torch.randint(
+        0, num_classes, size=(batch_size,), generator=torch.Generator().manual_seed(0)
+    )
+    context = {
+        "classes": classes.to(device),
+        "text_prompts": [str(c) for c in classes.tolist()],
+    }
+
+    def _run(threshold: Optional[float]):
+        sampling_config = config.diffusion.sampling.to_dict()
+        sampling_config["block_cache"] = {
+            "enable": threshold is not None,
+            "policy": policy,
+            "threshold": threshold if threshold is not None else 0.0,
+        }
+        if "target" in config:
+            diffusion_model = get_obj_from_str(config["target"])(config)
+        else:
+            diffusion_model = GaussianDiffusion_DDPM(config=config)
+        if checkpoint_path:
+            diffusion_model.load_checkpoint(checkpoint_path)
+        diffusion_model = diffusion_model.to(device).eval()
+
+        torch.manual_seed(0)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        samples, _ = diffusion_model.sample(
+            num_samples=batch_size,
+            context=context,
+            num_sampling_steps=num_sampling_steps,
+        )
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        latency = time.perf_counter() - start_time
+
+        block_cache = diffusion_model.block_cache()
+        hit_rate = block_cache.metrics()["hit_rate"] if block_cache else 0.0
+        return samples.to(torch.float64), latency, hit_rate
+
+    reference, reference_latency, _ = _run(threshold=None)
+    print(
+        f"{'threshold':>10} {'latency (s)':>12} {'speedup':>8} {'hit rate':>9} "
+        f"{'max abs err':>12} {'rmse':>10}"
+    )
+    print(f"{'none':>10} {reference_latency:>12.4f} {1.0:>8.2f} {0.0:>9.2f}")
+    for threshold in thresholds:
+        samples, latency, hit_rate = _run(threshold=threshold)
+        error = samples - reference
+        print(
+            f"{threshold:>10} {latency:>12.4f} {reference_latency / latency:>8.2f} "
+            f"{hit_rate:>9.2f} {error.abs().max().item():>12.3e} "
+            f"{error.square().mean().sqrt().item():>10.3e}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config_path", type=str, default="configs/image/mnist/dit.yaml"
+    )
+    parser.add_argument("--checkpoint_path", type=str, default="")
+    parser.add_argument(
+        "--policy",
+        type=str,
+        default="modulated_input",
+        choices=["modulated_input", "timestep_embedding"],
+    )
+    parser.add_argument(
+        "--thresholds", type=float, nargs="+", default=[0.05, 0.1, 0.2, 0.4]
+    )
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_sampling_steps", type=int, default=None)
+    parser.add_argument("--force_cpu", action="store_true")
+    args = parser.parse_args()
+
+    benchmark(
+        config_path=args.config_path,
+        checkpoint_path=args.checkpoint_path,
+        policy=args.policy,
+        thresholds=args.thresholds,
+        batch_size=args.batch_size,
+        num_sampling_steps=args.num_sampling_steps,
+        force_cpu=args.force_cpu,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Benchmark of the BPE tokenizer used by TextPromptsPreprocessor.
+
+Compares the tokens/sec of batch tokenization using:
+
+- original: The original tokenizer, which merges token strings with a cache
+  of merged words, and assembles the batch one row at a time.
+- uncached: The token id merges, with the word and prompt caches disabled.
+- cached: The token id merges, with the word and whole prompt caches.
+
+for batches of prompts drawn from a fixed set of unique prompts, as in training
+where the same prompts are tokenized over and over. Also compares the time to
+load the vocabulary from the original text files and from the binary vocab.bin.
+
+Usage:
+    python tools/benchmarks/bpe_tokenizer.py --num_unique_prompts 10 1000 100000
+"""
+
+import argparse
+import os
+import random
+import time
+import torch
+
+from xdiffusion.tokenizer import bpe
+
+WORDS = (
+    "a photo of the digit zero one two three four five six seven eight nine "
+    "and with in on an image handwritten number moving bouncing across "
+    "black background white large small painting drawing of"
+).split()
+
+
+class OriginalEncoder:
+    """The original string merging tokenizer, for comparison."""
+
+    def __init__(self, encoder, bpe_merges):
+        self.encoder = encoder
+        self.byte_encoder = bpe.bytes_to_unicode()
+        self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
+        self.cache = {}
+        self.pat = bpe.re.compile(
+            r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+        )
+
+    def bpe(self, token):
+        if token in self.cache:
+            return self.cache[token]
+        word = tuple(token)
+        pairs = bpe.get_pairs(word)
+        if not pairs:
+            return token
+
+        while True:
+            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
+            if bigram not in self.bpe_ranks:
+                break
+            first, second = bigram
+            new_word = []
+            i = 0
+            while i < len(word):
+                try:
+                    j = word.index(first, i)
+                    new_word.extend(word[i:j])
+                    i = j
+                except ValueError:
+                    new_word.extend(word[i:])
+                    break
+
+                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                    new_word.append(first + second)
+                    i += 2
+                else:
+                    new_word.append(word[i])
+                    i += 1
+            word = tuple(new_word)
+            if len(word) == 1:
+                break
+            pairs = bpe.get_pairs(word)
+        word = " ".join(word)
+        self.cache[token] = word
+        return word
+
+    def encode(self, text):
+        bpe_tokens = []
+        for token in bpe.re.findall(self.pat, text.lower()):
+            token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+            bpe_tokens.extend(self.encoder[t] for t in self.bpe(token).split(" "))
+        return bpe_tokens
+
+    def tokenize(self, texts, context_length=256, truncate_text=False):
+        all_tokens = [self.encode(text) for text in texts]
+        result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
+        for i, tokens in enumerate(all_tokens):
+            tokens = tokens[:context_length]
+            result[i, : len(tokens)] = torch.tensor(tokens)
+        return result
+
+
+def benchmark(
+    num_unique_prompts,
+    batch_size: int,
+    context_length: int,
+    num_batches: int,
+):
+    start_time = time.perf_counter()
+    encoder, bpe_merges = bpe.load_text_vocab()
+    merge_table = bpe.build_merge_table(encoder, bpe_merges)
+    text_load_time = time.perf_counter() - start_time
+    print(f"Vocabulary load from text files: {1000.0 * text_load_time:.1f}ms")
+
+    binary_vocab_path = os.path.join(
+        os.path.dirname(os.path.abspath(bpe.__file__)), bpe.BINARY_VOCAB_FILE_NAME
+    )
+    if os.path.exists(binary_vocab_path):
+        start_time = time.perf_counter()
+        bpe.load_binary_vocab(binary_vocab_path)
+        binary_load_time = time.perf_counter() - start_time
+        print(f"Vocabulary load from vocab.bin: {1000.0 * binary_load_time:.1f}ms")
+
+    print(f"batch_size={batch_size} context_length={context_length}")
+    print(f"{'unique prompts':>15} {'tokenizer':>10} {'tokens/sec':>12} {'speedup':>8}")
+    random.seed(0)
+    for num_unique in num_unique_prompts:
+        prompts = [
+            " ".join(random.choices(WORDS, k=random.randint(2, 16)))
+            for _ in range(num_unique)
+        ]
+        batches = [random.choices(prompts, k=batch_size) for _ in range(num_batches)]
+
+        tokenizers = [
+            ("original", OriginalEncoder(encoder, bpe_merges)),
+            (
+                "uncached",
+                bpe.Encoder(
+                    encoder,
+                    merge_table=merge_table,
+                    bpe_cache_size=0,
+                    prompt_cache_size=0,
+                ),
+            ),
+            ("cached", bpe.Encoder(encoder, merge_table=merge_table)),
+        ]
+
+        reference = None
+        for name, tokenizer in tokenizers:
+            num_tokens = 0
+            start_time = time.perf_counter()
+            for batch in batches:
+                tokens = tokenizer.tokenize(
+                    batch, context_length=context_length, truncate_text=True
+                )
+                num_tokens += int((tokens != 0).sum())
+            tokens_per_sec = num_tokens / (time.perf_counter() - start_time)
+
+            if reference is None:
+                reference = tokens_per_sec
+            print(
+                f"{num_unique:>15} {name:>10} {tokens_per_sec:>12.0f} "
+                f"{tokens_per_sec / reference:>7.1f}x"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_unique_prompts", type=int, nargs="+", default=[10, 1000, 100000]
+    )
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--context_length", type=int, default=128)
+    parser.add_argument("--num_batches", type=int, default=200)
+    args = parser.parse_args()
+
+    benchmark(
+        num_unique_prompts=args.num_unique_prompts,
+        batch_size=args.batch_size,
+        context_length=args.context_length,
+        num_batches=args.num_batches,
+    )
+
+
+if __name__ == "__main__":
+    main()
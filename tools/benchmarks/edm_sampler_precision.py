@@ -0,0 +1,114 @@
+"""Accuracy vs. speed benchmark for the EDM sampler precision policies.
+
+Samples from an EDM configuration (with random weights) using the reference
+float64 ODE state, and compares the latency and the deviation from the
+reference for each of the reduced precision policies, starting from the
+same initial noise.
+
+Usage:
+    python tools/benchmarks/edm_sampler_precision.py --config_path configs/image/mnist/edm.yaml
+"""
+
+import argparse
+import copy
+import time
+import torch
+
+from xdiffusion.utils import get_obj_from_str, instantiate_from_config, load_yaml
+
+# (precision, network_precision) policies to compare against the reference.
+POLICIES = [
+    ("fp64", "fp32"),
+    ("fp32", "fp32"),
+    ("fp32", "bf16"),
+    ("fp64", "bf16"),
+]
+
+
+def benchmark(
+    config_path: str,
+    batch_size: int,
+    num_steps: int,
+    num_repeats: int,
+    force_cpu: bool,
+):
+    device = (
+        torch.device("cuda")
+        if torch.cuda.is_available() and not force_cpu
+        else torch.device("cpu")
+    )
+    config = load_yaml(config_path)
+    diffusion_model = get_obj_from_str(config["target"])(config).to(device).eval()
+
+    shape = (
+        batch_size,
+        config.diffusion.sampling.output_channels,
+        config.diffusion.sampling.output_spatial_size,
+        config.diffusion.sampling.output_spatial_size,
+    )
+    generator = torch.Generator(device="cpu").manual_seed(0)
+    latents = torch.randn(shape, generator=generator).to(device)
+
+    def _run(precision: str, network_precision: str):
+        sampler_config = copy.deepcopy(config.diffusion.sampling.to_dict())
+        sampler_config["params"]["num_steps"] = num_steps
+        sampler_config["params"]["precision"] = precision
+        sampler_config["params"]["network_precision"] = network_precision
+        sampler = instantiate_from_config(sampler_config)
+
+        # Warm up (also populates the time step cache)
+        torch.manual_seed(0)
+        x_0 = sampler.p_sample_loop(diffusion_model=diffusion_model, latents=latents)
+
+        latencies = []
+        for _ in range(num_repeats):
+            torch.manual_seed(0)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+            x_0 = sampler.p_sample_loop(
+                diffusion_model=diffusion_model, latents=latents
+            )
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            latencies.append(time.perf_counter() - start_time)
+        return x_0.to(torch.float64), min(latencies)
+
+    reference, reference_latency = _run("fp64", "fp32")
+    print(
+        f"{'precision':>10} {'network':>8} {'latency (s)':>12} {'speedup':>8} "
+        f"{'max abs err':>12} {'rmse':>10}"
+    )
+    for precision, network_precision in POLICIES:
+        x_0, latency = _run(precision, network_precision)
+        error = x_0 - reference
+        print(
+            f"{precision:>10} {network_precision:>8} {latency:>12.4f} "
+            f"{reference_latency / latency:>8.2f} "
+            f"{error.abs().max().item():>12.3e} "
+            f"{error.square().mean().sqrt().item():>10.3e}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config_path", type=str, default="configs/image/mnist/edm.yaml"
+    )
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_steps", type=int, default=18)
+    parser.add_argument("--num_repeats", type=int, default=3)
+    parser.add_argument("--force_cpu", action="store_true")
+    args = parser.parse_args()
+
+    benchmark(
+        config_path=args.config_path,
+        batch_size=args.batch_size,
+        num_steps=args.num_steps,
+        num_repeats=args.num_repeats,
+        force_cpu=args.force_cpu,
+    )
+
+
+if __name__ == "__main__":
+    main()
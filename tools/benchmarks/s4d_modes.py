@@ -0,0 +1,130 @@
+"""Micro-benchmark of the S4D evaluation modes.
+
+Compares the latency of an S4D layer (with frozen weights, as during sampling)
+across sequence lengths, using:
+
+- fft: the FFT convolution, rebuilding the SSM kernel on every call (the
+  original behavior).
+- fft, cached: the FFT convolution with the cached kernel.
+- scan: the chunked scan, which carries the SSM state between chunks.
+- recurrent: the step-by-step recurrence, one call per sequence element.
+
+The outputs of the scan and the recurrence are checked against the FFT
+convolution.
+
+Usage:
+    python tools/benchmarks/s4d_modes.py --sequence_lengths 256 1024 4096
+"""
+
+import argparse
+import time
+import torch
+
+from xdiffusion.layers.s4d import S4D
+
+
+def benchmark(
+    d_model: int,
+    d_state: int,
+    batch_size: int,
+    sequence_lengths,
+    chunk_size: int,
+    max_recurrent_length: int,
+    num_iterations: int,
+    force_cpu: bool,
+):
+    device = (
+        torch.device("cuda")
+        if torch.cuda.is_available() and not force_cpu
+        else torch.device("cpu")
+    )
+
+    torch.manual_seed(0)
+    layer = S4D(d_model, d_state=d_state, transposed=True).to(device).eval()
+    layer.requires_grad_(False)
+
+    def _time(fn):
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        for _ in range(num_iterations):
+            fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        return 1000.0 * (time.perf_counter() - start_time) / num_iterations
+
+    def _fft_uncached(u):
+        layer._cache.clear()
+        return layer(u)
+
+    def _recurrent(u):
+        ys = []
+        state = None
+        for t in range(u.shape[-1]):
+            y, state = layer.step(u[..., t], state)
+            ys.append(y)
+        return torch.stack(ys, dim=-1)
+
+    print(
+        f"S4D d_model={d_model} d_state={d_state} batch_size={batch_size} on {device}"
+    )
+    print(
+        f"{'length':>8} {'fft (ms)':>10} {'cached (ms)':>12} "
+        f"{'scan (ms)':>10} {'recurrent (ms)':>15} {'scan error':>11} "
+        f"{'recurrent error':>16}"
+    )
+    with torch.no_grad():
+        for L in sequence_lengths:
+            u = torch.randn(batch_size, d_model, L, device=device)
+
+            fft_latency = _time(lambda: _fft_uncached(u))
+            cached_latency = _time(lambda: layer(u))
+            scan_latency = _time(lambda: layer.scan(u, chunk_size=chunk_size))
+
+            y_fft, _ = layer(u)
+            y_scan, _ = layer.scan(u, chunk_size=chunk_size)
+            scan_error = (y_fft - y_scan).abs().max().item()
+
+            # The recurrence is one call per step, so skip the longer sequences.
+            recurrent_latency = float("nan")
+            recurrent_error = float("nan")
+            if L <= max_recurrent_length:
+                recurrent_latency = _time(lambda: _recurrent(u))
+                recurrent_error = (y_fft - _recurrent(u)).abs().max().item()
+
+            print(
+                f"{L:>8} {fft_latency:>10.3f} {cached_latency:>12.3f} "
+                f"{scan_latency:>10.3f} {recurrent_latency:>15.3f} "
+                f"{scan_error:>11.2e} {recurrent_error:>16.2e}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--d_model", type=int, default=256)
+    parser.add_argument("--d_state", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument(
+        "--sequence_lengths", type=int, nargs="+", default=[64, 256, 1024, 4096]
+    )
+    parser.add_argument("--chunk_size", type=int, default=64)
+    parser.add_argument("--max_recurrent_length", type=int, default=1024)
+    parser.add_argument("--num_iterations", type=int, default=10)
+    parser.add_argument("--force_cpu", action="store_true")
+    args = parser.parse_args()
+
+    benchmark(
+        d_model=args.d_model,
+        d_state=args.d_state,
+        batch_size=args.batch_size,
+        sequence_lengths=args.sequence_lengths,
+        chunk_size=args.chunk_size,
+        max_recurrent_length=args.max_recurrent_length,
+        num_iterations=args.num_iterations,
+        force_cpu=args.force_cpu,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,513 @@
+"""Sampling throughput benchmark across samplers and score networks.
+
+Instantiates each configuration with random weights, and measures the sampling
+latency and throughput (samples/sec) over a grid of batch sizes, sampling step
+counts and classifier free guidance on/off. The mean time per step is the
+sampling latency divided by the number of steps, so it includes the sampler
+overhead as well as the score network forward pass(es) of each step. The forward
+latency is measured separately, as the latency of a single score network forward
+pass on the inputs of the first sampling step.
+
+The results are written to a JSON file, and can be compared against a stored
+baseline (a previous output of this script) to detect throughput regressions.
+The script exits with a non-zero status if the throughput or the forward latency
+of any entry regressed by more than the tolerance, so it can be used to gate
+releases. The default grid is small enough to run on CPU.
+
+Usage:
+    # Run the default suite on CPU and save the results as the baseline.
+    python tools/benchmarks/sampling_throughput.py --force_cpu \
+        --output_path benchmarks/sampling_baseline.json
+
+    # Compare against the baseline.
+    python tools/benchmarks/sampling_throughput.py --force_cpu \
+        --output_path benchmarks/sampling.json \
+        --baseline_path benchmarks/sampling_baseline.json
+
+    # Benchmark any other configuration, with the sampler it defines.
+    python tools/benchmarks/sampling_throughput.py --force_cpu \
+        --config_paths configs/image/mnist/dit.yaml configs/image/mnist/sana.yaml
+"""
+
+import argparse
+import copy
+import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import torch
+from typing import Dict, List, Optional
+
+from xdiffusion.diffusion.ddpm import GaussianDiffusion_DDPM
+from xdiffusion.utils import DotConfig, get_obj_from_str, load_yaml
+
+# The default suite, covering each of the sampler families. Each case is a
+# configuration file, with optional overrides (dotted config keys) applied before
+# the model is created. steps_key is the config key which sets the number of
+# sampling steps, or None if the number of steps is passed to sample().
+DEFAULT_CASES = {
+    "ancestral": {
+        "config_path": "configs/image/mnist/ddpm_32x32_epsilon_discrete.yaml",
+        "overrides": {},
+        "steps_key": None,
+    },
+    "ddim": {
+        "config_path": "configs/image/mnist/ddpm_32x32_epsilon_continuous.yaml",
+        "overrides": {
+            "diffusion.sampling.target": "xdiffusion.samplers.ddim.DDIMSampler",
+            "diffusion.sampling.params": {},
+        },
+        "steps_key": None,
+    },
+    "rectified_flow": {
+        "config_path": "configs/image/mnist/rectified_flow_32x32.yaml",
+        "overrides": {},
+        "steps_key": None,
+    },
+    "edm": {
+        "config_path": "configs/image/mnist/edm.yaml",
+        "overrides": {},
+        "steps_key": "diffusion.sampling.params.num_steps",
+    },
+    "consistency": {
+        "config_path": "configs/image/mnist/consistency_model.yaml",
+        "overrides": {
+            "diffusion.sampling.target": "xdiffusion.samplers.consistency.GeneralizedConsistencySampler",
+            "diffusion.sampling.params.sampler": "ancestral",
+            "diffusion.sampling.params.steps": 40,
+        },
+        "steps_key": "diffusion.sampling.params.steps",
+    },
+    "pc": {
+        "config_path": "configs/image/mnist/score_sde_vpsde_continuous.yaml",
+        "overrides": {},
+        "steps_key": "diffusion.sde.params.N",
+    },
+}
+
+# Config keys which set the number of sampling steps for samplers whose
+# models do not take the number of steps in sample().
+STEPS_KEYS_BY_TARGET = {
+    "xdiffusion.diffusion.edm.GaussianDiffusion_EDM": "diffusion.sampling.params.num_steps",
+    "xdiffusion.diffusion.consistency.GaussianDiffusion_ConsistencyModel": "diffusion.sampling.params.steps",
+    "xdiffusion.diffusion.sde.GaussianDiffusion_SDE": "diffusion.sde.params.N",
+}
+
+
+def _set_key(config: Dict, dotted_key: str, value):
+    """Sets a (nested) dotted key in a configuration dictionary."""
+    keys = dotted_key.split(".")
+    for key in keys[:-1]:
+        config = config.setdefault(key, {})
+    config[keys[-1]] = value
+
+
+def _has_key(config: Dict, dotted_key: str) -> bool:
+    for key in dotted_key.split("."):
+        if not isinstance(config, dict) or key not in config:
+            return False
+        config = config[key]
+    return True
+
+
+def _create_model(
+    config_path: str,
+    overrides: Dict,
+    steps_key: Optional[str],
+    num_steps: int,
+    device: torch.device,
+):
+    """Creates a diffusion model with random (but reproducible) weights."""
+    config = copy.deepcopy(load_yaml(config_path).to_dict())
+    for key, value in overrides.items():
+        _set_key(config, key, copy.deepcopy(value))
+    if steps_key is not None:
+        _set_key(config, steps_key, num_steps)
+    config = DotConfig(config)
+
+    torch.manual_seed(0)
+    if "target" in config:
+        diffusion_model = get_obj_from_str(config["target"])(config)
+    else:
+        diffusion_model = GaussianDiffusion_DDPM(config=config)
+    return diffusion_model.to(device).eval(), config
+
+
+def _sampling_context(config: DotConfig, batch_size: int, device: torch.device):
+    num_classes = config.data.num_classes if "num_classes" in config.data else 10
+    classes = torch.randint(0, num_classes, size=(batch_size,), device=device)
+    return {
+        "classes": classes,
+        "text_prompts": [str(c) for c in classes.tolist()],
+    }
+
+
+def _capture_score_network_inputs(diffusion_model, sample_fn):
+    """Runs sample_fn, capturing the inputs of the first score network call.
+
+    Returns:
+        Tuple of the score network and its positional and keyword arguments,
+        or None if the model has no score network (e.g. cascaded models).
+    """
+    # Consistency models sample with the EMA of the score network, if it exists.
+    score_networks = [
+        getattr(diffusion_model, name, None)
+        for name in ["_score_network", "_score_network_ema"]
+    ]
+    score_networks = [m for m in score_networks if m is not None]
+
+    captured = []
+
+    def _hook(module, args, kwargs):
+        if not captured:
+            # The sampling loop can update the context in place between steps.
+            captured.append(
+                (
+                    module,
+                    tuple(copy.copy(a) if isinstance(a, dict) else a for a in args),
+                    {
+                        k: copy.copy(v) if isinstance(v, dict) else v
+                        for k, v in kwargs.items()
+                    },
+                )
+            )
+
+    handles = [
+        m.register_forward_pre_hook(_hook, with_kwargs=True) for m in score_networks
+    ]
+    try:
+        sample_fn()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return captured[0] if captured else None
+
+
+def _forward_latency(
+    score_network: torch.nn.Module,
+    args,
+    kwargs,
+    num_warmup: int,
+    num_repeats: int,
+    device: torch.device,
+) -> float:
+    """The median latency (in seconds) of a score network forward pass."""
+
+    def _forward():
+        with torch.no_grad():
+            score_network(*args, **kwargs)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    for _ in range(num_warmup):
+        _forward()
+
+    latencies = []
+    for _ in range(num_repeats):
+        start_time = time.perf_counter()
+        _forward()
+        latencies.append(time.perf_counter() - start_time)
+    return statistics.median(latencies)
+
+
+def benchmark_case(
+    name: str,
+    config_path: str,
+    overrides: Dict,
+    steps_key: Optional[str],
+    batch_sizes: List[int],
+    num_steps_list: List[int],
+    guidance_scales: List[Optional[float]],
+    num_warmup: int,
+    num_repeats: int,
+    device: torch.device,
+) -> List[Dict]:
+    results = []
+    for num_steps in num_steps_list:
+        diffusion_model, config = _create_model(
+            config_path, overrides, steps_key, num_steps, device
+        )
+        num_parameters = sum(p.numel() for p in diffusion_model.parameters())
+
+        for guidance in guidance_scales:
+            # Only the DDPM family of models takes classifier free guidance
+            # in sample(), the others ignore it.
+            if guidance is not None and not isinstance(
+                diffusion_model, GaussianDiffusion_DDPM
+            ):
+                continue
+
+            for batch_size in batch_sizes:
+
+                def _sample():
+                    torch.manual_seed(0)
+                    context = _sampling_context(config, batch_size, device)
+                    with torch.no_grad():
+                        diffusion_model.sample(
+                            context=context,
+                            num_samples=batch_size,
+                            classifier_free_guidance=guidance,
+                            num_sampling_steps=(
+                                num_steps if steps_key is None else None
+                            ),
+                        )
+                    if device.type == "cuda":
+                        torch.cuda.synchronize()
+
+                # The first run also captures the score network inputs, for
+                # timing the forward pass on its own.
+                score_network_inputs = _capture_score_network_inputs(
+                    diffusion_model, _sample
+                )
+                for _ in range(num_warmup - 1):
+                    _sample()
+
+                latencies = []
+                for _ in range(num_repeats):
+                    start_time = time.perf_counter()
+                    _sample()
+                    latencies.append(time.perf_counter() - start_time)
+
+                latency = statistics.median(latencies)
+                forward_latency = None
+                if score_network_inputs is not None:
+                    forward_latency = _forward_latency(
+                        *score_network_inputs,
+                        num_warmup=num_warmup,
+                        num_repeats=num_repeats,
+                        device=device,
+                    )
+
+                result = {
+                    "case": name,
+                    "config_path": config_path,
+                    "sampler": config.diffusion.sampling.target,
+                    "num_parameters": num_parameters,
+                    "batch_size": batch_size,
+                    "num_steps": num_steps,
+                    "cfg": guidance is not None,
+                    "guidance": guidance,
+                    "latency_s": latency,
+                    "min_latency_s": min(latencies),
+                    "mean_time_per_step_ms": 1000.0 * latency / num_steps,
+                    "forward_latency_ms": (
+                        1000.0 * forward_latency
+                        if forward_latency is not None
+                        else None
+                    ),
+                    "samples_per_sec": batch_size / latency,
+                }
+                results.append(result)
+                forward_str = (
+                    f"{result['forward_latency_ms']:9.2f}ms"
+                    if forward_latency is not None
+                    else f"{'n/a':>11}"
+                )
+                print(
+                    f"{name:>16} bs={batch_size:<4} steps={num_steps:<5} "
+                    f"cfg={'on' if result['cfg'] else 'off':<4} "
+                    f"latency={latency:8.3f}s "
+                    f"time/step={result['mean_time_per_step_ms']:9.2f}ms "
+                    f"forward={forward_str} "
+                    f"samples/sec={result['samples_per_sec']:8.2f}"
+                )
+    return results
+
+
+def _result_key(result: Dict):
+    return (result["case"], result["batch_size"], result["num_steps"], result["cfg"])
+
+
+def compare_to_baseline(
+    results: List[Dict], baseline_path: str, tolerance: float, device: torch.device
+) -> List[Dict]:
+    """Compares the throughput against a baseline, returning the regressions."""
+    with open(baseline_path, "r") as fp:
+        baseline = json.load(fp)
+    baseline_results = {_result_key(r): r for r in baseline["results"]}
+
+    device_name = _device_name(device)
+    if baseline["metadata"]["device"] != device_name:
+        print(
+            f"WARNING: The baseline was measured on {baseline['metadata']['device']}, "
+            f"comparing against {device_name}."
+        )
+
+    regressions = []
+    print(
+        f"\n{'case':>16} {'bs':>4} {'steps':>5} {'cfg':>4} {'speedup':>8} "
+        f"{'fwd speedup':>12}"
+    )
+    for result in results:
+        key = _result_key(result)
+        if key not in baseline_results:
+            continue
+        baseline_result = baseline_results[key]
+        speedup = result["samples_per_sec"] / baseline_result["samples_per_sec"]
+        result["baseline_samples_per_sec"] = baseline_result["samples_per_sec"]
+        result["speedup"] = speedup
+        regressed = speedup < 1.0 - tolerance
+
+        # The forward latency is missing from older baselines, and for models
+        # without a single score network.
+        forward_speedup = None
+        if (
+            result.get("forward_latency_ms") is not None
+            and baseline_result.get("forward_latency_ms") is not None
+        ):
+            forward_speedup = (
+                baseline_result["forward_latency_ms"] / result["forward_latency_ms"]
+            )
+            result["baseline_forward_latency_ms"] = baseline_result[
+                "forward_latency_ms"
+            ]
+            result["forward_speedup"] = forward_speedup
+            regressed = regressed or forward_speedup < 1.0 - tolerance
+
+        if regressed:
+            regressions.append(result)
+        forward_str = (
+            f"{forward_speedup:>12.3f}"
+            if forward_speedup is not None
+            else f"{'n/a':>12}"
+        )
+        print(
+            f"{key[0]:>16} {key[1]:>4} {key[2]:>5} {'on' if key[3] else 'off':>4} "
+            f"{speedup:>8.3f} {forward_str}{'  REGRESSION' if regressed else ''}"
+        )
+    return regressions
+
+
+def _device_name(device: Optional[torch.device] = None) -> str:
+    if device is not None and device.type == "cuda":
+        return torch.cuda.get_device_name(device)
+    return platform.processor() or platform.machine()
+
+
+def _git_commit() -> str:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except Exception:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--cases",
+        type=str,
+        nargs="*",
+        default=list(DEFAULT_CASES.keys()),
+        help="The default cases to run.",
+    )
+    parser.add_argument(
+        "--config_paths",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Additional configurations to benchmark, with their own sampler.",
+    )
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--num_steps", type=int, nargs="+", default=[10])
+    parser.add_argument("--guidance", type=float, default=3.0)
+    parser.add_argument("--no_cfg", action="store_true")
+    parser.add_argument("--num_warmup", type=int, default=1)
+    parser.add_argument("--num_repeats", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--force_cpu", action="store_true")
+    parser.add_argument(
+        "--output_path", type=str, default="output/benchmarks/sampling.json"
+    )
+    parser.add_argument("--baseline_path", type=str, default="")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="The allowed fractional drop in samples/sec (or in the forward "
+        "latency speedup) against the baseline.",
+    )
+    args = parser.parse_args()
+
+    device = (
+        torch.device("cuda")
+        if torch.cuda.is_available() and not args.force_cpu
+        else torch.device("cpu")
+    )
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    cases = {name: DEFAULT_CASES[name] for name in args.cases}
+    for config_path in args.config_paths:
+        config = load_yaml(config_path).to_dict()
+        steps_key = STEPS_KEYS_BY_TARGET.get(config.get("target", ""), None)
+        if steps_key is not None and not _has_key(config, steps_key):
+            steps_key = None
+        cases[Path(config_path).stem] = {
+            "config_path": config_path,
+            "overrides": {},
+            "steps_key": steps_key,
+        }
+
+    guidance_scales = [None] if args.no_cfg else [None, args.guidance]
+    results = []
+    for name, case in cases.items():
+        results.extend(
+            benchmark_case(
+                name=name,
+                config_path=case["config_path"],
+                overrides=case["overrides"],
+                steps_key=case["steps_key"],
+                batch_sizes=args.batch_sizes,
+                num_steps_list=args.num_steps,
+                guidance_scales=guidance_scales,
+                num_warmup=args.num_warmup,
+                num_repeats=args.num_repeats,
+                device=device,
+            )
+        )
+
+    regressions = []
+    if args.baseline_path:
+        regressions = compare_to_baseline(
+            results, args.baseline_path, args.tolerance, device=device
+        )
+
+    output = {
+        "metadata": {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "git_commit": _git_commit(),
+            "torch_version": torch.__version__,
+            "python_version": platform.python_version(),
+            "device": _device_name(device),
+            "device_type": device.type,
+            "num_threads": torch.get_num_threads(),
+            "num_warmup": args.num_warmup,
+            "num_repeats": args.num_repeats,
+            "baseline_path": args.baseline_path,
+            "tolerance": args.tolerance,
+        },
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_path)), exist_ok=True)
+    with open(args.output_path, "w") as fp:
+        json.dump(output, fp, indent=2)
+    print(f"Saved results to {args.output_path}")
+
+    if regressions:
+        print(f"{len(regressions)} throughput regression(s) against the baseline.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
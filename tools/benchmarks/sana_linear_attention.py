@@ -0,0 +1,143 @@
+"""Benchmark of the Sana linear attention processors.
+
+Compares the latency, throughput and peak memory (on CUDA) of the original
+SanaLinearAttnProcessor2_0 against the chunked SanaChunkedLinearAttnProcessor,
+for a single linear attention layer over square token grids.
+
+Usage:
+    python tools/benchmarks/sana_linear_attention.py --grid_sizes 32 64 128 256
+    python tools/benchmarks/sana_linear_attention.py --grid_sizes 512 1024 --dtype bf16
+"""
+
+import argparse
+import time
+import torch
+
+from xdiffusion.layers.attention_diffusers import Attention
+from xdiffusion.score_networks.sana import (
+    SanaChunkedLinearAttnProcessor,
+    SanaLinearAttnProcessor2_0,
+)
+
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def benchmark(
+    grid_sizes,
+    batch_size: int,
+    num_attention_heads: int,
+    attention_head_dim: int,
+    chunk_size: int,
+    dtype: str,
+    num_iterations: int,
+    force_cpu: bool,
+):
+    device = (
+        torch.device("cuda")
+        if torch.cuda.is_available() and not force_cpu
+        else torch.device("cpu")
+    )
+    dtype = DTYPES[dtype]
+
+    torch.manual_seed(0)
+    dim = num_attention_heads * attention_head_dim
+    attn = (
+        Attention(
+            query_dim=dim,
+            heads=num_attention_heads,
+            dim_head=attention_head_dim,
+            bias=False,
+            processor=SanaLinearAttnProcessor2_0(),
+        )
+        .to(device=device, dtype=dtype)
+        .eval()
+    )
+    processors = [
+        ("original", SanaLinearAttnProcessor2_0()),
+        ("chunked", SanaChunkedLinearAttnProcessor(chunk_size=chunk_size)),
+    ]
+
+    def _measure(x):
+        attn(x)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start_time = time.perf_counter()
+        for _ in range(num_iterations):
+            attn(x)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        latency = (time.perf_counter() - start_time) / num_iterations
+        peak_memory_mb = (
+            torch.cuda.max_memory_allocated() / 2**20
+            if device.type == "cuda"
+            else float("nan")
+        )
+        return latency, peak_memory_mb
+
+    print(
+        f"Linear attention dim={dim} heads={num_attention_heads} "
+        f"batch_size={batch_size} dtype={dtype} on {device}"
+    )
+    print(
+        f"{'grid':>10} {'processor':>10} {'latency (ms)':>13} "
+        f"{'tokens/sec':>12} {'peak memory (MB)':>17} {'max error':>10}"
+    )
+    with torch.no_grad():
+        for grid_size in grid_sizes:
+            num_tokens = grid_size * grid_size
+            x = torch.randn(batch_size, num_tokens, dim, device=device, dtype=dtype)
+
+            outputs = []
+            for name, processor in processors:
+                attn.set_processor(processor)
+                try:
+                    latency, peak_memory_mb = _measure(x)
+                    outputs.append(attn(x).float())
+                except torch.cuda.OutOfMemoryError:
+                    print(f"{grid_size:>4}x{grid_size:<5} {name:>10} {'OOM':>13}")
+                    outputs.append(None)
+                    torch.cuda.empty_cache()
+                    continue
+
+                error = (
+                    (outputs[-1] - outputs[0]).abs().max().item()
+                    if outputs[0] is not None
+                    else float("nan")
+                )
+                print(
+                    f"{grid_size:>4}x{grid_size:<5} {name:>10} {1000.0 * latency:>13.3f} "
+                    f"{batch_size * num_tokens / latency:>12.0f} "
+                    f"{peak_memory_mb:>17.1f} {error:>10.2e}"
+                )
+            del x, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--grid_sizes", type=int, nargs="+", default=[32, 64, 128, 256, 512, 1024]
+    )
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_attention_heads", type=int, default=36)
+    parser.add_argument("--attention_head_dim", type=int, default=32)
+    parser.add_argument("--chunk_size", type=int, default=4096)
+    parser.add_argument("--dtype", type=str, default="fp32", choices=list(DTYPES))
+    parser.add_argument("--num_iterations", type=int, default=5)
+    parser.add_argument("--force_cpu", action="store_true")
+    args = parser.parse_args()
+
+    benchmark(
+        grid_sizes=args.grid_sizes,
+        batch_size=args.batch_size,
+        num_attention_heads=args.num_attention_heads,
+        attention_head_dim=args.attention_head_dim,
+        chunk_size=args.chunk_size,
+        dtype=args.dtype,
+        num_iterations=args.num_iterations,
+        force_cpu=args.force_cpu,
+    )
+
+
+if __name__ == "__main__":
+    main()
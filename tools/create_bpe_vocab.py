@@ -0,0 +1,45 @@
+"""Create the binary BPE vocabulary used by xdiffusion.tokenizer.bpe.
+
+Converts encoder.json.gz and vocab.bpe.gz into the compact vocab.bin, which
+is much faster to load since the merges are stored as token id arrays.
+"""
+
+import argparse
+import os
+import time
+
+from xdiffusion.tokenizer import bpe
+
+
+def create_bpe_vocab(output_path: str):
+    encoder, bpe_merges = bpe.load_text_vocab()
+    bpe.save_binary_vocab(output_path, encoder=encoder, bpe_merges=bpe_merges)
+
+    # Make sure the binary vocabulary round trips.
+    start_time = time.perf_counter()
+    loaded_encoder, merge_table = bpe.load_binary_vocab(output_path)
+    load_time = time.perf_counter() - start_time
+    assert loaded_encoder == encoder
+    assert merge_table == bpe.build_merge_table(encoder, bpe_merges)
+    print(
+        f"Saved {len(encoder)} tokens and {len(bpe_merges)} merges to {output_path} "
+        f"({os.path.getsize(output_path)} bytes, loads in {1000.0 * load_time:.1f}ms)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(bpe.__file__)), bpe.BINARY_VOCAB_FILE_NAME
+        ),
+    )
+    args = parser.parse_args()
+
+    create_bpe_vocab(output_path=args.output_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""Precomputes the latents of a dataset for latent diffusion training.
+
+The latent encoder of a latent diffusion model is frozen, so encoding every
+training batch repeats the same work each epoch. For the video VAEs (e.g.
+HunyuanCausal3DVAE or the LTX CausalVideoAutoencoder) the encoder can cost
+more than the score network itself. This tool encodes the dataset once into
+sharded, memory-mapped numpy files which are read by
+xdiffusion.datasets.precomputed_latents.PrecomputedLatentsDataset.
+
+The posterior mean and standard deviation are stored (rather than a single
+sample), so training still sees a fresh posterior sample each time an example
+is used. The latent scale factor is computed over the whole dataset and stored
+alongside the shards.
+
+To train on the precomputed latents, add the following to the config file:
+
+training:
+  precomputed_latents:
+    path: <output_path>
+
+Usage:
+    python tools/precompute_latents.py \
+        --config_path configs/video/moving_mnist/ltx_video/ltx_video.yaml \
+        --load_vae_weights_from_checkpoint <vae checkpoint> \
+        --output_path latents/ltx_video
+"""
+
+import argparse
+import json
+import numpy as np
+import os
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from xdiffusion.autoencoders.distributions import DiagonalGaussianDistribution
+from xdiffusion.datasets.precomputed_latents import (
+    LABELS_FMT,
+    LATENTS_MEAN_FMT,
+    LATENTS_STD_FMT,
+    METADATA_FILE_NAME,
+)
+from xdiffusion.datasets.utils import load_dataset
+from xdiffusion.training_utils import preprocess_training_videos
+from xdiffusion.utils import freeze, instantiate_from_config, load_yaml
+
+
+def precompute_latents(
+    config_path: str,
+    output_path: str,
+    dataset_name: str = "",
+    load_vae_weights_from_checkpoint: str = "",
+    batch_size: int = 32,
+    examples_per_shard: int = 5000,
+    num_workers: int = 1,
+    force_cpu: bool = False,
+):
+    config = load_yaml(config_path)
+    assert (
+        "latent_encoder" in config.diffusion
+    ), "Latents can only be precomputed for latent diffusion models."
+
+    if "training" in config and "dataset" in config.training:
+        dataset_name = config.training.dataset
+    if not dataset_name:
+        raise ValueError(
+            "--dataset_name must be passed if there is no dataset specified in the config file."
+        )
+
+    is_video = dataset_name.startswith("video/")
+    if is_video:
+        assert not (
+            "training" in config
+            and "flexible_diffusion_modeling" in config.training
+            and config.training.flexible_diffusion_modeling
+        ), "Flexible diffusion modeling samples random frames per batch, and cannot be precomputed."
+
+    device = (
+        torch.device("cuda")
+        if torch.cuda.is_available() and not force_cpu
+        else torch.device("cpu")
+    )
+
+    # Create the VAE
+    vae = instantiate_from_config(
+        config.diffusion.latent_encoder, use_config_struct=True
+    )
+    if load_vae_weights_from_checkpoint:
+        ckpt = torch.load(load_vae_weights_from_checkpoint, map_location="cpu")[
+            "model_state_dict"
+        ]
+
+        # Remove "module." from the keys
+        sd = {}
+        for k in ckpt.keys():
+            if k.startswith("module."):
+                sd[k[7:]] = ckpt[k]
+            else:
+                sd[k] = ckpt[k]
+        vae.load_state_dict(sd, strict=True)
+    vae = freeze(vae).to(device)
+
+    dataset, _ = load_dataset(
+        dataset_name=dataset_name, config=config.data, split="train"
+    )
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+    )
+
+    os.makedirs(output_path, exist_ok=True)
+
+    means = []
+    stds = []
+    labels = []
+    num_examples = 0
+    shard_idx = 0
+    has_std = None
+    latent_shape = None
+
+    # Running statistics of the sampled latents, for the scale factor.
+    latent_sum = 0.0
+    latent_sum_sq = 0.0
+    latent_count = 0
+
+    def _write_shard():
+        np.save(
+            os.path.join(output_path, LATENTS_MEAN_FMT.format(shard_idx=shard_idx)),
+            np.concatenate(means, axis=0),
+            allow_pickle=False,
+        )
+        if has_std:
+            np.save(
+                os.path.join(output_path, LATENTS_STD_FMT.format(shard_idx=shard_idx)),
+                np.concatenate(stds, axis=0),
+                allow_pickle=False,
+            )
+        np.save(
+            os.path.join(output_path, LABELS_FMT.format(shard_idx=shard_idx)),
+            np.concatenate(labels, axis=0),
+            allow_pickle=False,
+        )
+        means.clear()
+        stds.clear()
+        labels.clear()
+
+    with torch.no_grad():
+        for batch in tqdm(dataloader):
+            x, y = batch[0], batch[1]
+
+            if is_video:
+                # Apply the same resizing and frame processing as training.
+                x, _, _ = preprocess_training_videos(
+                    source_videos=x, config=config, context={}
+                )
+
+            x = x.to(device)
+            posterior = vae.encode(x)
+            if isinstance(posterior, DiagonalGaussianDistribution):
+                mean = posterior.mean
+                std = posterior.std
+                z = posterior.sample()
+            else:
+                mean = vae.encode_to_latents(x)
+                std = None
+                z = mean
+
+            if has_std is None:
+                has_std = std is not None
+                latent_shape = list(mean.shape[1:])
+
+            z = z.double()
+            latent_sum += z.sum().item()
+            latent_sum_sq += (z * z).sum().item()
+            latent_count += z.numel()
+
+            # Fill the current shard, and write it out when it is full.
+            start = 0
+            while start < mean.shape[0]:
+                end = min(
+                    mean.shape[0],
+                    start + examples_per_shard - sum(m.shape[0] for m in means),
+                )
+                means.append(mean[start:end].float().cpu().numpy())
+                if has_std:
+                    stds.append(std[start:end].float().cpu().numpy())
+                labels.append(torch.as_tensor(y[start:end]).cpu().numpy())
+                num_examples += end - start
+                start = end
+
+                if sum(m.shape[0] for m in means) == examples_per_shard:
+                    _write_shard()
+                    shard_idx += 1
+
+    if len(means) > 0:
+        _write_shard()
+        shard_idx += 1
+
+    latent_mean = latent_sum / latent_count
+    latent_std = np.sqrt(latent_sum_sq / latent_count - latent_mean**2)
+    latent_scale_factor = float(1.0 / latent_std)
+    print(f"Latent scale factor: {latent_scale_factor}")
+
+    with open(os.path.join(output_path, METADATA_FILE_NAME), "w") as fp:
+        json.dump(
+            {
+                "config_path": config_path,
+                "dataset_name": dataset_name,
+                "num_shards": shard_idx,
+                "examples_per_shard": examples_per_shard,
+                "total_examples": num_examples,
+                "latent_shape": latent_shape,
+                "has_std": has_std,
+                "latent_scale_factor": latent_scale_factor,
+            },
+            fp,
+            indent=2,
+        )
+
+
+def main(override=None):
+    """
+    Main entrypoint for the standalone version of this package.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_path", type=str, required=True)
+    parser.add_argument("--output_path", type=str, required=True)
+    parser.add_argument("--dataset_name", type=str, default="")
+    parser.add_argument("--load_vae_weights_from_checkpoint", type=str, default="")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--examples_per_shard", type=int, default=5000)
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--force_cpu", action="store_true")
+    args = parser.parse_args()
+
+    precompute_latents(
+        config_path=args.config_path,
+        output_path=args.output_path,
+        dataset_name=args.dataset_name,
+        load_vae_weights_from_checkpoint=args.load_vae_weights_from_checkpoint,
+        batch_size=args.batch_size,
+        examples_per_shard=args.examples_per_shard,
+        num_workers=args.num_workers,
+        force_cpu=args.force_cpu,
+    )
+
+
+if __name__ == "__main__":
+    main()
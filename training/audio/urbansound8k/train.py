@@ -6,7 +6,6 @@ import os
 from pathlib import Path
 import torch
 from torch.optim import Adam
-from torch.utils.data import DataLoader
 from torchinfo import summary
 from torchvision import transforms, utils
 from tqdm import tqdm
@@ -17,6 +16,7 @@ from xdiffusion.diffusion.ddpm import GaussianDiffusion_DDPM
 from xdiffusion.diffusion import DiffusionModel
 from xdiffusion.diffusion.cascade import GaussianDiffusionCascade
 from xdiffusion.layers.ema import create_ema_and_scales_fn
+from xdiffusion.training.data_loader import create_data_loader
 from xdiffusion.utils import (
     cycle,
     freeze,
@@ -57,7 +57,9 @@ def train(
 
     # Create the dataloader for the audio dataset
     num_samples = 8
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4)
+    dataloader = create_data_loader(
+        dataset, config=config, batch_size=batch_size, shuffle=True, num_workers=4
+    )
 
     # Create the latent encoder if it exists
     vae = None
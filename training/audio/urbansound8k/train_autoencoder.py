@@ -11,7 +11,6 @@ import math
 import os
 import torch
 from torch.optim import Adam
-from torch.utils.data import DataLoader
 from torchinfo import summary
 from torchvision import transforms
 from torchvision import utils as torch_utils
@@ -19,6 +18,7 @@ from torchvision.datasets import MNIST
 from tqdm import tqdm
 
 from xdiffusion.datasets.urbansound8k import UrbanSound8k
+from xdiffusion.training.data_loader import create_data_loader
 from xdiffusion.utils import cycle, load_yaml, save_mel_spectrogram_audio
 from xdiffusion.layers.audio import (
     mel_to_logmel,
@@ -40,12 +40,14 @@ def train_autoencoder(num_training_steps: int, batch_size: int, config_path: str
         ".",
     )
 
-    # Create the dataloader for the MNIST dataset
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4)
-
     # Open the model configuration
     config = load_yaml(config_path)
 
+    # Create the dataloader for the MNIST dataset
+    dataloader = create_data_loader(
+        dataset, config=config, batch_size=batch_size, shuffle=True, num_workers=4
+    )
+
     # Create the autoencoder we will train.
     vae = AutoencoderKL(config)
     summary(
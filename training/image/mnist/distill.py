@@ -16,6 +16,7 @@ from torchvision.datasets import MNIST
 from tqdm import tqdm
 from typing import List
 
+from xdiffusion.training.data_loader import create_data_loader
 from xdiffusion.utils import (
     cycle,
     freeze,
@@ -153,7 +154,9 @@ def single_distillation_iteration(
     )
 
     # Create the dataloader for the MNIST dataset
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4)
+    dataloader = create_data_loader(
+        dataset, config=config, batch_size=batch_size, shuffle=True, num_workers=4
+    )
 
     num_samples = 64
     validation_dataloader = DataLoader(
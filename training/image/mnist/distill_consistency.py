@@ -21,6 +21,7 @@ from xdiffusion.diffusion.ddpm import GaussianDiffusion_DDPM
 from xdiffusion.diffusion import DiffusionModel
 from xdiffusion.diffusion.cascade import GaussianDiffusionCascade
 from xdiffusion.layers.ema import create_ema_and_scales_fn
+from xdiffusion.training.data_loader import create_data_loader
 from xdiffusion.utils import cycle, get_obj_from_str, load_yaml, DotConfig
 
 OUTPUT_NAME = "output/image/mnist/distilled"
@@ -71,7 +72,13 @@ def distill(
     )
 
     # Create the dataloader for the MNIST dataset
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4)
+    dataloader = create_data_loader(
+        dataset,
+        config=student_config,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=4,
+    )
 
     num_samples = 64
     validation_dataloader = DataLoader(
@@ -23,6 +23,7 @@ from xdiffusion.diffusion.cascade import GaussianDiffusionCascade
 from xdiffusion.datasets.moving_mnist import MovingMNISTImage
 from xdiffusion.layers.ema import create_ema_and_scales_fn
 from xdiffusion.lora import inject_trainable_lora, save_lora_weights
+from xdiffusion.training.data_loader import create_data_loader
 from xdiffusion.utils import cycle, freeze, get_obj_from_str, load_yaml, DotConfig
 
 OUTPUT_NAME = "output/image/moving_mnist/lora"
@@ -89,7 +90,9 @@ def train(
     )
 
     # Create the dataloader for the MNIST dataset
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4)
+    dataloader = create_data_loader(
+        dataset, config=config, batch_size=batch_size, shuffle=True, num_workers=4
+    )
 
     num_samples = 64
     validation_dataloader = DataLoader(
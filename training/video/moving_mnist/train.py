@@ -10,6 +10,7 @@ from torchvision.transforms import v2
 from tqdm import tqdm
 from typing import List
 
+from xdiffusion.training.data_loader import create_data_loader
 from xdiffusion.utils import (
     load_yaml,
     cycle,
@@ -68,7 +69,9 @@ def train(
     )
 
     # Create the dataloader for the MNIST dataset
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4)
+    dataloader = create_data_loader(
+        dataset, config=config, batch_size=batch_size, shuffle=True, num_workers=4
+    )
 
     # Technically this is not correct, as the val set is the same as the train set
     # TODO: Create a real validation set for Moving MNIST.
@@ -0,0 +1,335 @@
+"""Memory bounded decoding of latents with a VAE.
+
+Decoding a large batch of video latents in a single call can easily run out of
+memory, since the decoder activations are much larger than the latents. The
+DecodePolicy splits the decode into batch micro-chunks, and if a single sample
+is still too large, into overlapping spatial (and for video, temporal) tiles
+which are blended back together.
+
+The decode is driven by a peak memory budget. The peak decode memory per latent
+element is either given, or measured (on CUDA devices) by decoding a small crop
+of the first sample. The chunk and tile sizes are then chosen so that the
+estimated peak memory stays under the budget.
+"""
+
+import math
+import torch
+from typing import Callable, List, Optional, Tuple
+
+
+class DecodePolicy:
+    def __init__(
+        self,
+        max_batch_size: Optional[int] = None,
+        memory_budget_mb: Optional[float] = None,
+        bytes_per_latent_element: Optional[float] = None,
+        spatial_tile_size: Optional[int] = None,
+        spatial_tile_overlap: float = 0.25,
+        min_spatial_tile_size: int = 4,
+        temporal_tile_size: Optional[int] = None,
+        temporal_tile_overlap: int = 1,
+        min_temporal_tile_size: int = 2,
+        temporal_causal: bool = True,
+        probe_size: int = 8,
+    ):
+        """Initializes the policy.
+
+        With the default arguments, the latents are decoded in a single call.
+
+        Args:
+            max_batch_size: The maximum number of samples to decode at once.
+            memory_budget_mb: The peak memory budget of the decode, in MB.
+                The chunk and tile sizes are chosen to stay within the budget.
+            bytes_per_latent_element: The peak decode memory per latent element.
+                If None, this is measured on a crop of the first sample (CUDA only).
+            spatial_tile_size: Fixed latent spatial tile size. If None, the tile
+                size is derived from the memory budget.
+            spatial_tile_overlap: The fraction of a spatial tile which overlaps
+                with its neighbors.
+            min_spatial_tile_size: The smallest latent spatial tile size to use.
+            temporal_tile_size: Fixed latent temporal tile size (in latent frames).
+                If None, the tile size is derived from the memory budget. Must be
+                at least 2 if temporal_causal.
+            temporal_tile_overlap: The number of latent frames shared by
+                neighboring temporal tiles.
+            min_temporal_tile_size: The smallest latent temporal tile size to use.
+            temporal_causal: True if the VAE is causal in time, e.g. the first
+                latent frame decodes to a single frame, and every other latent
+                frame decodes to the temporal compression ratio frames.
+            probe_size: The latent spatial size of the crop used to measure the
+                peak decode memory.
+        """
+        # A single causal latent frame decodes to a single frame, so causal
+        # temporal tiles need at least 2 latent frames to place the decoded tiles.
+        if temporal_causal:
+            assert (
+                temporal_tile_size is None or temporal_tile_size >= 2
+            ), "Causal temporal tiles need at least 2 latent frames."
+            assert (
+                min_temporal_tile_size >= 2
+            ), "Causal temporal tiles need at least 2 latent frames."
+
+        self._max_batch_size = max_batch_size
+        self._memory_budget = (
+            memory_budget_mb * 1024 * 1024 if memory_budget_mb is not None else None
+        )
+        self._bytes_per_latent_element = bytes_per_latent_element
+        self._spatial_tile_size = spatial_tile_size
+        self._spatial_tile_overlap = spatial_tile_overlap
+        self._min_spatial_tile_size = min_spatial_tile_size
+        self._temporal_tile_size = temporal_tile_size
+        self._temporal_tile_overlap = temporal_tile_overlap
+        self._min_temporal_tile_size = min_temporal_tile_size
+        self._temporal_causal = temporal_causal
+        self._probe_size = probe_size
+
+    def decode(
+        self, decode_fn: Callable[[torch.Tensor], torch.Tensor], z: torch.Tensor
+    ) -> torch.Tensor:
+        """Decodes a batch of latents.
+
+        Args:
+            decode_fn: Decodes a batch of latents of shape (B,C,H,W) or (B,C,F,H,W).
+            z: The batch of latents.
+
+        Returns:
+            The decoded batch.
+        """
+        B = z.shape[0]
+        batch_size = B if self._max_batch_size is None else self._max_batch_size
+        spatial_tile_size = self._spatial_tile_size
+        temporal_tile_size = self._temporal_tile_size
+
+        if self._memory_budget is not None:
+            if self._bytes_per_latent_element is None and z.is_cuda:
+                self._bytes_per_latent_element = self._measure_bytes_per_element(
+                    decode_fn, z
+                )
+
+            if self._bytes_per_latent_element is not None:
+                bytes_per_sample = z[0].numel() * self._bytes_per_latent_element
+                if bytes_per_sample <= self._memory_budget:
+                    batch_size = min(
+                        batch_size, int(self._memory_budget // bytes_per_sample)
+                    )
+                else:
+                    # A single sample is over budget, so decode each sample in tiles.
+                    batch_size = 1
+                    spatial_tile_size, temporal_tile_size = self._tile_sizes_for_budget(
+                        z, self._memory_budget / bytes_per_sample
+                    )
+
+        return torch.cat(
+            [
+                self._decode_tiled(
+                    decode_fn, chunk, spatial_tile_size, temporal_tile_size
+                )
+                for chunk in z.split(max(batch_size, 1))
+            ],
+            dim=0,
+        )
+
+    def _measure_bytes_per_element(
+        self, decode_fn: Callable[[torch.Tensor], torch.Tensor], z: torch.Tensor
+    ) -> float:
+        """Measures the peak decode memory per latent element on a small crop."""
+        probe = z[:1, ..., : self._probe_size, : self._probe_size]
+        if len(z.shape) == 5:
+            probe = probe[:, :, : self._min_temporal_tile_size]
+
+        # The peak memory stats are not reset, since they may belong to the
+        # caller (e.g. the training loop). If the probe stays under the existing
+        # peak, this overestimates its memory, which errs towards smaller chunks.
+        torch.cuda.synchronize(z.device)
+        base = torch.cuda.memory_allocated(z.device)
+        decode_fn(probe)
+        torch.cuda.synchronize(z.device)
+        peak = torch.cuda.max_memory_allocated(z.device) - base
+        return peak / probe.numel()
+
+    def _tile_sizes_for_budget(
+        self, z: torch.Tensor, fraction: float
+    ) -> Tuple[Optional[int], Optional[int]]:
+        """Chooses tile sizes covering at most fraction of a sample."""
+        spatial_tile_size = self._spatial_tile_size
+        temporal_tile_size = self._temporal_tile_size
+        H, W = z.shape[-2:]
+
+        if len(z.shape) == 5:
+            # Tile in time first, since it keeps the spatial context intact.
+            T = z.shape[2]
+            if temporal_tile_size is None:
+                temporal_tile_size = min(
+                    T, max(self._min_temporal_tile_size, math.floor(T * fraction))
+                )
+            fraction = fraction * T / min(temporal_tile_size, T)
+
+        if fraction < 1.0 and spatial_tile_size is None:
+            # Leave room for the tile overlap.
+            side = math.floor(
+                max(H, W) * math.sqrt(fraction) * (1.0 - self._spatial_tile_overlap)
+            )
+            spatial_tile_size = max(self._min_spatial_tile_size, side)
+        return spatial_tile_size, temporal_tile_size
+
+    def _decode_tiled(
+        self,
+        decode_fn: Callable[[torch.Tensor], torch.Tensor],
+        z: torch.Tensor,
+        spatial_tile_size: Optional[int],
+        temporal_tile_size: Optional[int],
+    ) -> torch.Tensor:
+        if (
+            len(z.shape) == 5
+            and temporal_tile_size is not None
+            and z.shape[2] > temporal_tile_size
+        ):
+            return self._temporal_tiled_decode(
+                decode_fn, z, spatial_tile_size, temporal_tile_size
+            )
+        return self._spatial_tiled_decode(decode_fn, z, spatial_tile_size)
+
+    def _spatial_tiled_decode(
+        self,
+        decode_fn: Callable[[torch.Tensor], torch.Tensor],
+        z: torch.Tensor,
+        tile_size: Optional[int],
+    ) -> torch.Tensor:
+        H, W = z.shape[-2:]
+        if tile_size is None or (H <= tile_size and W <= tile_size):
+            return decode_fn(z)
+
+        overlap = min(
+            math.ceil(tile_size * self._spatial_tile_overlap), max(tile_size - 1, 0)
+        )
+        starts_h = _tile_starts(H, tile_size, overlap)
+        starts_w = _tile_starts(W, tile_size, overlap)
+
+        output = None
+        weights = None
+        for i in starts_h:
+            for j in starts_w:
+                tile = z[..., i : i + tile_size, j : j + tile_size]
+                decoded = decode_fn(tile)
+                scale_h = decoded.shape[-2] // tile.shape[-2]
+                scale_w = decoded.shape[-1] // tile.shape[-1]
+
+                if output is None:
+                    output = torch.zeros(
+                        decoded.shape[:-2] + (H * scale_h, W * scale_w),
+                        dtype=torch.float32,
+                        device=decoded.device,
+                    )
+                    weights = torch.zeros(
+                        (H * scale_h, W * scale_w),
+                        dtype=torch.float32,
+                        device=decoded.device,
+                    )
+
+                # Blend the overlapping regions linearly between tiles.
+                w = (
+                    _ramp(
+                        decoded.shape[-2],
+                        overlap * scale_h if i > 0 else 0,
+                        overlap * scale_h if i + tile_size < H else 0,
+                        decoded.device,
+                    )[:, None]
+                    * _ramp(
+                        decoded.shape[-1],
+                        overlap * scale_w if j > 0 else 0,
+                        overlap * scale_w if j + tile_size < W else 0,
+                        decoded.device,
+                    )[None, :]
+                )
+                h_slice = slice(i * scale_h, i * scale_h + decoded.shape[-2])
+                w_slice = slice(j * scale_w, j * scale_w + decoded.shape[-1])
+                output[..., h_slice, w_slice] += decoded * w
+                weights[h_slice, w_slice] += w
+        return (output / weights).to(decoded.dtype)
+
+    def _temporal_tiled_decode(
+        self,
+        decode_fn: Callable[[torch.Tensor], torch.Tensor],
+        z: torch.Tensor,
+        spatial_tile_size: Optional[int],
+        tile_size: int,
+    ) -> torch.Tensor:
+        T = z.shape[2]
+        overlap = min(self._temporal_tile_overlap, tile_size - 1)
+        starts = _tile_starts(T, tile_size, overlap)
+
+        output = None
+        weights = None
+        ranges = None
+        for idx, s in enumerate(starts):
+            tile = z[:, :, s : s + tile_size]
+            decoded = self._spatial_tiled_decode(decode_fn, tile, spatial_tile_size)
+
+            if output is None:
+                # The temporal compression ratio determines where each tile lands.
+                n = tile.shape[2]
+                F = decoded.shape[2]
+                if self._temporal_causal:
+                    ratio = (F - 1) // (n - 1)
+                    total_frames = 1 + (T - 1) * ratio
+                else:
+                    ratio = F // n
+                    total_frames = T * ratio
+                ranges = [
+                    self._temporal_range(start, tile_size, T, ratio) for start in starts
+                ]
+                output = torch.zeros(
+                    decoded.shape[:2] + (total_frames,) + decoded.shape[3:],
+                    dtype=torch.float32,
+                    device=decoded.device,
+                )
+                weights = torch.zeros(
+                    (total_frames,), dtype=torch.float32, device=decoded.device
+                )
+
+            if self._temporal_causal and s > 0:
+                # The first latent frame of a causal tile decodes as a single
+                # (image) frame, which has no equivalent in the full video.
+                decoded = decoded[:, :, 1:]
+
+            begin, end = ranges[idx]
+            lead = ranges[idx - 1][1] - begin if idx > 0 else 0
+            trail = end - ranges[idx + 1][0] if idx + 1 < len(ranges) else 0
+            w = _ramp(end - begin, max(lead, 0), max(trail, 0), decoded.device)
+            output[:, :, begin:end] += decoded * w[:, None, None]
+            weights[begin:end] += w
+        return (output / weights[:, None, None]).to(decoded.dtype)
+
+    def _temporal_range(
+        self, start: int, tile_size: int, T: int, ratio: int
+    ) -> Tuple[int, int]:
+        """The output frame range of the latent frames [start, start + tile_size)."""
+        end = min(start + tile_size, T)
+        if not self._temporal_causal:
+            return start * ratio, end * ratio
+        if start == 0:
+            return 0, 1 + (end - 1) * ratio
+        return 1 + start * ratio, 1 + (end - 1) * ratio
+
+
+def _tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    """Start offsets of full size tiles covering length, with the given overlap."""
+    if length <= tile_size:
+        return [0]
+    stride = max(tile_size - overlap, 1)
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+
+def _ramp(length: int, lead: int, trail: int, device: torch.device) -> torch.Tensor:
+    """Blending weights, ramping up over lead and down over trail elements."""
+    w = torch.ones((length,), dtype=torch.float32, device=device)
+    if lead > 0:
+        w[:lead] = torch.arange(1, lead + 1, device=device) / (lead + 1)
+    if trail > 0:
+        w[length - trail :] = torch.minimum(
+            w[length - trail :],
+            torch.arange(trail, 0, -1, device=device) / (trail + 1),
+        )
+    return w
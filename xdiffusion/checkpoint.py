@@ -0,0 +1,393 @@
+"""Asynchronous, sharded checkpointing for the training loops.
+
+Saving a checkpoint with torch.save in the training loop blocks the main
+process (and every other process at the next collective) until the whole
+model and optimizer state has been serialized to disk. The CheckpointWriter
+instead snapshots the state into (reused) pinned CPU buffers, which only
+enqueues device to host copies, and serializes the snapshot on a background
+thread while training continues.
+
+Two formats are supported:
+    "torch": A single diffusion-{step}.pt file, identical to torch.save of
+        the training state, for compatibility with existing tooling.
+    "sharded": A diffusion-{step} directory with one safetensors file per
+        top level module of the diffusion model, one per optimizer, and an
+        index.json with the remaining (non-tensor) state. Safetensors files
+        are memory mappable, so resuming only reads the tensors which are
+        actually loaded.
+
+Both formats are read by load_model_state_dict and load_training_state.
+"""
+
+from collections import deque
+import json
+import os
+import shutil
+import threading
+import torch
+from typing import Any, Dict, List, Optional
+
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+INDEX_FILE_NAME = "index.json"
+MODEL_SHARD_FMT = "model-{name}.safetensors"
+OPTIMIZER_SHARD_FMT = "optimizer-{idx:02d}.safetensors"
+
+# Placeholder key for tensors in the JSON structure of the optimizer states.
+_TENSOR_KEY = "__tensor__"
+
+
+def checkpoint_path_for_step(output_path: str, step: int, format: str) -> str:
+    """The path of the checkpoint for a training step."""
+    if format == "sharded":
+        return os.path.join(output_path, f"diffusion-{step}")
+    return os.path.join(output_path, f"diffusion-{step}.pt")
+
+
+def is_sharded_checkpoint(checkpoint_path: str) -> bool:
+    return os.path.isdir(checkpoint_path) and os.path.exists(
+        os.path.join(checkpoint_path, INDEX_FILE_NAME)
+    )
+
+
+def _load_index(checkpoint_path: str) -> Dict:
+    with open(os.path.join(checkpoint_path, INDEX_FILE_NAME), "r") as fp:
+        return json.load(fp)
+
+
+def _torch_load(checkpoint_path: str) -> Dict:
+    """Loads a torch.save checkpoint, memory mapped if possible."""
+    try:
+        return torch.load(
+            checkpoint_path, map_location="cpu", mmap=True, weights_only=False
+        )
+    except RuntimeError:
+        # Checkpoints in the legacy (non-zip) format cannot be memory mapped.
+        return torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+
+
+def load_model_state_dict(checkpoint_path: str, prefix: str = "") -> Dict:
+    """Loads the model weights from a checkpoint.
+
+    Only the weights under prefix are loaded. For sharded checkpoints, only the
+    shards containing those weights are opened, and for torch.save checkpoints
+    the file is memory mapped, so the rest of the checkpoint is never read.
+
+    Args:
+        checkpoint_path: A sharded checkpoint directory or torch.save file.
+        prefix: Only load the keys starting with prefix (for example
+            "_score_network."), with the prefix removed.
+
+    Returns:
+        The (filtered) model state dict.
+    """
+    state_dict = {}
+    if is_sharded_checkpoint(checkpoint_path):
+        index = _load_index(checkpoint_path)
+        for shard_file, keys in index["model_shards"].items():
+            keys = [k for k in keys if k.startswith(prefix)]
+            if not keys:
+                continue
+            with safe_open(
+                os.path.join(checkpoint_path, shard_file), framework="pt"
+            ) as f:
+                for k in keys:
+                    state_dict[k[len(prefix) :]] = f.get_tensor(k)
+        return state_dict
+
+    for k, v in _torch_load(checkpoint_path)["model_state_dict"].items():
+        if k.startswith(prefix):
+            state_dict[k[len(prefix) :]] = v
+    return state_dict
+
+
+def load_training_state(checkpoint_path: str) -> Dict:
+    """Loads the training state (step and optimizer states) from a checkpoint.
+
+    Returns:
+        A dictionary with "step", "num_optimizers" and "optimizer_state_dicts".
+    """
+    if not is_sharded_checkpoint(checkpoint_path):
+        checkpoint = _torch_load(checkpoint_path)
+        return {
+            "step": checkpoint.get("step", 0),
+            "num_optimizers": checkpoint["num_optimizers"],
+            "optimizer_state_dicts": checkpoint["optimizer_state_dicts"],
+        }
+
+    index = _load_index(checkpoint_path)
+    optimizer_state_dicts = []
+    for idx, structure in enumerate(index["optimizer_state_dicts"]):
+        with safe_open(
+            os.path.join(checkpoint_path, OPTIMIZER_SHARD_FMT.format(idx=idx)),
+            framework="pt",
+        ) as f:
+            optimizer_state_dict = _restore_tensors(structure, f)
+
+        # JSON object keys are strings, optimizer state keys are ints.
+        optimizer_state_dict["state"] = {
+            int(k): v for k, v in optimizer_state_dict["state"].items()
+        }
+        optimizer_state_dicts.append(optimizer_state_dict)
+    return {
+        "step": index["step"],
+        "num_optimizers": index["num_optimizers"],
+        "optimizer_state_dicts": optimizer_state_dicts,
+    }
+
+
+def _restore_tensors(structure, shard):
+    """Replaces the tensor placeholders in an optimizer state structure."""
+    if isinstance(structure, dict):
+        if _TENSOR_KEY in structure:
+            return shard.get_tensor(structure[_TENSOR_KEY])
+        return {k: _restore_tensors(v, shard) for k, v in structure.items()}
+    if isinstance(structure, list):
+        return [_restore_tensors(v, shard) for v in structure]
+    return structure
+
+
+class CheckpointWriter:
+    """Writes training checkpoints on a background thread."""
+
+    def __init__(
+        self,
+        output_path: str,
+        format: str = "torch",
+        keep_last_n: Optional[int] = None,
+        async_write: bool = True,
+    ):
+        """Initializes the writer.
+
+        Args:
+            output_path: The directory to write the checkpoints to.
+            format: The checkpoint format, "torch" or "sharded".
+            keep_last_n: If set, only keep the last keep_last_n checkpoints
+                written by this writer, deleting the older ones.
+            async_write: If False, write the checkpoints synchronously.
+        """
+        assert format in ["torch", "sharded"], f"Unknown format {format}"
+        self._output_path = output_path
+        self._format = format
+        self._keep_last_n = keep_last_n
+        self._async_write = async_write
+
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        self._written = deque()
+
+        # Pinned CPU buffers for the snapshots, reused across checkpoints.
+        self._buffers: Dict[str, torch.Tensor] = {}
+
+    def save(
+        self,
+        step: int,
+        diffusion_model: torch.nn.Module,
+        optimizers: List[torch.optim.Optimizer],
+        loss: Any,
+        config: Any,
+    ) -> str:
+        """Snapshots the training state and writes it in the background.
+
+        Returns:
+            The path of the checkpoint being written.
+        """
+        # Only one checkpoint is in flight at a time, which also makes
+        # the snapshot buffers safe to reuse.
+        self.wait()
+
+        model_state = {
+            k: self._snapshot(f"model.{k}", v)
+            for k, v in diffusion_model.state_dict().items()
+        }
+        optimizer_states = [
+            self._snapshot_structure(f"optimizer.{idx}", optimizer.state_dict())
+            for idx, optimizer in enumerate(optimizers)
+        ]
+
+        # The device to host copies are asynchronous, so the writer waits
+        # for them on this event rather than stalling the training loop.
+        copy_done = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+
+        checkpoint_path = checkpoint_path_for_step(
+            self._output_path, step, self._format
+        )
+        state = {
+            "step": step,
+            "model_state_dict": model_state,
+            "num_optimizers": len(optimizers),
+            "optimizer_state_dicts": optimizer_states,
+            "loss": (
+                loss.detach().float().cpu().item()
+                if isinstance(loss, torch.Tensor)
+                else loss
+            ),
+            "config": config.to_dict() if hasattr(config, "to_dict") else config,
+        }
+
+        def _write():
+            try:
+                if copy_done is not None:
+                    copy_done.synchronize()
+                if self._format == "sharded":
+                    _write_sharded(state, checkpoint_path)
+                else:
+                    _write_torch(state, checkpoint_path)
+                self._rotate(checkpoint_path)
+            except BaseException as e:
+                self._error = e
+
+        if self._async_write:
+            self._thread = threading.Thread(target=_write, daemon=False)
+            self._thread.start()
+        else:
+            _write()
+            self._raise_error()
+        return checkpoint_path
+
+    def wait(self):
+        """Waits for the checkpoint in flight to finish writing."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise RuntimeError("Failed to write checkpoint.") from error
+
+    def _snapshot(self, name: str, tensor: torch.Tensor) -> torch.Tensor:
+        """Copies a tensor into a (reused) CPU buffer, pinned for device tensors."""
+        tensor = tensor.detach()
+        buffer = self._buffers.get(name, None)
+        if (
+            buffer is None
+            or buffer.shape != tensor.shape
+            or buffer.dtype != tensor.dtype
+        ):
+            buffer = torch.empty(
+                tensor.shape,
+                dtype=tensor.dtype,
+                pin_memory=tensor.is_cuda,
+            )
+            self._buffers[name] = buffer
+        buffer.copy_(tensor, non_blocking=tensor.is_cuda)
+        return buffer
+
+    def _snapshot_structure(self, name: str, structure):
+        if isinstance(structure, torch.Tensor):
+            return self._snapshot(name, structure)
+        if isinstance(structure, dict):
+            return {
+                k: self._snapshot_structure(f"{name}.{k}", v)
+                for k, v in structure.items()
+            }
+        if isinstance(structure, (list, tuple)):
+            return type(structure)(
+                self._snapshot_structure(f"{name}.{i}", v)
+                for i, v in enumerate(structure)
+            )
+        return structure
+
+    def _rotate(self, checkpoint_path: str):
+        self._written.append(checkpoint_path)
+        if self._keep_last_n is None:
+            return
+        while len(self._written) > self._keep_last_n:
+            path = self._written.popleft()
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+
+
+def _write_torch(state: Dict, checkpoint_path: str):
+    # Write to a temporary file first, so that a partially written
+    # checkpoint is never mistaken for a complete one.
+    tmp_path = checkpoint_path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def _write_sharded(state: Dict, checkpoint_path: str):
+    tmp_path = checkpoint_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    # One shard per top level module of the diffusion model.
+    shards: Dict[str, Dict[str, torch.Tensor]] = {}
+    for k, v in state["model_state_dict"].items():
+        name = k.split(".", 1)[0] if "." in k else "root"
+        shards.setdefault(name, {})[k] = v
+
+    model_shards = {}
+    for name, tensors in shards.items():
+        shard_file = MODEL_SHARD_FMT.format(name=name.lstrip("_"))
+        save_file(tensors, os.path.join(tmp_path, shard_file))
+        model_shards[shard_file] = list(tensors.keys())
+
+    optimizer_structures = []
+    for idx, optimizer_state in enumerate(state["optimizer_state_dicts"]):
+        tensors = {}
+        optimizer_structures.append(_extract_tensors(optimizer_state, "", tensors))
+        save_file(tensors, os.path.join(tmp_path, OPTIMIZER_SHARD_FMT.format(idx=idx)))
+
+    with open(os.path.join(tmp_path, INDEX_FILE_NAME), "w") as fp:
+        json.dump(
+            {
+                "step": state["step"],
+                "loss": state["loss"],
+                "num_optimizers": state["num_optimizers"],
+                "model_shards": model_shards,
+                "optimizer_state_dicts": optimizer_structures,
+                "config": state["config"],
+            },
+            fp,
+            indent=2,
+        )
+
+    if os.path.exists(checkpoint_path):
+        shutil.rmtree(checkpoint_path)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def _extract_tensors(structure, name: str, tensors: Dict[str, torch.Tensor]):
+    """Replaces the tensors in a structure with placeholders, collecting them."""
+    if isinstance(structure, torch.Tensor):
+        tensors[name] = structure
+        return {_TENSOR_KEY: name}
+    if isinstance(structure, dict):
+        return {
+            str(k): _extract_tensors(v, f"{name}.{k}" if name else str(k), tensors)
+            for k, v in structure.items()
+        }
+    if isinstance(structure, (list, tuple)):
+        return [
+            _extract_tensors(v, f"{name}.{i}" if name else str(i), tensors)
+            for i, v in enumerate(structure)
+        ]
+    return structure
+
+
+def create_checkpoint_writer(config, output_path: str) -> CheckpointWriter:
+    """Creates the checkpoint writer from the training.checkpoint config section.
+
+    For example:
+
+    training:
+      checkpoint:
+        format: "sharded"
+        keep_last_n: 3
+        async_write: True
+    """
+    params = {}
+    if "training" in config and "checkpoint" in config.training:
+        params = config.training.checkpoint.to_dict()
+    return CheckpointWriter(output_path=output_path, **params)
@@ -23,9 +23,10 @@ from transformers import (
     T5EncoderModel,
     CLIPTextModelWithProjection,
 )
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 from xdiffusion.layers.clip import FrozenCLIPTextTokenizer
+from xdiffusion.text_embedding_cache import TextEmbeddingCache
 from xdiffusion.tokenizer.bpe import get_encoder
 
 
@@ -264,6 +265,10 @@ class SD3TextPromptsPreprocessor(torch.nn.Module):
         second_clip_max_length: int,
         t5_model_name: str,
         t5_max_length: int,
+        encoder_device: Optional[str] = None,
+        embedding_cache_size: int = 128,
+        embedding_cache_dir: Optional[str] = None,
+        embedding_cache_offload_to_cpu: bool = False,
     ):
         super().__init__()
 
@@ -280,69 +285,125 @@ class SD3TextPromptsPreprocessor(torch.nn.Module):
         self._clip_tokenizer_1_max_length = first_clip_max_length
         self._clip_tokenizer_2_max_length = second_clip_max_length
         self._t5_max_length = t5_max_length
+        self._model_names = (
+            first_clip_model_name,
+            first_clip_max_length,
+            second_clip_model_name,
+            second_clip_max_length,
+            t5_model_name,
+            t5_max_length,
+        )
+
+        # The device the text encoders stay resident on. If None, the encoders
+        # are moved (once) to the device of the context.
+        self._encoder_device = encoder_device
+
+        # The text encoders are frozen, so the embeddings for a prompt
+        # can be reused across training steps and sampling calls.
+        self._embedding_cache = (
+            TextEmbeddingCache(
+                max_entries=embedding_cache_size,
+                cache_dir=embedding_cache_dir,
+                offload_to_cpu=embedding_cache_offload_to_cpu,
+            )
+            if embedding_cache_size > 0 or embedding_cache_dir is not None
+            else None
+        )
 
     def forward(self, context: Dict, device, **kwargs):
         if "text_prompts" in context:
             prompts = context["text_prompts"]
+            encode_fn = lambda indices: self._encode_prompts(
+                [prompts[idx] for idx in indices], device=device
+            )
             with torch.no_grad():
-                prompt_embeds_1, pooled_prompt_embeds_1 = self._get_clip_prompt_embeds(
-                    prompt=prompts,
-                    clip_encoder=self._clip_encoder_1,
-                    clip_tokenizer=self._clip_tokenizer_1,
-                    max_length=self._clip_tokenizer_1_max_length,
-                    device=device,
-                )
-                prompt_embeds_2, pooled_prompt_embeds_2 = self._get_clip_prompt_embeds(
-                    prompt=prompts,
-                    clip_encoder=self._clip_encoder_2,
-                    clip_tokenizer=self._clip_tokenizer_2,
-                    max_length=self._clip_tokenizer_2_max_length,
-                    device=device,
-                )
-
-                t5_prompt_embed = self._get_t5_prompt_embeds(
-                    prompt=prompts,
-                    max_sequence_length=self._t5_max_length,
-                    device=device,
-                    t5_tokenizer=self._t5_tokenizer,
-                    t5_encoder=self._t5_encoder,
-                )
-                # Concatenate the CLIP prompt embeddings
-                # "We also concatenate the penultimate hidden representations channel-wise to a CLIP
-                # context conditioning c^CLIP_txt ∈ R^77×2048"
-                clip_prompt_embeds = torch.cat(
-                    [prompt_embeds_1, prompt_embeds_2], dim=-1
-                )
-
-                # Pad the CLIP prompt embeddings to the T5 prompt embeddings
-                # "Finally, we zero-pad c^CLIP_txt along the channel axis to 4096 dimensions
-                # to match the T5 representation"
-                if t5_prompt_embed.shape[-1] > clip_prompt_embeds.shape[-1]:
-                    clip_prompt_embeds = torch.nn.functional.pad(
-                        clip_prompt_embeds,
-                        (0, t5_prompt_embed.shape[-1] - clip_prompt_embeds.shape[-1]),
+                if self._embedding_cache is not None:
+                    keys = [
+                        TextEmbeddingCache.key(*self._model_names, prompt)
+                        for prompt in prompts
+                    ]
+                    prompt_embeds, pooled_prompt_embeds = self._embedding_cache.lookup(
+                        keys,
+                        encode_fn=encode_fn,
+                        device=device,
+                        dtype=self._t5_encoder.dtype,
                     )
-                elif clip_prompt_embeds.shape[-1] > t5_prompt_embed.shape[-1]:
-                    t5_prompt_embed = torch.nn.functional.pad(
-                        t5_prompt_embed,
-                        (0, clip_prompt_embeds.shape[-1] - t5_prompt_embed.shape[-1]),
+                else:
+                    prompt_embeds, pooled_prompt_embeds = encode_fn(
+                        list(range(len(prompts)))
                     )
-
-                # Concatentate the CLIP and T5 text embeddings
-                # "and concatenate it along the sequence axis with c^T5_txt
-                # to obtain the final context representation c_txt ∈ R^154×4096"
-                prompt_embeds = torch.cat([clip_prompt_embeds, t5_prompt_embed], dim=-2)
-
-                # Concatenate the Pooled CLIP prompt embeddings
-                # "We concatenate the pooled outputs, of sizes 768 and 1280 respectively, to obtain
-                # a vector conditioning c_vec ∈ R^2048"
-                pooled_prompt_embeds = torch.cat(
-                    [pooled_prompt_embeds_1, pooled_prompt_embeds_2], dim=-1
-                )
             context["text_embeddings"] = prompt_embeds.detach().to(device)
             context["pooled_text_embeddings"] = pooled_prompt_embeds.detach().to(device)
         return context
 
+    def _encode_prompts(
+        self, prompts: List[str], device
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Encodes the prompts with the CLIP and T5 text encoders."""
+        self._move_encoders_to_device(device)
+        prompt_embeds_1, pooled_prompt_embeds_1 = self._get_clip_prompt_embeds(
+            prompt=prompts,
+            clip_encoder=self._clip_encoder_1,
+            clip_tokenizer=self._clip_tokenizer_1,
+            max_length=self._clip_tokenizer_1_max_length,
+            device=device,
+        )
+        prompt_embeds_2, pooled_prompt_embeds_2 = self._get_clip_prompt_embeds(
+            prompt=prompts,
+            clip_encoder=self._clip_encoder_2,
+            clip_tokenizer=self._clip_tokenizer_2,
+            max_length=self._clip_tokenizer_2_max_length,
+            device=device,
+        )
+
+        t5_prompt_embed = self._get_t5_prompt_embeds(
+            prompt=prompts,
+            max_sequence_length=self._t5_max_length,
+            device=device,
+            t5_tokenizer=self._t5_tokenizer,
+            t5_encoder=self._t5_encoder,
+        )
+        # Concatenate the CLIP prompt embeddings
+        # "We also concatenate the penultimate hidden representations channel-wise to a CLIP
+        # context conditioning c^CLIP_txt ∈ R^77×2048"
+        clip_prompt_embeds = torch.cat([prompt_embeds_1, prompt_embeds_2], dim=-1)
+
+        # Pad the CLIP prompt embeddings to the T5 prompt embeddings
+        # "Finally, we zero-pad c^CLIP_txt along the channel axis to 4096 dimensions
+        # to match the T5 representation"
+        if t5_prompt_embed.shape[-1] > clip_prompt_embeds.shape[-1]:
+            clip_prompt_embeds = torch.nn.functional.pad(
+                clip_prompt_embeds,
+                (0, t5_prompt_embed.shape[-1] - clip_prompt_embeds.shape[-1]),
+            )
+        elif clip_prompt_embeds.shape[-1] > t5_prompt_embed.shape[-1]:
+            t5_prompt_embed = torch.nn.functional.pad(
+                t5_prompt_embed,
+                (0, clip_prompt_embeds.shape[-1] - t5_prompt_embed.shape[-1]),
+            )
+
+        # Concatentate the CLIP and T5 text embeddings
+        # "and concatenate it along the sequence axis with c^T5_txt
+        # to obtain the final context representation c_txt ∈ R^154×4096"
+        prompt_embeds = torch.cat([clip_prompt_embeds, t5_prompt_embed], dim=-2)
+
+        # Concatenate the Pooled CLIP prompt embeddings
+        # "We concatenate the pooled outputs, of sizes 768 and 1280 respectively, to obtain
+        # a vector conditioning c_vec ∈ R^2048"
+        pooled_prompt_embeds = torch.cat(
+            [pooled_prompt_embeds_1, pooled_prompt_embeds_2], dim=-1
+        )
+        return prompt_embeds, pooled_prompt_embeds
+
+    def _move_encoders_to_device(self, device):
+        """Moves the text encoders to their resident device, if needed."""
+        encoder_device = torch.device(
+            self._encoder_device if self._encoder_device is not None else device
+        )
+        for encoder in [self._clip_encoder_1, self._clip_encoder_2, self._t5_encoder]:
+            if encoder.device != encoder_device:
+                encoder.to(encoder_device)
+
     def _get_clip_prompt_embeds(
         self,
         prompt: Union[str, List[str]],
@@ -379,12 +440,9 @@ class SD3TextPromptsPreprocessor(torch.nn.Module):
                 f" {self.tokenizer_max_length} tokens: {removed_text}"
             )
 
-        clip_encoder_device = clip_encoder.device
-        clip_encoder = clip_encoder.to(device)
         prompt_embeds = clip_encoder(
-            text_input_ids.to(device), output_hidden_states=True
+            text_input_ids.to(clip_encoder.device), output_hidden_states=True
         )
-        clip_encoder = clip_encoder.to(clip_encoder_device)
 
         pooled_prompt_embeds = prompt_embeds[0]
         prompt_embeds = prompt_embeds.hidden_states[-2]
@@ -444,10 +502,7 @@ class SD3TextPromptsPreprocessor(torch.nn.Module):
                 f" {max_sequence_length} tokens: {removed_text}"
             )
 
-        t5_device = t5_encoder.device
-        t5_encoder = t5_encoder.to(device)
-        prompt_embeds = t5_encoder(text_input_ids.to(device))[0]
-        t5_encoder = t5_encoder.to(t5_device)
+        prompt_embeds = t5_encoder(text_input_ids.to(t5_encoder.device))[0]
 
         dtype = t5_encoder.dtype
         prompt_embeds = prompt_embeds.to(dtype=dtype, device=device)
@@ -0,0 +1,83 @@
+"""Batched, device side transforms for raw datasets.
+
+Datasets which support batch transforms return the raw uint8 frames from their
+workers, and attach a BatchTransform which converts the whole batch to the
+training resolution and (0,1) float range once it is on the device. This avoids
+running a torchvision pipeline per sample in the data loader workers, and copies
+4x less data (uint8 instead of float32) from the host to the device.
+"""
+
+import torch
+from torch.utils.data import Dataset
+from torchvision.transforms import v2
+from typing import Callable, Dict, Optional, Tuple
+
+
+class BatchTransform:
+    """Resizes, scales and (optionally) inverts a batch of raw uint8 frames."""
+
+    def __init__(self, height: int, width: int, invert: bool = False):
+        """Initializes the transform.
+
+        Args:
+            height: The training height of the frames.
+            width: The training width of the frames.
+            invert: True to invert the frames, for LoRA training.
+        """
+        self._size = (height, width)
+        self._invert = invert
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        """Transforms the batch.
+
+        Args:
+            batch: Tensor batch of images of shape (B, C, H, W), or videos of
+                shape (B, C, F, H, W), typically uint8.
+
+        Returns:
+            The transformed batch in the range (0,1), at the training resolution.
+        """
+        batch = v2.functional.to_dtype(batch, torch.float32, scale=True)
+        batch = resize_batch(batch, self._size)
+        if self._invert:
+            batch = 1.0 - batch
+        return batch
+
+
+def resize_batch(
+    batch: torch.Tensor,
+    size: Tuple[int, int],
+    cache: Optional[Dict[Tuple[int, int], torch.Tensor]] = None,
+) -> torch.Tensor:
+    """Resizes the spatial dimensions of a batch of images or videos.
+
+    Args:
+        batch: Tensor batch of shape (..., H, W).
+        size: The (height, width) to resize to.
+        cache: Optional dictionary of previously resized versions of the
+            same batch, keyed by size, so each size is only computed once.
+
+    Returns:
+        The resized batch, or the batch itself if it is already the right size.
+    """
+    size = tuple(size)
+    if tuple(batch.shape[-2:]) == size:
+        return batch
+
+    if cache is not None and size in cache:
+        return cache[size]
+
+    resized = v2.functional.resize(batch, size=list(size), antialias=True)
+    if cache is not None:
+        cache[size] = resized
+    return resized
+
+
+def get_batch_transform(dataset: Dataset) -> Callable[[torch.Tensor], torch.Tensor]:
+    """Returns the batch transform of the dataset, or the identity if it has none."""
+    batch_transform = getattr(dataset, "batch_transform", None)
+    return batch_transform if batch_transform is not None else _identity
+
+
+def _identity(batch: torch.Tensor) -> torch.Tensor:
+    return batch
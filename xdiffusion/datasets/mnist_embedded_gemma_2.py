@@ -1,4 +1,5 @@
 from bs4 import BeautifulSoup
+from collections import OrderedDict
 import numpy as np
 import os
 import requests
@@ -52,17 +53,31 @@ def load_mnist(
 
 class MNISTEmbedded(Dataset):
 
-    def __init__(self, root_dir, transform=None, train: bool = True):
+    def __init__(
+        self,
+        root_dir,
+        transform=None,
+        train: bool = True,
+        max_open_shards: int = 4,
+    ):
         """
         Arguments:
             csv_file (string): Path to the csv file with annotations.
             root_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            max_open_shards (int): The maximum number of shards to keep memory
+                mapped at once, per dataloader worker.
         """
         self.root_dir = root_dir
         self.transform = transform
 
+        # LRU cache of open shard memmaps, keyed by shard index. Each
+        # dataloader worker gets its own copy of the dataset, and therefore
+        # its own cache.
+        self.max_open_shards = max_open_shards
+        self._open_shards = OrderedDict()
+
         self.local_image_data_fmt = (
             "MNISTEmbeddedGemma2/mnist_embedded_gemma_2_image_data_{shard_idx:03d}.npy"
         )
@@ -183,54 +198,95 @@ class MNISTEmbedded(Dataset):
         # Find out the index inside the shard this belongs to
         example_idx = idx - (shard_idx * self.examples_per_shard)
 
-        image_data_file_name = os.path.join(
-            self.root_dir, self.local_image_data_fmt.format(shard_idx=shard_idx)
-        )
-        class_labels_file_name = os.path.join(
-            self.root_dir, self.local_class_labels_fmt.format(shard_idx=shard_idx)
-        )
-        caption_embeddings_file_name = os.path.join(
-            self.root_dir, self.local_caption_embeddings_fmt.format(shard_idx=shard_idx)
-        )
-        caption_embedding_attention_masks_file_name = os.path.join(
-            self.root_dir,
-            self.local_caption_embedding_attention_masks_fmt.format(
-                shard_idx=shard_idx
-            ),
-        )
-
-        image_data = np.load(
-            image_data_file_name,
-            mmap_mode="r",
-        )
-        label_data = np.load(
-            class_labels_file_name,
-            mmap_mode="r",
-        )
-        embedding_data = np.load(
-            caption_embeddings_file_name,
-            mmap_mode="r",
-        )
-        mask_data = np.load(
-            caption_embedding_attention_masks_file_name,
-            mmap_mode="r",
-        )
-
-        rv = (
+        image_data, label_data, embedding_data, mask_data = self._get_shard(shard_idx)
+        return (
             torch.from_numpy(image_data[example_idx].copy()),
             torch.tensor(label_data[example_idx]),
             {
-                "text_embeddings": torch.from_numpy(embedding_data[example_idx].copy()).squeeze(0),
-                "text_attention_mask": torch.from_numpy(mask_data[example_idx].copy()).squeeze(0),
+                "text_embeddings": torch.from_numpy(
+                    embedding_data[example_idx].copy()
+                ).squeeze(0),
+                "text_attention_mask": torch.from_numpy(
+                    mask_data[example_idx].copy()
+                ).squeeze(0),
             },
         )
 
-        image_data._mmap.close()
-        label_data._mmap.close()
-        embedding_data._mmap.close()
-        mask_data._mmap.close()
+    def __getitems__(self, indices: List[int]) -> List:
+        """Batched version of __getitem__, used by the DataLoader fetcher.
 
-        return rv
+        Groups the indices by shard and gathers each shard with a single
+        (sorted) fancy-index read, rather than one read per example.
+        """
+        if torch.is_tensor(indices):
+            indices = indices.tolist()
+
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_indices = indices // self.examples_per_shard
+        example_indices = indices - (shard_indices * self.examples_per_shard)
+
+        samples = [None] * len(indices)
+        for shard_idx in np.unique(shard_indices):
+            positions = np.nonzero(shard_indices == shard_idx)[0]
+            shard_example_indices = example_indices[positions]
+
+            # Memory mapped reads are fastest in increasing order
+            order = np.argsort(shard_example_indices, kind="stable")
+            positions = positions[order]
+            shard_example_indices = shard_example_indices[order]
+
+            image_data, label_data, embedding_data, mask_data = self._get_shard(
+                int(shard_idx)
+            )
+            images = torch.from_numpy(image_data[shard_example_indices])
+            labels = torch.from_numpy(np.asarray(label_data[shard_example_indices]))
+            embeddings = torch.from_numpy(embedding_data[shard_example_indices])
+            masks = torch.from_numpy(mask_data[shard_example_indices])
+
+            for i, position in enumerate(positions):
+                samples[position] = (
+                    images[i],
+                    labels[i],
+                    {
+                        "text_embeddings": embeddings[i].squeeze(0),
+                        "text_attention_mask": masks[i].squeeze(0),
+                    },
+                )
+        return samples
+
+    def __getstate__(self):
+        # Never send open memory maps to the dataloader workers, each
+        # worker opens its own shards lazily.
+        state = self.__dict__.copy()
+        state["_open_shards"] = OrderedDict()
+        return state
+
+    def _get_shard(self, shard_idx: int) -> Tuple[np.ndarray, ...]:
+        """Returns the (cached) memory mapped arrays for a shard."""
+        if shard_idx in self._open_shards:
+            self._open_shards.move_to_end(shard_idx)
+            return self._open_shards[shard_idx]
+
+        shard = tuple(
+            np.load(
+                os.path.join(self.root_dir, fmt.format(shard_idx=shard_idx)),
+                mmap_mode="r",
+            )
+            for fmt in (
+                self.local_image_data_fmt,
+                self.local_class_labels_fmt,
+                self.local_caption_embeddings_fmt,
+                self.local_caption_embedding_attention_masks_fmt,
+            )
+        )
+        self._open_shards[shard_idx] = shard
+
+        # Evict the least recently used shard
+        while len(self._open_shards) > self.max_open_shards:
+            _, evicted_shard = self._open_shards.popitem(last=False)
+            for data in evicted_shard:
+                data._mmap.close()
+        return shard
 
 
 def download_from_http(url, filename):
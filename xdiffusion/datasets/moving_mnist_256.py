@@ -15,7 +15,9 @@ import torch
 from torch.utils.data import Dataset
 from torchvision.transforms import v2
 from tqdm import tqdm
-from typing import Callable, List, Tuple
+from typing import Callable, List, Optional, Tuple
+
+from xdiffusion.datasets.batch_transforms import BatchTransform
 
 
 def load_moving_mnist(
@@ -23,6 +25,7 @@ def load_moving_mnist(
     training_width: int,
     split: str = "train",
     invert: bool = False,
+    batch_transforms: bool = False,
 ) -> Tuple[Dataset, Callable[[torch.Tensor], List[str]]]:
     assert split in ["train"]
 
@@ -50,9 +53,16 @@ def load_moving_mnist(
             v2.ToDtype(torch.float32, scale=True),
         ]
 
+    # With batch transforms, the dataset returns the raw uint8 videos and
+    # the same transforms are applied to the whole batch on the device.
     dataset = MovingMNIST(
         ".",
-        transform=v2.Compose(xforms),
+        transform=v2.Compose(xforms) if not batch_transforms else None,
+        batch_transform=(
+            BatchTransform(height=training_height, width=training_width, invert=invert)
+            if batch_transforms
+            else None
+        ),
     )
 
     return dataset, convert_labels_to_prompts
@@ -61,15 +71,24 @@ def load_moving_mnist(
 class MovingMNIST(Dataset):
     """Moving MNIST dataset."""
 
-    def __init__(self, root_dir, transform=None):
+    def __init__(
+        self,
+        root_dir,
+        transform=None,
+        batch_transform: Optional[BatchTransform] = None,
+    ):
         """
         Args:
             root_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            batch_transform (BatchTransform, optional): Transform to be applied
+                to the raw batches on the device, instead of a per-sample
+                transform.
         """
         self.root_dir = root_dir
         self.transform = transform
+        self.batch_transform = batch_transform
 
         # Download the data to the root dir if it does not exist
         from urllib.request import urlretrieve
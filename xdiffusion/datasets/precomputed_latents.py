@@ -0,0 +1,134 @@
+"""Dataset of latents precomputed by tools/precompute_latents.py.
+
+Latent diffusion models encode every training batch with a frozen VAE. Since the
+VAE never changes, the posterior of each example can be computed once, offline,
+and training can read it directly from sharded, memory-mapped numpy files.
+
+The shard directory contains:
+    metadata.json: The shard layout and the latent scale factor.
+    latents_mean_{shard_idx:03d}.npy: The posterior mean of each example.
+    latents_std_{shard_idx:03d}.npy: The posterior standard deviation of each
+        example, if the VAE has a stochastic posterior.
+    labels_{shard_idx:03d}.npy: The labels of each example.
+"""
+
+from collections import OrderedDict
+import json
+import numpy as np
+import os
+import torch
+from torch.utils.data import Dataset
+from typing import Dict, List, Tuple
+
+METADATA_FILE_NAME = "metadata.json"
+LATENTS_MEAN_FMT = "latents_mean_{shard_idx:03d}.npy"
+LATENTS_STD_FMT = "latents_std_{shard_idx:03d}.npy"
+LABELS_FMT = "labels_{shard_idx:03d}.npy"
+
+
+def load_latents_metadata(root_dir: str) -> Dict:
+    """Loads the metadata of a precomputed latents directory."""
+    with open(os.path.join(root_dir, METADATA_FILE_NAME), "r") as fp:
+        return json.load(fp)
+
+
+class PrecomputedLatentsDataset(Dataset):
+    def __init__(
+        self,
+        root_dir: str,
+        sample_posterior: bool = True,
+        max_open_shards: int = 4,
+    ):
+        """
+        Arguments:
+            root_dir (string): Directory with the precomputed latent shards.
+            sample_posterior (bool): If True, and the posterior standard deviation
+                was stored, then each example is a new sample from the posterior
+                (matching encode_to_latents). Otherwise the posterior mean is used.
+            max_open_shards (int): The maximum number of shards to keep memory
+                mapped at once, per dataloader worker.
+        """
+        self.root_dir = root_dir
+        self.sample_posterior = sample_posterior
+        self.max_open_shards = max_open_shards
+        self._open_shards = OrderedDict()
+
+        metadata = load_latents_metadata(root_dir)
+        self.num_shards = metadata["num_shards"]
+        self.examples_per_shard = metadata["examples_per_shard"]
+        self.total_examples = metadata["total_examples"]
+        self.latent_shape = tuple(metadata["latent_shape"])
+        self.latent_scale_factor = metadata["latent_scale_factor"]
+        self.has_std = metadata["has_std"]
+
+    def __len__(self):
+        return self.total_examples
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices: List[int]) -> List:
+        """Batched version of __getitem__, used by the DataLoader fetcher."""
+        if torch.is_tensor(indices):
+            indices = indices.tolist()
+
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_indices = indices // self.examples_per_shard
+        example_indices = indices - (shard_indices * self.examples_per_shard)
+
+        samples = [None] * len(indices)
+        for shard_idx in np.unique(shard_indices):
+            positions = np.nonzero(shard_indices == shard_idx)[0]
+            shard_example_indices = example_indices[positions]
+
+            # Memory mapped reads are fastest in increasing order
+            order = np.argsort(shard_example_indices, kind="stable")
+            positions = positions[order]
+            shard_example_indices = shard_example_indices[order]
+
+            mean_data, std_data, label_data = self._get_shard(int(shard_idx))
+            latents = torch.from_numpy(mean_data[shard_example_indices])
+            if self.sample_posterior and std_data is not None:
+                std = torch.from_numpy(std_data[shard_example_indices])
+                latents = latents + std * torch.randn_like(latents)
+            labels = torch.from_numpy(np.asarray(label_data[shard_example_indices]))
+
+            for i, position in enumerate(positions):
+                samples[position] = (latents[i], labels[i])
+        return samples
+
+    def __getstate__(self):
+        # Never send open memory maps to the dataloader workers, each
+        # worker opens its own shards lazily.
+        state = self.__dict__.copy()
+        state["_open_shards"] = OrderedDict()
+        return state
+
+    def _get_shard(self, shard_idx: int) -> Tuple[np.ndarray, ...]:
+        """Returns the (cached) memory mapped arrays for a shard."""
+        if shard_idx in self._open_shards:
+            self._open_shards.move_to_end(shard_idx)
+            return self._open_shards[shard_idx]
+
+        def _load(fmt):
+            return np.load(
+                os.path.join(self.root_dir, fmt.format(shard_idx=shard_idx)),
+                mmap_mode="r",
+            )
+
+        shard = (
+            _load(LATENTS_MEAN_FMT),
+            _load(LATENTS_STD_FMT) if self.has_std else None,
+            _load(LABELS_FMT),
+        )
+        self._open_shards[shard_idx] = shard
+
+        # Evict the least recently used shard
+        while len(self._open_shards) > self.max_open_shards:
+            _, evicted_shard = self._open_shards.popitem(last=False)
+            for data in evicted_shard:
+                if data is not None:
+                    data._mmap.close()
+        return shard
@@ -9,7 +9,21 @@ def load_dataset(
     dataset_name: str,
     config: DotConfig,
     split: str = "train",
+    batch_transforms: bool = False,
 ) -> Tuple[Dataset, Callable[[torch.Tensor], List[str]]]:
+    """Loads the named dataset.
+
+    Args:
+        dataset_name: The name of the dataset to load.
+        config: The data section of the configuration file.
+        split: The dataset split to load.
+        batch_transforms: If True, and the dataset supports it, the dataset returns
+            raw uint8 samples, and the resize/scaling transforms are applied per
+            batch on the device. See xdiffusion.datasets.batch_transforms.
+
+    Returns:
+        Tuple of the dataset, and the function to convert labels to text prompts.
+    """
     assert dataset_name in [
         "image/mnist",
         "image/mnist_inverted",
@@ -45,6 +59,7 @@ def load_dataset(
             training_height=config.image_size,
             training_width=config.image_size,
             split=split,
+            batch_transforms=batch_transforms,
         )
     elif dataset_name == "image/moving_mnist_inverted":
         from xdiffusion.datasets.moving_mnist import load_moving_mnist_image
@@ -54,6 +69,7 @@ def load_dataset(
             training_width=config.image_size,
             split=split,
             invert=True,
+            batch_transforms=batch_transforms,
         )
     elif dataset_name == "image/cifar10":
         from xdiffusion.datasets.cifar10 import load_cifar10
@@ -78,6 +94,7 @@ def load_dataset(
             training_height=config.image_size,
             training_width=config.image_size,
             split=split,
+            batch_transforms=batch_transforms,
         )
     elif dataset_name == "video/moving_mnist_256":
         from xdiffusion.datasets.moving_mnist_256 import load_moving_mnist
@@ -86,6 +103,7 @@ def load_dataset(
             training_height=config.image_size,
             training_width=config.image_size,
             split=split,
+            batch_transforms=batch_transforms,
         )
 
     raise NotImplementedError(f"Dataset '{dataset_name}' not implemented yet.")
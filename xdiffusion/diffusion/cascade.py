@@ -1,10 +1,10 @@
 from einops import reduce
 import numpy as np
 import torch
-from torchvision import transforms
 from tqdm import tqdm
 from typing import Callable, Dict, List, Optional, Tuple
 
+from xdiffusion.datasets.batch_transforms import resize_batch
 from xdiffusion.diffusion.ddpm import GaussianDiffusion_DDPM
 from xdiffusion.diffusion import DiffusionModel
 from xdiffusion.samplers.base import ReverseProcessSampler
@@ -77,25 +77,28 @@ class GaussianDiffusionCascade(DiffusionModel):
         return optimizers
 
     def forward(self, images: torch.FloatTensor, context: Dict, **kwargs):
+        # The low resolution context of each stage is usually the input resolution
+        # of the previous stage, so only resize the batch once per resolution.
+        resized_images = {}
+
         # Sum the losses from each of the stages
         stage_loss = 0
         for model in self.models():
             config_for_layer = model.config()
             context_for_layer = context.copy()
-            images_for_layer = images
 
             if "super_resolution" in config_for_layer:
                 # First create the low resolution context.
                 low_resolution_spatial_size = (
                     config_for_layer.super_resolution.low_resolution_size
                 )
-                low_resolution_images = transforms.functional.resize(
+                low_resolution_images = resize_batch(
                     images,
                     size=(
                         low_resolution_spatial_size,
                         low_resolution_spatial_size,
                     ),
-                    antialias=True,
+                    cache=resized_images,
                 )
                 context_for_layer[
                     config_for_layer.super_resolution.conditioning_key
@@ -106,16 +109,14 @@ class GaussianDiffusionCascade(DiffusionModel):
             # super resolution layers of a multi-layer cascade.
             model_input_spatial_size = config_for_layer.data.image_size
 
-            B, C, H, W = images.shape
-            if H != model_input_spatial_size or W != model_input_spatial_size:
-                images_for_layer = transforms.functional.resize(
-                    images,
-                    size=(
-                        model_input_spatial_size,
-                        model_input_spatial_size,
-                    ),
-                    antialias=True,
-                )
+            images_for_layer = resize_batch(
+                images,
+                size=(
+                    model_input_spatial_size,
+                    model_input_spatial_size,
+                ),
+                cache=resized_images,
+            )
 
             try:
                 loss_dict = model.loss_on_batch(
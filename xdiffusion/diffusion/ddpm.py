@@ -6,6 +6,7 @@ from different papers:
 """
 
 import accelerate
+from contextlib import nullcontext
 from einops import reduce
 import numpy as np
 import time
@@ -15,9 +16,14 @@ from tqdm.autonotebook import tqdm
 from typing import Callable, Dict, List, Optional, Tuple, Union
 from typing_extensions import Self
 
+from xdiffusion.autoencoders.decode_policy import DecodePolicy
+from xdiffusion.checkpoint import load_model_state_dict
 from xdiffusion.diffusion import DiffusionModel, PredictionType
+from xdiffusion.layers.attention import configure_attention_backend_from_config
+from xdiffusion.layers.block_cache import BlockCache, configure_block_cache
 from xdiffusion.samplers.ancestral import AncestralSampler
 from xdiffusion.samplers.base import ReverseProcessSampler
+from xdiffusion.samplers.plan import SamplingPlan
 from xdiffusion.sde.base import SDE
 from xdiffusion.scheduler import NoiseScheduler
 from xdiffusion.utils import (
@@ -64,6 +70,22 @@ class GaussianDiffusion_DDPM(DiffusionModel):
             config.diffusion.score_network, use_config_struct=True
         )
 
+        # Select the attention backend of the score network, if specified.
+        configure_attention_backend_from_config(self._score_network, config)
+
+        # Reuse the transformer block outputs of the score network across
+        # sampling steps, if specified.
+        self._block_cache: Optional[BlockCache] = None
+        if (
+            "block_cache" in config.diffusion.sampling
+            and config.diffusion.sampling.block_cache.enable
+        ):
+            block_cache_params = config.diffusion.sampling.block_cache.to_dict()
+            block_cache_params.pop("enable")
+            self._block_cache = configure_block_cache(
+                self._score_network, **block_cache_params
+            )
+
         self._is_learned_sigma = config.diffusion.score_network.params.is_learned_sigma
         self._is_class_conditional = (
             (config.diffusion.score_network.params.is_class_conditional)
@@ -123,6 +145,23 @@ class GaussianDiffusion_DDPM(DiffusionModel):
         if self._latent_encoder is not None:
             freeze(self._latent_encoder)
 
+        # The policy for decoding sampled latents, which can bound the peak
+        # memory of the decode by chunking and tiling it.
+        if "decode_policy" in config.diffusion.sampling:
+            self._decode_policy = instantiate_from_config(
+                config.diffusion.sampling.decode_policy.to_dict()
+            )
+        else:
+            self._decode_policy = DecodePolicy()
+
+        # If the training batches are latents precomputed offline by
+        # tools/precompute_latents.py, then skip the latent encoder in training.
+        self._precomputed_latents = (
+            "training" in config
+            and "precomputed_latents" in config.training
+            and self._latent_encoder is not None
+        )
+
     def models(self) -> List[DiffusionModel]:
         return [self]
 
@@ -139,6 +178,30 @@ class GaussianDiffusion_DDPM(DiffusionModel):
         # EMA not supported yet
         return
 
+    def set_latent_scale_factor(self, latent_scale_factor: float):
+        """Sets the latent scale factor, if it has not been set already.
+
+        Normally the scale factor is calculated from the first training batch.
+        When training on precomputed latents, the scale factor stored with the
+        latents is used instead.
+        """
+        if self._latent_scale_factor == -1.0:
+            del self._latent_scale_factor
+            self.register_buffer(
+                "_latent_scale_factor", torch.tensor(latent_scale_factor)
+            )
+            print(f"Latent scale factor: {self._latent_scale_factor}")
+
+    def encode_to_latents(self, x: torch.Tensor) -> torch.Tensor:
+        """Encodes pixels in the range [0,1] into the scaled latent space.
+
+        Requires a latent encoder, and a latent scale factor which has already
+        been calculated (or set with set_latent_scale_factor).
+        """
+        assert self._latent_encoder is not None, "No latent encoder."
+        assert self._latent_scale_factor != -1.0, "The latent scale factor is not set."
+        return self._latent_encoder.encode_to_latents(x) * self._latent_scale_factor
+
     def forward(self, images: torch.FloatTensor, context: Dict, **kwargs):
         return self.loss_on_batch(images=images, context=context)
 
@@ -163,7 +226,13 @@ class GaussianDiffusion_DDPM(DiffusionModel):
         context = context.copy()
 
         # Encode the normalized images into latents to send to the score network
-        if self._latent_encoder is not None:
+        if self._precomputed_latents:
+            # The batch is already (unscaled) latents.
+            assert (
+                self._latent_scale_factor != -1.0
+            ), "set_latent_scale_factor() must be called when training on precomputed latents."
+            z_0 = images * self._latent_scale_factor
+        elif self._latent_encoder is not None:
             # The latent encoder assumes pixels are coming in [0,1]
             x_0 = images
             z_0 = self._latent_encoder.encode_to_latents(x_0)
@@ -633,26 +702,34 @@ class GaussianDiffusion_DDPM(DiffusionModel):
             else self._noise_scheduler.steps()
         )
 
-        latent_samples, intermediate_outputs = self._p_sample_loop(
-            shape,
-            context=context,
-            unconditional_context=unconditional_context,
-            guidance_fn=guidance_fn,
-            classifier_free_guidance=classifier_free_guidance,
-            num_sampling_steps=sampling_steps,
-            sampler=sampler,
-            initial_noise=initial_noise,
-        )
+        # The block cache is only active for the steps of this trajectory.
+        with (
+            self._block_cache.sampling()
+            if self._block_cache is not None
+            else nullcontext()
+        ):
+            latent_samples, intermediate_outputs = self._p_sample_loop(
+                shape,
+                context=context,
+                unconditional_context=unconditional_context,
+                guidance_fn=guidance_fn,
+                classifier_free_guidance=classifier_free_guidance,
+                num_sampling_steps=sampling_steps,
+                sampler=sampler,
+                initial_noise=initial_noise,
+            )
         latents = latent_samples
 
         # Decode the samples from the latent space
         if self._latent_encoder is not None:
             # TODO: Grab the exact last timestep. For now, assume that all of them
             #       are really small. Rectified flow uses 1e-3, so let's use that here.
-            latents = self._latent_encoder.decode_from_latents(
+            latents = self._decode_policy.decode(
+                lambda z: self._latent_encoder.decode_from_latents(
+                    z,
+                    timestep=torch.ones(size=(z.shape[0],), device=z.device) * 1e-3,
+                ),
                 latents / self._latent_scale_factor,
-                timestep=torch.ones(size=(latents.shape[0],), device=latents.device)
-                * 1e-3,
             )
 
             if (
@@ -794,21 +871,14 @@ class GaussianDiffusion_DDPM(DiffusionModel):
 
     def load_checkpoint(self, checkpoint_path: str, strict: bool = False):
         # Load the state dict for the score network
-        checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
         if hasattr(self._score_network, "load_model_weights"):
-            state_dict = checkpoint["model_state_dict"]
-
             # Only preserve the score network keys
-            score_network_state_pairs = []
-            namespace = "_score_network."
-            for k, v in state_dict.items():
-                if k.startswith(namespace):
-                    k = k[len(namespace) :]
-                    score_network_state_pairs.append((k, v))
-            self._score_network.load_model_weights(dict(score_network_state_pairs))
+            self._score_network.load_model_weights(
+                load_model_state_dict(checkpoint_path, prefix="_score_network.")
+            )
         else:
             missing_keys, unexpected_keys = self.load_state_dict(
-                checkpoint["model_state_dict"], strict=strict
+                load_model_state_dict(checkpoint_path), strict=strict
             )
             for k in missing_keys:
                 assert "temporal" in k or "motion_module" in k, k
@@ -860,6 +930,9 @@ class GaussianDiffusion_DDPM(DiffusionModel):
     def classifier_free_guidance(self) -> float:
         return self._classifier_free_guidance
 
+    def block_cache(self) -> Optional[BlockCache]:
+        return self._block_cache
+
     def prediction_type(self) -> PredictionType:
         return self._prediction_type
 
@@ -916,46 +989,29 @@ class GaussianDiffusion_DDPM(DiffusionModel):
             initial_timestep = self._config.diffusion.sampling.initial_timestep
 
         sampler = sampler if sampler is not None else self._reverse_process_sampler
-        for timestep_idx in tqdm(
-            reversed(range(initial_timestep, num_sampling_steps)),
+
+        # Precompute the timestep state for the whole trajectory, so that the
+        # loop only needs to index into it.
+        plan = SamplingPlan(
+            noise_scheduler=self._noise_scheduler,
+            batch_size=shape[0],
+            num_sampling_steps=num_sampling_steps,
+            initial_timestep=initial_timestep,
+            device=device,
+        )
+        for step in tqdm(
+            range(len(plan)),
             desc="sampling loop time step",
             total=num_sampling_steps,
             leave=False,
         ):
-            # Some of the score network preprocessors can update the
-            # context at each call, so we need to use a new dictionary
-            # at each step to preserve the original context.
-            context_for_timestep = context.copy()
-            if unconditional_context is not None:
-                unconditional_context_for_timestep = unconditional_context.copy()
-            else:
-                unconditional_context_for_timestep = None
-
-            t = torch.tensor([timestep_idx] * shape[0], device=device)
-            context_for_timestep["timestep_idx"] = timestep_idx
-            if self._noise_scheduler.continuous():
-                context_for_timestep["logsnr_s"] = self._noise_scheduler.logsnr(
-                    t / num_sampling_steps
-                )
-
-                t_plus_1 = t + 1
-                context_for_timestep["logsnr_t"] = self._noise_scheduler.logsnr(
-                    t_plus_1 / num_sampling_steps
-                )
+            if self._block_cache is not None:
+                self._block_cache.next_step(final_step=step == len(plan) - 1)
 
-                if unconditional_context_for_timestep is not None:
-                    unconditional_context_for_timestep["timestep_idx"] = timestep_idx
-                    unconditional_context_for_timestep["logsnr_s"] = (
-                        self._noise_scheduler.logsnr(t / num_sampling_steps)
-                    )
-                    unconditional_context_for_timestep["logsnr_t"] = (
-                        self._noise_scheduler.logsnr(t_plus_1 / num_sampling_steps)
-                    )
-                t = t / num_sampling_steps
-            context_for_timestep["timestep"] = t
-
-            if unconditional_context_for_timestep is not None:
-                unconditional_context_for_timestep["timestep"] = t
+            context_for_timestep = plan.step_context(step, context)
+            unconditional_context_for_timestep = plan.step_context(
+                step, unconditional_context
+            )
 
             # If there is a video mask, make to sure add in the unmasked
             # frames from the original conditioning. A mask value of 1 means generate,
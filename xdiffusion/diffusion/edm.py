@@ -12,7 +12,9 @@ from torchinfo import summary
 from typing import Callable, Dict, List, Optional, Tuple, Union
 from typing_extensions import Self
 
+from xdiffusion.checkpoint import load_model_state_dict
 from xdiffusion.diffusion import DiffusionModel, PredictionType
+from xdiffusion.layers.attention import configure_attention_backend_from_config
 from xdiffusion.samplers.base import ReverseProcessSampler
 from xdiffusion.scheduler import NoiseScheduler
 from xdiffusion.sde.base import SDE
@@ -36,6 +38,10 @@ class GaussianDiffusion_EDM(DiffusionModel):
         self._score_network = instantiate_from_config(
             config.diffusion.score_network.to_dict()
         )
+
+        # Select the attention backend of the score network, if specified.
+        configure_attention_backend_from_config(self._score_network, config)
+
         self._context_preprocessors = []
         self._loss = instantiate_from_config(config.diffusion.loss.to_dict())
         self._augment_pipeline = None
@@ -177,21 +183,14 @@ class GaussianDiffusion_EDM(DiffusionModel):
 
     def load_checkpoint(self, checkpoint_path: str, strict: bool = False):
         # Load the state dict for the score network
-        checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
         if hasattr(self._score_network, "load_model_weights"):
-            state_dict = checkpoint["model_state_dict"]
-
             # Only preserve the score network keys
-            score_network_state_pairs = []
-            namespace = "_score_network."
-            for k, v in state_dict.items():
-                if k.startswith(namespace):
-                    k = k[len(namespace) :]
-                    score_network_state_pairs.append((k, v))
-            self._score_network.load_model_weights(dict(score_network_state_pairs))
+            self._score_network.load_model_weights(
+                load_model_state_dict(checkpoint_path, prefix="_score_network.")
+            )
         else:
             missing_keys, unexpected_keys = self.load_state_dict(
-                checkpoint["model_state_dict"], strict=strict
+                load_model_state_dict(checkpoint_path), strict=strict
             )
             for k in missing_keys:
                 assert "temporal" in k, k
@@ -0,0 +1,180 @@
+"""Data parallel sampling across accelerate processes.
+
+The sampling scripts generate all of their samples on a single device. To
+generate large evaluation sets, the distributed sampling mode instead splits
+the requested number of samples across the accelerate processes (launched with
+`accelerate launch`), with each process:
+
+- Generating a contiguous slice of the global sample indices, in batches.
+- Seeding its random number generators with seed + process index, so that a
+  run is reproducible for the same seed and number of processes.
+- Writing one file per sample (PNG or GIF) into its own shard directory,
+  along with a shard manifest describing each sample.
+
+Once every process has finished, the main process merges the shard manifests
+into a single manifest.json, ordered by global sample index:
+
+output_path/
+  manifest.json
+  rank-00/
+    000000.png
+    000001.png
+    ...
+  rank-01/
+    ...
+"""
+
+from accelerate import Accelerator
+from accelerate.utils import gather_object, set_seed
+import json
+import os
+import torch
+from torchvision import utils
+from typing import Any, Dict, List, Optional, Tuple
+
+from xdiffusion.utils import video_tensor_to_gif
+
+MANIFEST_FILE_NAME = "manifest.json"
+SHARD_DIR_FMT = "rank-{rank:02d}"
+SHARD_MANIFEST_FMT = "manifest-rank-{rank:02d}.json"
+
+
+def get_sample_range(
+    num_samples: int, num_processes: int, process_index: int
+) -> Tuple[int, int]:
+    """Returns the [start, end) global sample indices generated by a process.
+
+    The samples are split as evenly as possible, with the first
+    num_samples % num_processes processes generating one extra sample.
+    """
+    samples_per_process, remainder = divmod(num_samples, num_processes)
+    start = process_index * samples_per_process + min(process_index, remainder)
+    end = start + samples_per_process + (1 if process_index < remainder else 0)
+    return start, end
+
+
+def seed_process(seed: int):
+    """Seeds the random number generators of this process with seed + process index."""
+    set_seed(seed, device_specific=True)
+
+
+def gather_samples(
+    accelerator: Accelerator, samples: List[torch.Tensor]
+) -> torch.Tensor:
+    """Gathers the (possibly unevenly sized) samples of every process.
+
+    Args:
+        accelerator: The accelerator the processes were launched with.
+        samples: List of tensor batches of samples from this process, each of
+            shape (B, ...). May be empty if the process has no samples.
+
+    Returns:
+        The samples of all processes on the CPU, concatenated in process order.
+    """
+    return torch.cat(gather_object([s.cpu() for s in samples]), dim=0)
+
+
+class SampleShardWriter:
+    """Writes the samples of one process to its shard, and merges the manifests."""
+
+    def __init__(self, output_path: str, accelerator: Accelerator):
+        """Initializes the writer.
+
+        Args:
+            output_path: The root output directory, shared by all processes.
+            accelerator: The accelerator the processes were launched with.
+        """
+        self._output_path = output_path
+        self._accelerator = accelerator
+        self._rank = accelerator.process_index
+        self._shard_dir = SHARD_DIR_FMT.format(rank=self._rank)
+        self._entries: List[Dict[str, Any]] = []
+        os.makedirs(os.path.join(output_path, self._shard_dir), exist_ok=True)
+
+    def _path(self, index: int, extension: str) -> str:
+        return os.path.join(self._shard_dir, f"{index:06d}.{extension}")
+
+    def _add_entries(
+        self,
+        start_index: int,
+        paths: List[str],
+        prompts: Optional[List[str]],
+        classes: Optional[torch.Tensor],
+    ):
+        if classes is not None:
+            classes = classes.cpu().tolist()
+
+        for i, path in enumerate(paths):
+            entry = {"index": start_index + i, "rank": self._rank, "path": path}
+            if prompts is not None:
+                entry["prompt"] = prompts[i]
+            if classes is not None:
+                entry["class"] = classes[i]
+            self._entries.append(entry)
+
+    def write_images(
+        self,
+        samples: torch.Tensor,
+        start_index: int,
+        prompts: Optional[List[str]] = None,
+        classes: Optional[torch.Tensor] = None,
+    ):
+        """Writes a batch of images, of shape (B, C, H, W) in the range (0,1), as PNGs."""
+        paths = [self._path(start_index + i, "png") for i in range(samples.shape[0])]
+        for sample, path in zip(samples.cpu(), paths):
+            utils.save_image(sample, os.path.join(self._output_path, path))
+        self._add_entries(start_index, paths, prompts, classes)
+
+    def write_videos(
+        self,
+        samples: torch.Tensor,
+        start_index: int,
+        prompts: Optional[List[str]] = None,
+        classes: Optional[torch.Tensor] = None,
+    ):
+        """Writes a batch of videos, of shape (B, C, F, H, W) in the range (0,1), as GIFs."""
+        paths = [self._path(start_index + i, "gif") for i in range(samples.shape[0])]
+        for sample, path in zip(samples.cpu(), paths):
+            video_tensor_to_gif(sample[None], os.path.join(self._output_path, path))
+        self._add_entries(start_index, paths, prompts, classes)
+
+    def finalize(self) -> Optional[str]:
+        """Writes the shard manifest, and merges all of the manifests.
+
+        Must be called by every process, since it waits for all of the
+        processes to finish writing their shards.
+
+        Returns:
+            The path of the merged manifest on the main process, otherwise None.
+        """
+        with open(
+            os.path.join(self._output_path, SHARD_MANIFEST_FMT.format(rank=self._rank)),
+            "w",
+        ) as fp:
+            json.dump(self._entries, fp)
+        self._accelerator.wait_for_everyone()
+
+        if not self._accelerator.is_main_process:
+            return None
+
+        entries = []
+        for rank in range(self._accelerator.num_processes):
+            shard_manifest_path = os.path.join(
+                self._output_path, SHARD_MANIFEST_FMT.format(rank=rank)
+            )
+            with open(shard_manifest_path, "r") as fp:
+                entries.extend(json.load(fp))
+            os.remove(shard_manifest_path)
+
+        manifest_path = os.path.join(self._output_path, MANIFEST_FILE_NAME)
+        with open(manifest_path, "w") as fp:
+            json.dump(
+                {
+                    "num_samples": len(entries),
+                    "num_processes": self._accelerator.num_processes,
+                    "samples": sorted(entries, key=lambda e: e["index"]),
+                },
+                fp,
+                indent=2,
+            )
+        return manifest_path
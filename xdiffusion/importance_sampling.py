@@ -79,36 +79,147 @@ class UniformSampler(ScheduleSampler):
 
 
 class ImportanceSampler(ScheduleSampler):
-    """Importance sampler over timesteps."""
+    """Importance sampler over timesteps.
 
-    def __init__(self, num_timesteps, history_per_term=10, uniform_prob=0.001):
+    Keeps the last history_per_term losses of each timestep in a ring buffer,
+    along with the running sum of their squares, so that both updates and
+    weights() are vectorized and independent of history_per_term.
+    """
+
+    def __init__(
+        self,
+        num_timesteps,
+        history_per_term=10,
+        uniform_prob=0.001,
+        sync_across_processes: bool = False,
+    ):
+        """Initializes the sampler.
+
+        Args:
+            num_timesteps: The number of diffusion timesteps.
+            history_per_term: The number of losses to keep per timestep.
+            uniform_prob: The probability mass spread uniformly over all timesteps.
+            sync_across_processes: If True, gather the losses from all of the
+                (accelerate/torch.distributed) processes at each update, so that
+                every process samples from the same loss history.
+        """
         super().__init__()
         self.num_timesteps = num_timesteps
         self.history_per_term = history_per_term
         self.uniform_prob = uniform_prob
+        self.sync_across_processes = sync_across_processes
         self._loss_history = np.zeros(
             [num_timesteps, history_per_term], dtype=np.float64
         )
         self._loss_counts = np.zeros([num_timesteps], dtype=np.int64)
 
+        # Ring buffer write position for each timestep.
+        self._heads = np.zeros([num_timesteps], dtype=np.int64)
+
+        # Running sum of the squared losses in the history of each timestep.
+        self._sum_squared_losses = np.zeros([num_timesteps], dtype=np.float64)
+        self._is_warmed_up = False
+
     def weights(self):
         if not self._warmed_up():
             return np.ones([self.num_timesteps], dtype=np.float64)
-        weights = np.sqrt(np.mean(self._loss_history**2, axis=-1))
+        weights = np.sqrt(
+            np.maximum(self._sum_squared_losses, 0.0) / self.history_per_term
+        )
         weights /= np.sum(weights)
         weights *= 1 - self.uniform_prob
         weights += self.uniform_prob / len(weights)
         return weights
 
     def update_with_all_losses(self, ts, losses):
-        for t, loss in zip(ts, losses):
-            if self._loss_counts[t] == self.history_per_term:
-                # Shift out the oldest loss term.
-                self._loss_history[t, :-1] = self._loss_history[t, 1:]
-                self._loss_history[t, -1] = loss
-            else:
-                self._loss_history[t, self._loss_counts[t]] = loss
-                self._loss_counts[t] += 1
+        if self.sync_across_processes:
+            ts, losses = _all_gather_losses(ts, losses)
+
+        ts = _to_numpy(ts).astype(np.int64).reshape(-1)
+        losses = _to_numpy(losses).astype(np.float64).reshape(-1)
+        if ts.shape[0] == 0:
+            return
+
+        # Group the losses by timestep, preserving the batch order within
+        # each timestep, and find the rank of each loss within its group.
+        order = np.argsort(ts, kind="stable")
+        ts = ts[order]
+        losses = losses[order]
+        unique_ts, first_indices, counts = np.unique(
+            ts, return_index=True, return_counts=True
+        )
+        ranks = np.arange(ts.shape[0]) - np.repeat(first_indices, counts)
+
+        # Only the newest history_per_term losses of each timestep are kept.
+        keep = ranks >= np.repeat(counts, counts) - self.history_per_term
+        ts = ts[keep]
+        losses = losses[keep]
+        ranks = ranks[keep]
+
+        # Scatter the losses into the ring buffer, replacing the oldest entries.
+        slots = (self._heads[ts] + ranks) % self.history_per_term
+        previous_losses = self._loss_history[ts, slots]
+        self._sum_squared_losses += np.bincount(
+            ts,
+            weights=losses**2 - previous_losses**2,
+            minlength=self.num_timesteps,
+        )
+        self._loss_history[ts, slots] = losses
+        self._heads[unique_ts] = (
+            self._heads[unique_ts] + counts
+        ) % self.history_per_term
+        self._loss_counts[unique_ts] = np.minimum(
+            self._loss_counts[unique_ts] + counts, self.history_per_term
+        )
 
     def _warmed_up(self):
-        return (self._loss_counts == self.history_per_term).all()
+        # Once every timestep has a full history, it stays full.
+        if not self._is_warmed_up:
+            self._is_warmed_up = bool(
+                (self._loss_counts == self.history_per_term).all()
+            )
+        return self._is_warmed_up
+
+
+def _to_numpy(x) -> np.ndarray:
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def _all_gather_losses(ts, losses):
+    """Gathers the timesteps and losses from all of the processes."""
+    if not (
+        torch.distributed.is_available()
+        and torch.distributed.is_initialized()
+        and torch.distributed.get_world_size() > 1
+    ):
+        return ts, losses
+
+    world_size = torch.distributed.get_world_size()
+    losses = torch.as_tensor(losses)
+    ts = torch.as_tensor(ts, device=losses.device).long().reshape(-1)
+    losses = losses.reshape(-1)
+
+    # Processes can have different batch sizes, so pad to the largest.
+    batch_size = torch.tensor([ts.shape[0]], device=losses.device)
+    batch_sizes = [torch.zeros_like(batch_size) for _ in range(world_size)]
+    torch.distributed.all_gather(batch_sizes, batch_size)
+    batch_sizes = [int(b.item()) for b in batch_sizes]
+    max_batch_size = max(batch_sizes)
+
+    padded_ts = torch.zeros((max_batch_size,), dtype=ts.dtype, device=ts.device)
+    padded_ts[: ts.shape[0]] = ts
+    padded_losses = torch.zeros(
+        (max_batch_size,), dtype=losses.dtype, device=losses.device
+    )
+    padded_losses[: losses.shape[0]] = losses
+
+    all_ts = [torch.zeros_like(padded_ts) for _ in range(world_size)]
+    all_losses = [torch.zeros_like(padded_losses) for _ in range(world_size)]
+    torch.distributed.all_gather(all_ts, padded_ts)
+    torch.distributed.all_gather(all_losses, padded_losses)
+
+    ts = torch.cat([t[:b] for t, b in zip(all_ts, batch_sizes)])
+    losses = torch.cat([l[:b] for l, b in zip(all_losses, batch_sizes)])
+    return ts, losses
@@ -14,7 +14,198 @@ from xdiffusion.context import (
     NullContextAdapter,
 )
 from xdiffusion.layers.utils import conv_nd, normalization, zero_module, ContextBlock
-from xdiffusion.utils import instantiate_from_config
+from xdiffusion.utils import DotConfig, instantiate_from_config
+
+# The attention backends supported by dispatch_attention().
+ATTENTION_BACKENDS = (
+    "auto",
+    "sdpa",
+    "sdpa_efficient",
+    "sdpa_math",
+    "chunked",
+    "einsum",
+)
+
+# Above this many query/key pairs (per batch and head), the "auto" backend uses
+# chunked attention when scaled_dot_product_attention is not available.
+_CHUNKED_ATTENTION_THRESHOLD = 4096 * 4096
+
+# The number of times each backend has been used, see attention_backend_usage().
+_ATTENTION_BACKEND_USAGE = {}
+
+
+def attention_backend_usage() -> Dict[str, int]:
+    """Returns the number of attention calls dispatched to each backend."""
+    return dict(_ATTENTION_BACKEND_USAGE)
+
+
+def configure_attention_backend(
+    module: torch.nn.Module, backend: str, chunk_size: Optional[int] = None
+):
+    """Sets the attention backend of all of the attention layers in a module.
+
+    Args:
+        module: The module (e.g. a score network) to configure.
+        backend: One of ATTENTION_BACKENDS.
+        chunk_size: Optional query chunk size for the "chunked" backend.
+    """
+    assert backend in ATTENTION_BACKENDS, f"Unknown attention backend {backend}"
+    for m in module.modules():
+        if hasattr(m, "attention_backend"):
+            m.attention_backend = backend
+            if chunk_size is not None:
+                m.attention_chunk_size = chunk_size
+
+
+def configure_attention_backend_from_config(module: torch.nn.Module, config: DotConfig):
+    """Sets the attention backend of a module from the diffusion config section.
+
+    The backend is read from diffusion.attention_backend (and the optional
+    diffusion.attention_chunk_size). If it is not specified, the attention
+    layers keep their default backend.
+
+    Args:
+        module: The module (e.g. a score network) to configure.
+        config: The configuration file.
+    """
+    if "attention_backend" not in config.diffusion:
+        return
+    configure_attention_backend(
+        module,
+        config.diffusion.attention_backend,
+        chunk_size=(
+            config.diffusion.attention_chunk_size
+            if "attention_chunk_size" in config.diffusion
+            else None
+        ),
+    )
+
+
+def _sdpa_kernel(backend: str):
+    """Restricts scaled_dot_product_attention to the kernels of the backend."""
+    try:
+        from torch.nn.attention import SDPBackend, sdpa_kernel
+    except ImportError:
+        # Older versions of torch only have the (since deprecated) flags.
+        return torch.backends.cuda.sdp_kernel(
+            enable_flash=backend == "sdpa_efficient",
+            enable_mem_efficient=backend == "sdpa_efficient",
+            enable_math=backend == "sdpa_math",
+        )
+
+    return sdpa_kernel(
+        [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+        if backend == "sdpa_efficient"
+        else [SDPBackend.MATH]
+    )
+
+
+def dispatch_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    backend: str = "auto",
+    bias: Optional[torch.Tensor] = None,
+    scale: Optional[float] = None,
+    dropout_p: float = 0.0,
+    chunk_size: int = 1024,
+) -> torch.Tensor:
+    """Computes softmax(q k^T * scale + bias) v with the given backend.
+
+    Backends:
+        sdpa: torch scaled_dot_product_attention, with the kernel chosen by torch.
+        sdpa_efficient: scaled_dot_product_attention, restricted to the memory
+            efficient (and flash) kernels.
+        sdpa_math: scaled_dot_product_attention, restricted to the math kernel.
+        chunked: Attention over chunks of chunk_size queries, so that at most
+            chunk_size x S attention weights exist at once.
+        einsum: The original einsum implementation, which materializes all of
+            the attention weights.
+        auto: sdpa if it is available, otherwise chunked for very long
+            sequences and einsum for everything else.
+
+    Args:
+        q: Tensor batch of queries, of shape (*, T, D).
+        k: Tensor batch of keys, of shape (*, S, D).
+        v: Tensor batch of values, of shape (*, S, Dv).
+        backend: One of ATTENTION_BACKENDS.
+        bias: Optional additive attention bias, broadcastable to (*, T, S).
+        scale: The scale of the attention logits. Defaults to 1/sqrt(D).
+        dropout_p: Dropout probability of the attention weights.
+        chunk_size: The number of queries per chunk, for the chunked backend.
+
+    Returns:
+        Tensor batch of shape (*, T, Dv).
+    """
+    has_sdpa = hasattr(torch.nn.functional, "scaled_dot_product_attention")
+    if backend == "auto":
+        if has_sdpa:
+            backend = "sdpa"
+        elif q.shape[-2] * k.shape[-2] > _CHUNKED_ATTENTION_THRESHOLD:
+            backend = "chunked"
+        else:
+            backend = "einsum"
+    assert backend in ATTENTION_BACKENDS, f"Unknown attention backend {backend}"
+
+    if backend not in _ATTENTION_BACKEND_USAGE:
+        print(f"Using attention backend: {backend}")
+        _ATTENTION_BACKEND_USAGE[backend] = 0
+    _ATTENTION_BACKEND_USAGE[backend] += 1
+
+    if scale is None:
+        scale = q.shape[-1] ** -0.5
+
+    if backend == "chunked":
+        outputs = []
+        for start in range(0, q.shape[-2], chunk_size):
+            end = start + chunk_size
+            bias_chunk = None
+            if bias is not None:
+                bias_chunk = bias[..., start:end, :] if bias.shape[-2] != 1 else bias
+            outputs.append(
+                _attention(
+                    q[..., start:end, :],
+                    k,
+                    v,
+                    bias=bias_chunk,
+                    scale=scale,
+                    dropout_p=dropout_p,
+                    use_sdpa=has_sdpa,
+                )
+            )
+        return torch.cat(outputs, dim=-2)
+    elif backend == "einsum":
+        return _attention(
+            q, k, v, bias=bias, scale=scale, dropout_p=dropout_p, use_sdpa=False
+        )
+    elif backend == "sdpa":
+        return _attention(
+            q, k, v, bias=bias, scale=scale, dropout_p=dropout_p, use_sdpa=True
+        )
+    else:
+        with _sdpa_kernel(backend):
+            return _attention(
+                q, k, v, bias=bias, scale=scale, dropout_p=dropout_p, use_sdpa=True
+            )
+
+
+def _attention(q, k, v, bias, scale, dropout_p, use_sdpa):
+    if use_sdpa:
+        if bias is not None:
+            bias = bias.to(q.dtype)
+        return torch.nn.functional.scaled_dot_product_attention(
+            q, k, v, attn_mask=bias, dropout_p=dropout_p, scale=scale
+        )
+
+    # More stable with f16 than scaling afterwards
+    qk_scale = math.sqrt(scale)
+    weight = torch.einsum("...td,...sd->...ts", q * qk_scale, k * qk_scale)
+    if bias is not None:
+        weight = weight + bias
+    weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+    if dropout_p > 0.0:
+        weight = torch.nn.functional.dropout(weight, p=dropout_p)
+    return torch.einsum("...ts,...sd->...td", weight, v)
 
 
 class SpatialCrossAttention(ContextBlock):
@@ -144,10 +335,18 @@ class SpatialCrossAttention(ContextBlock):
 class QKVAttention(torch.nn.Module):
     """A module which performs QKV attention."""
 
-    def __init__(self, num_heads, disable_self_attention: bool = False):
+    def __init__(
+        self,
+        num_heads,
+        disable_self_attention: bool = False,
+        attention_backend: str = "auto",
+        attention_chunk_size: int = 1024,
+    ):
         super().__init__()
         self.num_heads = num_heads
         self._disable_self_attention = disable_self_attention
+        self.attention_backend = attention_backend
+        self.attention_chunk_size = attention_chunk_size
 
     def forward(self, qkv, encoder_kv=None):
         """Apply QKV attention.
@@ -179,25 +378,38 @@ class QKVAttention(torch.nn.Module):
                 k = torch.cat([ek, k], dim=-1)
                 v = torch.cat([ev, v], dim=-1)
 
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = torch.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = torch.einsum("bts,bcs->bct", weight, v)
-        return a.reshape(bs, -1, length)
+        # (B*H, C, T) -> (B*H, T, C)
+        a = dispatch_attention(
+            q.transpose(1, 2),
+            k.transpose(1, 2),
+            v.transpose(1, 2),
+            backend=self.attention_backend,
+            chunk_size=self.attention_chunk_size,
+        )
+        return a.transpose(1, 2).reshape(bs, -1, length)
 
 
 class LastChannelCrossAttention(torch.nn.Module):
     """Same a SpatialCrossAttention but optimized for (B, *, C) input."""
 
-    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.0):
+    def __init__(
+        self,
+        query_dim,
+        context_dim=None,
+        heads=8,
+        dim_head=64,
+        dropout=0.0,
+        attention_backend: str = "auto",
+        attention_chunk_size: int = 1024,
+    ):
         super().__init__()
         inner_dim = dim_head * heads
         context_dim = context_dim if context_dim is not None else query_dim
 
         self.scale = dim_head**-0.5
         self.heads = heads
+        self.attention_backend = attention_backend
+        self.attention_chunk_size = attention_chunk_size
 
         self.to_q = torch.nn.Linear(query_dim, inner_dim, bias=False)
         self.to_k = torch.nn.Linear(context_dim, inner_dim, bias=False)
@@ -214,15 +426,18 @@ class LastChannelCrossAttention(torch.nn.Module):
         k = self.to_k(context)
         v = self.to_v(context)
 
-        q, k, v = map(lambda t: rearrange(t, "b n (h d) -> (b h) n d", h=h), (q, k, v))
-
-        sim = torch.einsum("b i d, b j d -> b i j", q, k) * self.scale
+        q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b h n d", h=h), (q, k, v))
 
         # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
-
-        out = torch.einsum("b i j, b j d -> b i d", attn, v)
-        out = rearrange(out, "(b h) n d -> b n (h d)", h=h)
+        out = dispatch_attention(
+            q,
+            k,
+            v,
+            backend=self.attention_backend,
+            scale=self.scale,
+            chunk_size=self.attention_chunk_size,
+        )
+        out = rearrange(out, "b h n d -> b n (h d)", h=h)
         out = self.to_out(out)
         out = self.dropout(out)
         return out
@@ -231,8 +446,9 @@ class LastChannelCrossAttention(torch.nn.Module):
 class AttentionPooling(torch.nn.Module):
     """Implements attention pooling from Imagen."""
 
-    def __init__(self, num_heads, embed_dim):
+    def __init__(self, num_heads, embed_dim, attention_backend: str = "auto"):
         super().__init__()
+        self.attention_backend = attention_backend
         self.positional_embedding = torch.nn.Parameter(
             torch.randn(1, embed_dim) / embed_dim**0.5
         )
@@ -267,15 +483,13 @@ class AttentionPooling(torch.nn.Module):
         k = shape(self.k_proj(x))
         v = shape(self.v_proj(x))
 
-        # (bs*n_heads, class_token_length, length+class_token_length):
-        scale = 1 / math.sqrt(math.sqrt(self.dim_per_head))
-        weight = torch.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-
         # (bs*n_heads, dim_per_head, class_token_length)
-        a = torch.einsum("bts,bcs->bct", weight, v)
+        a = dispatch_attention(
+            q.transpose(1, 2),
+            k.transpose(1, 2),
+            v.transpose(1, 2),
+            backend=self.attention_backend,
+        ).transpose(1, 2)
 
         # (bs, length+1, width)
         a = a.reshape(bs, -1, 1).transpose(1, 2)
@@ -332,6 +546,8 @@ class MultiHeadSelfAttention(torch.nn.Module):
         proj_drop: float = 0.0,
         use_fused_attn: bool = False,
         norm_layer: torch.nn.Module = torch.nn.LayerNorm,
+        attention_backend: Optional[str] = None,
+        attention_chunk_size: int = 1024,
     ) -> None:
         super().__init__()
         assert dim % num_heads == 0, "dim should be divisible by num_heads"
@@ -340,6 +556,13 @@ class MultiHeadSelfAttention(torch.nn.Module):
         self.scale = self.head_dim**-0.5
         self.fused_attn = use_fused_attn
 
+        # Without an explicit backend, use_fused_attn selects between
+        # scaled dot product attention and the einsum implementation.
+        if attention_backend is None:
+            attention_backend = "sdpa" if use_fused_attn else "einsum"
+        self.attention_backend = attention_backend
+        self.attention_chunk_size = attention_chunk_size
+
         self.qkv = torch.nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.q_norm = norm_layer(self.head_dim) if qk_norm else torch.nn.Identity()
         self.k_norm = norm_layer(self.head_dim) if qk_norm else torch.nn.Identity()
@@ -357,22 +580,15 @@ class MultiHeadSelfAttention(torch.nn.Module):
         q, k, v = qkv.unbind(0)
         q, k = self.q_norm(q), self.k_norm(k)
 
-        if self.fused_attn:
-            assert hasattr(
-                torch.nn.functional, "scaled_dot_product_attention"
-            ), "Torch version does not have scaled_dot_product_attention. disable fused attention."
-            x = torch.nn.functional.scaled_dot_product_attention(
-                q,
-                k,
-                v,
-                dropout_p=self.attn_drop.p if self.training else 0.0,
-            )
-        else:
-            q = q * self.scale
-            attn = q @ k.transpose(-2, -1)
-            attn = attn.softmax(dim=-1)
-            attn = self.attn_drop(attn)
-            x = attn @ v
+        x = dispatch_attention(
+            q,
+            k,
+            v,
+            backend=self.attention_backend,
+            scale=self.scale,
+            dropout_p=self.attn_drop.p if self.training else 0.0,
+            chunk_size=self.attention_chunk_size,
+        )
 
         x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
@@ -500,10 +716,14 @@ class QKVAttentionWithRelativePosition(torch.nn.Module):
         max_relative_position: int,
         dim_head: int,
         sequence_length: int,
+        attention_backend: str = "auto",
+        attention_chunk_size: int = 1024,
     ):
         super().__init__()
         # Depth is the dimension per head
         self.num_heads = num_heads
+        self.attention_backend = attention_backend
+        self.attention_chunk_size = attention_chunk_size
 
         # Generates embedding for each relative position of dimension depth.
         depth = dim_head
@@ -590,6 +810,8 @@ class QKVAttentionWithRelativePosition(torch.nn.Module):
             key_relative_embeddings=self._k_embeddings_table,
             value_relative_embeddings=self._v_embeddings_table,
             max_relative_position=self._max_relative_position,
+            attention_backend=self.attention_backend,
+            attention_chunk_size=self.attention_chunk_size,
         )
         return a.reshape(B, -1, L)
 
@@ -604,6 +826,8 @@ def dot_product_unmasked_self_attention_relative_v2(
     max_relative_position=None,
     heads_share_relative_embedding=False,
     add_relative_to_values=False,
+    attention_backend: str = "einsum",
+    attention_chunk_size: int = 1024,
 ):
     """Calculate relative position-aware dot-product self-attention.
 
@@ -625,6 +849,9 @@ def dot_product_unmasked_self_attention_relative_v2(
         relative embeddings between attention heads.
       add_relative_to_values: a boolean for whether to add relative component to
         values.
+      attention_backend: The attention backend (see dispatch_attention), used
+        when add_relative_to_values is False.
+      attention_chunk_size: The query chunk size of the chunked backend.
 
     Returns:
       A Tensor.
@@ -643,24 +870,31 @@ def dot_product_unmasked_self_attention_relative_v2(
     assert q.shape == k.shape
     assert q.shape == v.shape
 
-    # [batch, num_heads, query_length, memory_length]
-    logits = torch.matmul(q, k.transpose(-2, -1))
-
-    length = q.shape[2]
-    k_shape = k.shape
-    num_heads = k_shape[1]
-    depth_k = k_shape[-1]
-
     unmasked_rel_logits = matmul_with_relative_keys(
         q, key_relative_embeddings, heads_share_relative_embedding
     )
     unmasked_rel_logits = _relative_position_to_absolute_position_unmasked(
         unmasked_rel_logits
     )
-    logits += unmasked_rel_logits
-
     if bias is not None:
-        logits += bias
+        unmasked_rel_logits += bias
+
+    if not add_relative_to_values:
+        # The relative logits are an additive bias on the (unscaled) logits,
+        # so the attention weights never need to be materialized.
+        return dispatch_attention(
+            q,
+            k,
+            v,
+            backend=attention_backend,
+            bias=unmasked_rel_logits,
+            scale=1.0,
+            chunk_size=attention_chunk_size,
+        )
+
+    # [batch, num_heads, query_length, memory_length]
+    logits = torch.matmul(q, k.transpose(-2, -1))
+    logits += unmasked_rel_logits
     weights = torch.nn.functional.softmax(logits, dim=-1)
 
     ret = torch.matmul(weights, v)
@@ -0,0 +1,262 @@
+"""Timestep-level caching of transformer block outputs.
+
+During sampling, adjacent timesteps produce nearly identical activations in the
+transformer block stacks of the DiT family of score networks. Following TeaCache
+(https://arxiv.org/abs/2411.19108) and FORA (https://arxiv.org/abs/2407.01425),
+the block stack can instead be skipped at some of the sampling steps, adding the
+residual (output - input) of the block stack from the last step it ran to the
+new input.
+
+Whether a step reuses the cached residual is decided by the cache policy:
+
+- modulated_input: (TeaCache) The relative L1 distance between the timestep
+  modulated input of the first block at this step and the previous step,
+  accumulated since the last full evaluation. The block stack is skipped while
+  the accumulated distance is below the threshold.
+- timestep_embedding: The same, using the timestep embedding of the model.
+- interval: (FORA) The block stack runs every `interval` steps.
+
+The cache is only active inside the sampling loop of GaussianDiffusion_DDPM,
+which advances it once per sampling step. The score network can be called
+multiple times per step (e.g. for the conditional and unconditional branches of
+classifier free guidance), so the cache keeps a separate state for each call
+of the step.
+"""
+
+from contextlib import contextmanager
+import torch
+from typing import Callable, Dict, List, Optional
+
+BLOCK_CACHE_POLICIES = ["modulated_input", "timestep_embedding", "interval"]
+
+# The default cache settings of each score network that supports block caching,
+# keyed by class name. These are starting points, the threshold trades off the
+# number of skipped evaluations against the difference to the uncached samples.
+MODEL_CACHE_POLICIES = {
+    "DiT": {"policy": "modulated_input", "threshold": 0.1, "warmup_steps": 1},
+    "PixArtAlpha": {"policy": "modulated_input", "threshold": 0.1, "warmup_steps": 1},
+    "Flux": {"policy": "modulated_input", "threshold": 0.2, "warmup_steps": 1},
+    "SD3Transformer2DModel": {
+        "policy": "modulated_input",
+        "threshold": 0.1,
+        "warmup_steps": 1,
+    },
+    "HYVideoDiffusionTransformer": {
+        "policy": "modulated_input",
+        "threshold": 0.1,
+        "warmup_steps": 2,
+    },
+    "LTXVideoTransformer": {
+        "policy": "modulated_input",
+        "threshold": 0.05,
+        "warmup_steps": 2,
+    },
+}
+
+
+class _CacheState:
+    """The cache state of one score network call of each sampling step."""
+
+    def __init__(self):
+        self.previous_indicator: Optional[torch.Tensor] = None
+        self.accumulated_distance = 0.0
+        self.residual: Optional[torch.Tensor] = None
+        self.num_calls = 0
+
+
+class BlockCache:
+    """Caches the residual of a transformer block stack across sampling steps."""
+
+    def __init__(
+        self,
+        policy: str = "modulated_input",
+        threshold: float = 0.1,
+        interval: int = 2,
+        warmup_steps: int = 1,
+        coefficients: Optional[List[float]] = None,
+    ):
+        """Initializes the cache.
+
+        Args:
+            policy: One of BLOCK_CACHE_POLICIES.
+            threshold: The accumulated relative L1 distance of the indicator
+                below which the cached residual is reused.
+            interval: For the interval policy, the number of steps between
+                full evaluations of the block stack.
+            warmup_steps: The number of initial sampling steps which always run
+                the full block stack.
+            coefficients: Optional polynomial coefficients (highest degree first)
+                which rescale the relative L1 distance of the indicator into
+                an estimate of the output distance, as calibrated in TeaCache.
+        """
+        assert policy in BLOCK_CACHE_POLICIES, f"Unknown block cache policy {policy}"
+        assert interval >= 1
+        self._policy = policy
+        self._threshold = threshold
+        self._interval = interval
+        self._warmup_steps = warmup_steps
+        self._coefficients = coefficients
+
+        self._active = False
+        self._step = -1
+        self._final_step = False
+        self._call_index = 0
+        self._states: Dict[int, _CacheState] = {}
+        self.reset_metrics()
+
+    @contextmanager
+    def sampling(self):
+        """Activates the cache for a single sampling trajectory."""
+        self._states.clear()
+        self._step = -1
+        self._active = True
+        try:
+            yield self
+        finally:
+            self._active = False
+            self._states.clear()
+
+    def next_step(self, final_step: bool = False):
+        """Advances the cache to the next sampling step.
+
+        Args:
+            final_step: True if this is the last step of the trajectory, which
+                always runs the full block stack.
+        """
+        self._step += 1
+        self._final_step = final_step
+        self._call_index = 0
+
+    def metrics(self) -> Dict[str, float]:
+        """Returns the number of cache hits and misses, and the hit rate."""
+        total = self._hits + self._misses
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": self._hits / total if total > 0 else 0.0,
+        }
+
+    def reset_metrics(self):
+        self._hits = 0
+        self._misses = 0
+
+    def __call__(
+        self,
+        hidden_states: torch.Tensor,
+        run_blocks: Callable[[torch.Tensor], torch.Tensor],
+        modulated_input: Optional[Callable[[], torch.Tensor]] = None,
+        timestep_embedding: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Runs the block stack, or reuses its cached residual.
+
+        Args:
+            hidden_states: The input to the block stack.
+            run_blocks: Runs the block stack on hidden_states, returning an
+                output of the same shape.
+            modulated_input: Computes the timestep modulated input of the first
+                block, for the modulated_input policy.
+            timestep_embedding: The timestep embedding of the model, for the
+                timestep_embedding policy.
+
+        Returns:
+            The (possibly approximated) output of the block stack.
+        """
+        if not self._active or torch.is_grad_enabled():
+            return run_blocks(hidden_states)
+
+        state = self._states.setdefault(self._call_index, _CacheState())
+        self._call_index += 1
+
+        if self._policy == "modulated_input":
+            indicator = modulated_input()
+        elif self._policy == "timestep_embedding":
+            indicator = timestep_embedding
+        else:
+            indicator = None
+
+        reuse = (
+            state.residual is not None
+            and state.residual.shape == hidden_states.shape
+            and self._step >= self._warmup_steps
+            and not self._final_step
+        )
+        if reuse and indicator is not None:
+            if state.previous_indicator.shape != indicator.shape:
+                reuse = False
+            else:
+                distance = self._rescale(
+                    (
+                        (indicator - state.previous_indicator).abs().mean()
+                        / state.previous_indicator.abs().mean()
+                    ).item()
+                )
+                state.accumulated_distance += distance
+                reuse = state.accumulated_distance < self._threshold
+        elif reuse:
+            reuse = state.num_calls % self._interval != 0
+        state.previous_indicator = indicator
+        state.num_calls += 1
+
+        if reuse:
+            self._hits += 1
+            return hidden_states + state.residual
+
+        self._misses += 1
+        output = run_blocks(hidden_states)
+        state.residual = output - hidden_states
+        state.accumulated_distance = 0.0
+        return output
+
+    def _rescale(self, distance: float) -> float:
+        if self._coefficients is None:
+            return distance
+        value = 0.0
+        for c in self._coefficients:
+            value = value * distance + c
+        return value
+
+
+def run_cached_blocks(
+    block_cache: Optional[BlockCache],
+    hidden_states: torch.Tensor,
+    run_blocks: Callable[[torch.Tensor], torch.Tensor],
+    modulated_input: Optional[Callable[[], torch.Tensor]] = None,
+    timestep_embedding: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Runs a block stack through the block cache, if there is one."""
+    if block_cache is None:
+        return run_blocks(hidden_states)
+    return block_cache(
+        hidden_states,
+        run_blocks,
+        modulated_input=modulated_input,
+        timestep_embedding=timestep_embedding,
+    )
+
+
+def configure_block_cache(module: torch.nn.Module, **kwargs) -> Optional[BlockCache]:
+    """Enables block caching in all of the supporting score networks of a module.
+
+    Score networks support block caching if they have a block_cache attribute.
+    The cache settings default to the MODEL_CACHE_POLICIES of the first supporting
+    score network, overridden by kwargs.
+
+    Args:
+        module: The module (e.g. a score network) to configure.
+        kwargs: BlockCache arguments.
+
+    Returns:
+        The block cache shared by the score networks, or None if no score
+        network supports block caching.
+    """
+    supported = [m for m in module.modules() if hasattr(m, "block_cache")]
+    if not supported:
+        print(f"{type(module).__name__} does not support block caching.")
+        return None
+
+    params = dict(MODEL_CACHE_POLICIES.get(type(supported[0]).__name__, {}))
+    params.update(kwargs)
+    block_cache = BlockCache(**params)
+    for m in supported:
+        m.block_cache = block_cache
+    return block_cache
@@ -1,4 +1,6 @@
+from collections import OrderedDict
 import numpy as np
+import torch
 
 
 def update_ema(target_params, source_params, rate=0.99):
@@ -6,12 +8,28 @@ def update_ema(target_params, source_params, rate=0.99):
     Update target parameters to be closer to those of source parameters using
     an exponential moving average.
 
+    The update is issued as a single multi-tensor (foreach) lerp per device and
+    dtype, rather than a mul_/add_ pair per tensor.
+
     :param target_params: the target parameter sequence.
     :param source_params: the source parameter sequence.
     :param rate: the EMA rate (closer to 1 means slower).
     """
+    groups = OrderedDict()
     for targ, src in zip(target_params, source_params):
-        targ.detach().mul_(rate).add_(src, alpha=1 - rate)
+        key = (targ.device, targ.dtype)
+        if key not in groups:
+            groups[key] = ([], [])
+        groups[key][0].append(targ.detach())
+        groups[key][1].append(src.detach().to(device=targ.device, dtype=targ.dtype))
+
+    with torch.no_grad():
+        for targets, sources in groups.values():
+            if hasattr(torch, "_foreach_lerp_"):
+                torch._foreach_lerp_(targets, sources, 1 - rate)
+            else:
+                for targ, src in zip(targets, sources):
+                    targ.mul_(rate).add_(src, alpha=1 - rate)
 
 
 def create_ema_and_scales_fn(
@@ -13,6 +13,7 @@ from transformers import (
 )
 from typing import Callable, Dict, List, Optional, Tuple, Union
 
+from xdiffusion.text_embedding_cache import TextEmbeddingCache
 from xdiffusion.utils import freeze, prob_mask_like
 from xdiffusion.layers.attention import AttentionPooling
 from xdiffusion.layers.clip import FrozenCLIPTextEmbedder
@@ -309,17 +310,59 @@ class T5TextPromptsToTokens(torch.nn.Module):
 
 
 class T5TextTokensToEmbedding(torch.nn.Module):
-    def __init__(self, model_name: str):
+    def __init__(
+        self,
+        model_name: str,
+        embedding_cache_size: int = 128,
+        embedding_cache_dir: Optional[str] = None,
+        embedding_cache_offload_to_cpu: bool = False,
+    ):
         super().__init__()
 
+        self._model_name = model_name
         self._text_encoder = freeze(T5EncoderModel.from_pretrained(model_name))
 
+        # The text encoder is frozen, so the embeddings for a tokenized prompt
+        # can be reused across training steps and sampling calls.
+        self._embedding_cache = (
+            TextEmbeddingCache(
+                max_entries=embedding_cache_size,
+                cache_dir=embedding_cache_dir,
+                offload_to_cpu=embedding_cache_offload_to_cpu,
+            )
+            if embedding_cache_size > 0 or embedding_cache_dir is not None
+            else None
+        )
+
     def forward(self, tokens, context: Dict, **kwargs):
         # Tokens come in as a dictionary from the CLIP text encoder
         assert "input_ids" in tokens and "attention_mask" in tokens, f"{tokens}"
         with torch.no_grad():
-            embedding_dict = self._text_encoder(**tokens)
-        return embedding_dict["last_hidden_state"].detach()
+            if self._embedding_cache is None:
+                embedding_dict = self._text_encoder(**tokens)
+                return embedding_dict["last_hidden_state"].detach()
+
+            # The tokens are padded to the max length, so they uniquely
+            # identify the (model name, max length, prompt) of each entry.
+            input_ids = tokens["input_ids"]
+            attention_mask = tokens["attention_mask"]
+            input_ids_cpu = input_ids.cpu()
+            keys = [
+                TextEmbeddingCache.key(self._model_name, input_ids_cpu[i])
+                for i in range(input_ids_cpu.shape[0])
+            ]
+            (embeddings,) = self._embedding_cache.lookup(
+                keys,
+                encode_fn=lambda indices: (
+                    self._text_encoder(
+                        input_ids=input_ids[indices],
+                        attention_mask=attention_mask[indices],
+                    )["last_hidden_state"],
+                ),
+                device=input_ids.device,
+                dtype=self._text_encoder.dtype,
+            )
+        return embeddings.detach()
 
 
 class DiTTimestepEmbedding(torch.nn.Module):
@@ -6,6 +6,7 @@ from einops import rearrange
 from torch import Tensor, nn
 from typing import Optional
 
+from xdiffusion.layers.frequency_cache import cached_frequencies
 from xdiffusion.layers.utils import RMSNorm
 
 
@@ -47,7 +48,31 @@ class EmbedND(nn.Module):
         self.theta = theta
         self.axes_dim = axes_dim
 
-    def forward(self, ids: Tensor) -> Tensor:
+    def forward(self, ids: Tensor, cache_key: Optional[tuple] = None) -> Tensor:
+        """Calculates the rotary embeddings for the position ids.
+
+        Args:
+            ids: Tensor batch of position ids, of shape (B, L, n_axes).
+            cache_key: Optional key that uniquely identifies the ids (for example
+                the token grid shape). If given, the embeddings are looked up in
+                the shared frequency cache.
+
+        Returns:
+            The rotary embeddings of shape (B, 1, L, sum(axes_dim) / 2, 2, 2).
+        """
+        if cache_key is not None:
+            return cached_frequencies(
+                (
+                    "flux",
+                    cache_key,
+                    tuple(self.axes_dim),
+                    self.theta,
+                    ids.dtype,
+                    ids.device,
+                ),
+                lambda: self.forward(ids),
+            )
+
         n_axes = ids.shape[-1]
         emb = torch.cat(
             [rope(ids[..., i], self.axes_dim[i], self.theta) for i in range(n_axes)],
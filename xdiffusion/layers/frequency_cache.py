@@ -0,0 +1,74 @@
+"""Cache of positional (rotary) frequencies.
+
+The rotary frequencies only depend on the token grid and the embedding settings,
+which are identical for every step of the sampling loop, so the score networks
+look them up here instead of recomputing them on every forward pass. The keys
+should include everything the frequencies depend on, typically the grid shape,
+the rotary dimensions, theta, the frequency spacing, and the output dtype and
+device. The cached tensors are shared, so they must not be modified in place.
+"""
+
+from collections import OrderedDict
+import threading
+from typing import Any, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class FrequencyCache:
+    """A bounded, least recently used cache of positional frequencies."""
+
+    def __init__(self, max_size: int = 16):
+        """Initializes the cache.
+
+        Args:
+            max_size: The maximum number of entries, after which the least
+                recently used entry is evicted.
+        """
+        self._max_size = max_size
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, compute_fn: Callable[[], T]) -> T:
+        """Returns the cached value for key, computing it with compute_fn if missing."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        value = compute_fn()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# The cache shared by all of the score networks.
+_FREQUENCY_CACHE = FrequencyCache()
+
+
+def cached_frequencies(key: Hashable, compute_fn: Callable[[], T]) -> T:
+    """Looks up the frequencies for key in the shared cache.
+
+    Args:
+        key: Hashable key, which includes everything the frequencies depend on.
+        compute_fn: Computes the frequencies if they are not cached.
+
+    Returns:
+        The (possibly cached) frequencies.
+    """
+    return _FREQUENCY_CACHE.get(key, compute_fn)
+
+
+def clear_frequency_cache():
+    """Clears the shared frequency cache."""
+    _FREQUENCY_CACHE.clear()
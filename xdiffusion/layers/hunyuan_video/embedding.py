@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn
 from typing import Dict, List
 
+from xdiffusion.layers.frequency_cache import cached_frequencies
 from xdiffusion.layers.hunyuan_video.rope import get_rotary_pos_embed
 from xdiffusion.layers.modulate import modulate
 from xdiffusion.layers.utils import to_2tuple
@@ -226,17 +227,39 @@ class RopeFrequencies(nn.Module):
         device,
         **kwargs,
     ):
-        freqs_cos, freqs_sin = get_rotary_pos_embed(
-            video_length=self.video_length,
-            height=self.video_height,
-            width=self.video_width,
-            patch_size=self.patch_size,
-            rope_theta=self.rope_theta,
-            model_hidden_size=self.model_hidden_size,
-            model_heads_num=self.model_heads_num,
-            rope_dim_list=self.rope_dim_list,
-            vae_spec=self.vae_spec
+        def _compute_frequencies():
+            freqs_cos, freqs_sin = get_rotary_pos_embed(
+                video_length=self.video_length,
+                height=self.video_height,
+                width=self.video_width,
+                patch_size=self.patch_size,
+                rope_theta=self.rope_theta,
+                model_hidden_size=self.model_hidden_size,
+                model_heads_num=self.model_heads_num,
+                rope_dim_list=self.rope_dim_list,
+                vae_spec=self.vae_spec
+            )
+            return freqs_cos.to(device), freqs_sin.to(device)
+
+        # The frequencies are identical for every call, so they are cached
+        # (on the device) across the sampling steps.
+        freqs_cos, freqs_sin = cached_frequencies(
+            (
+                "hunyuan_video",
+                (self.video_length, self.video_height, self.video_width),
+                self.patch_size,
+                self.model_hidden_size // self.model_heads_num,
+                (
+                    tuple(self.rope_dim_list)
+                    if self.rope_dim_list is not None
+                    else None
+                ),
+                self.rope_theta,
+                self.vae_spec,
+                str(torch.device(device)),
+            ),
+            _compute_frequencies,
         )
-        context[self.context_output_key + "_cos"] = freqs_cos.to(device)
-        context[self.context_output_key + "_sin"] = freqs_sin.to(device)
+        context[self.context_output_key + "_cos"] = freqs_cos
+        context[self.context_output_key + "_sin"] = freqs_sin
         return context
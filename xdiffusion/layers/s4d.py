@@ -28,21 +28,32 @@ class S4DKernel(nn.Module):
         self.register("log_A_real", log_A_real, lr)
         self.register("A_imag", A_imag, lr)
 
-    def forward(self, L):
-        """
-        returns: (..., c, L) where c is number of channels (default 1)
-        """
+    def discretize(self):
+        """Discretizes the SSM with zero-order hold.
 
+        returns: (C, dA, dB, dtA), each of shape (H N), such that the
+            recurrence x_k = dA * x_{k-1} + dB * u_k, y_k = 2 * Re(C x_k)
+            matches the convolution kernel.
+        """
         # Materialize parameters
         dt = torch.exp(self.log_dt)  # (H)
         C = torch.view_as_complex(self.C)  # (H N)
         A = -torch.exp(self.log_A_real) + 1j * self.A_imag  # (H N)
 
-        # Vandermonde multiplication
         dtA = A * dt.unsqueeze(-1)  # (H N)
-        K = dtA.unsqueeze(-1) * torch.arange(L, device=A.device)  # (H N L)
-        C = C * (torch.exp(dtA) - 1.0) / A
-        K = 2 * torch.einsum("hn, hnl -> hl", C, torch.exp(K)).real
+        dA = torch.exp(dtA)
+        dB = (dA - 1.0) / A
+        return C, dA, dB, dtA
+
+    def forward(self, L):
+        """
+        returns: (..., c, L) where c is number of channels (default 1)
+        """
+        C, _, dB, dtA = self.discretize()
+
+        # Vandermonde multiplication
+        K = dtA.unsqueeze(-1) * torch.arange(L, device=dtA.device)  # (H N L)
+        K = 2 * torch.einsum("hn, hnl -> hl", C * dB, torch.exp(K)).real
 
         return K
 
@@ -75,6 +86,9 @@ class S4D(nn.Module):
         # SSM Kernel
         self.kernel = S4DKernel(self.h, N=self.n, **kernel_args)
 
+        # Cache of the kernel (and recurrence) for frozen parameters.
+        self._cache = {}
+
         # Pointwise
         self.activation = nn.GELU()
         # dropout_fn = nn.Dropout2d # NOTE: bugged in PyTorch 1.11
@@ -87,27 +101,158 @@ class S4D(nn.Module):
             nn.GLU(dim=-2),
         )
 
-    def forward(self, u, **kwargs):  # absorbs return_output and transformer src mask
-        """Input and output shape (B, H, L)"""
+    @property
+    def d_state(self):
+        return self.h * self.n // 2
+
+    @property
+    def state_to_tensor(self):
+        return lambda state: torch.view_as_real(state).flatten(start_dim=-3)
+
+    def default_state(self, *batch_shape, device=None):
+        """Returns the zero state, of shape (*batch_shape, H, N // 2)."""
+        return torch.zeros(
+            *batch_shape, self.h, self.n // 2, dtype=torch.cfloat, device=device
+        )
+
+    def _cached(self, key, fn):
+        """Caches fn() under key, until the SSM parameters change.
+
+        The kernel only depends on the SSM parameters, so it is identical for
+        every call with frozen weights (e.g. during sampling). Only cache when
+        no gradients are required, since training needs the autograd graph.
+        """
+        parameters = list(self.kernel.parameters()) + list(self.kernel.buffers())
+        if torch.is_grad_enabled() and any(p.requires_grad for p in parameters):
+            return fn()
+
+        # In-place updates (optimizer steps, load_state_dict) bump the tensor
+        # versions, which invalidates the cached values.
+        versions = tuple((p.data_ptr(), p._version) for p in parameters)
+        cached = self._cache.get(key, None)
+        if cached is None or cached[0] != versions:
+            cached = (versions, fn())
+            self._cache[key] = cached
+        return cached[1]
+
+    def _kernel_fft(self, L, device):
+        return self._cached(
+            ("fft", L, self.D.dtype, device),
+            lambda: torch.fft.rfft(self.kernel(L=L), n=2 * L),
+        )
+
+    def _output(self, y, u):
+        # Compute D term in state space equation - essentially a skip connection
+        y = y + u * self.D.unsqueeze(-1)
+
+        y = self.dropout(self.activation(y))
+        return self.output_linear(y)
+
+    def forward(self, u, state=None, **kwargs):
+        """Input and output shape (B, H, L)
+
+        If a state is given, the sequence is processed with scan() starting from
+        that state, and the next state is returned. Otherwise the state is None.
+        """
+        if state is not None:
+            return self.scan(u, state=state)
+
         if not self.transposed:
             u = u.transpose(-1, -2)
         L = u.size(-1)
-        # Compute SSM Kernel
-        k = self.kernel(L=L)  # (H L)
 
-        # Convolution
-        k_f = torch.fft.rfft(k, n=2 * L)  # (H L)
+        # Convolution with the (cached) SSM kernel
+        k_f = self._kernel_fft(L=L, device=u.device)  # (H L)
         u_f = torch.fft.rfft(u, n=2 * L)  # (B H L)
         y = torch.fft.irfft(u_f * k_f, n=2 * L)[..., :L]  # (B H L)
 
-        # Compute D term in state space equation - essentially a skip connection
-        y = y + u * self.D.unsqueeze(-1)
-
-        y = self.dropout(self.activation(y))
-        y = self.output_linear(y)
+        y = self._output(y, u)
         if not self.transposed:
             y = y.transpose(-1, -2)
         return (
             y,
             None,
         )  # Return a dummy state to satisfy this repo's interface, but this can be modified
+
+    def _scan_weights(self, T, device):
+        def _weights():
+            C, dA, dB, dtA = self.kernel.discretize()
+            t = torch.arange(T, device=dtA.device)
+
+            # Causal convolution within the chunk, as a Toeplitz matrix.
+            k = self.kernel(L=T)  # (H T)
+            idx = t.unsqueeze(-1) - t.unsqueeze(0)  # (T T)
+            toeplitz = k[:, idx.clamp(min=0)] * (idx >= 0)  # (H T T)
+
+            # Contribution of the incoming state to each output.
+            state_out = C.unsqueeze(-1) * torch.exp(
+                dtA.unsqueeze(-1) * (t + 1)
+            )  # (H N T)
+
+            # Contribution of each input to the outgoing state.
+            state_in = dB.unsqueeze(-1) * torch.exp(
+                dtA.unsqueeze(-1) * (T - 1 - t)
+            )  # (H N T)
+            return toeplitz, state_out, state_in, torch.exp(dtA * T)
+
+        return self._cached(("scan", T, self.D.dtype, device), _weights)
+
+    def scan(self, u, state=None, chunk_size=64):
+        """Processes the sequence in chunks, carrying the SSM state between them.
+
+        Each chunk is a dense causal convolution plus the contribution of the
+        incoming state, so the cost is linear in the sequence length.
+
+        Args:
+            u: Input of shape (B, H, L), or (B, L, H) if not transposed.
+            state: The incoming state, of shape (B, H, N // 2), or None for zeros.
+            chunk_size: The number of steps per chunk.
+
+        Returns:
+            Tuple of the output (same shape as the input) and the next state.
+        """
+        if not self.transposed:
+            u = u.transpose(-1, -2)
+        B, H, L = u.shape
+        if state is None:
+            state = self.default_state(B, device=u.device)
+
+        ys = []
+        for start in range(0, L, chunk_size):
+            u_chunk = u[..., start : start + chunk_size]
+            toeplitz, state_out, state_in, dA_T = self._scan_weights(
+                T=u_chunk.shape[-1], device=u.device
+            )
+            y = torch.einsum("bht, hst -> bhs", u_chunk, toeplitz)
+            y = y + 2 * torch.einsum("bhn, hnt -> bht", state, state_out).real
+            state = dA_T * state + torch.einsum(
+                "bht, hnt -> bhn", u_chunk.to(state_in.dtype), state_in
+            )
+            ys.append(y)
+        y = self._output(torch.cat(ys, dim=-1), u)
+
+        if not self.transposed:
+            y = y.transpose(-1, -2)
+        return y, state
+
+    def step(self, u, state, **kwargs):
+        """Recurrent mode, processing a single step of the sequence.
+
+        Args:
+            u: Input of shape (B, H).
+            state: The previous state, of shape (B, H, N // 2), or None for zeros.
+
+        Returns:
+            Tuple of the output of shape (B, H), and the next state.
+        """
+        if state is None:
+            state = self.default_state(u.shape[0], device=u.device)
+
+        C, dA, dB = self._cached(
+            ("step", self.D.dtype, u.device), lambda: self.kernel.discretize()[:3]
+        )
+        state = dA * state + dB * u.unsqueeze(-1)
+        y = 2 * torch.einsum("hn, bhn -> bh", C, state).real
+
+        y = self._output(y.unsqueeze(-1), u.unsqueeze(-1)).squeeze(-1)
+        return y, state
@@ -12,6 +12,40 @@ UNET_DEFAULT_TARGET_REPLACE = {
 DEFAULT_TARGET_REPLACE = UNET_DEFAULT_TARGET_REPLACE
 
 
+def _lora_weight_delta(lora_module: torch.nn.Module) -> torch.Tensor:
+    """Calculates scale * up @ selector @ down, in the shape of the base weight."""
+    if lora_module.lora_down.weight.dim() > 2 and lora_module.lora_down.groups != 1:
+        raise ValueError("Grouped convolution LoRAs cannot be merged.")
+
+    r = lora_module.r
+    up = lora_module.lora_up.weight.float().reshape(-1, r)
+    if not isinstance(lora_module.selector, torch.nn.Identity):
+        up = up @ lora_module.selector.weight.float().reshape(r, r)
+    down = lora_module.lora_down.weight.float()
+    delta = (up @ down.reshape(r, -1)).reshape((up.shape[0],) + down.shape[1:])
+    return delta * lora_module.scale
+
+
+@torch.no_grad()
+def _merge_lora(lora_module: torch.nn.Module, base: torch.nn.Module):
+    if lora_module.merged:
+        return
+
+    # Keep a copy of the original weight so that unmerging is exact. This
+    # lives on the CPU, so merging does not increase the accelerator memory.
+    lora_module._unmerged_weight = base.weight.detach().to("cpu", copy=True)
+    delta = _lora_weight_delta(lora_module)
+    base.weight.copy_((base.weight.float() + delta).to(base.weight.dtype))
+
+
+@torch.no_grad()
+def _unmerge_lora(lora_module: torch.nn.Module, base: torch.nn.Module):
+    if not lora_module.merged:
+        return
+    base.weight.copy_(lora_module._unmerged_weight)
+    lora_module._unmerged_weight = None
+
+
 class LoraInjectedLinear(torch.nn.Module):
     def __init__(
         self, in_features, out_features, bias=False, r=4, dropout_p=0.1, scale=1.0
@@ -30,10 +64,27 @@ class LoraInjectedLinear(torch.nn.Module):
         self.scale = scale
         self.selector = torch.nn.Identity()
 
+        # The original base weight, while the LoRA is merged into it.
+        self._unmerged_weight = None
+
         torch.nn.init.normal_(self.lora_down.weight, std=1 / r)
         torch.nn.init.zeros_(self.lora_up.weight)
 
+    @property
+    def merged(self) -> bool:
+        return self._unmerged_weight is not None
+
+    def merge(self):
+        """Folds the LoRA into the base weight, so forward is a single linear."""
+        _merge_lora(self, self.linear)
+
+    def unmerge(self):
+        """Restores the original base weight."""
+        _unmerge_lora(self, self.linear)
+
     def forward(self, input):
+        if self.merged:
+            return self.linear(input)
         return (
             self.linear(input)
             + self.dropout(self.lora_up(self.selector(self.lora_down(input))))
@@ -107,10 +158,27 @@ class LoraInjectedConv2d(torch.nn.Module):
         self.selector = torch.nn.Identity()
         self.scale = scale
 
+        # The original base weight, while the LoRA is merged into it.
+        self._unmerged_weight = None
+
         torch.nn.init.normal_(self.lora_down.weight, std=1 / r)
         torch.nn.init.zeros_(self.lora_up.weight)
 
+    @property
+    def merged(self) -> bool:
+        return self._unmerged_weight is not None
+
+    def merge(self):
+        """Folds the LoRA into the base weight, so forward is a single conv."""
+        _merge_lora(self, self.conv)
+
+    def unmerge(self):
+        """Restores the original base weight."""
+        _unmerge_lora(self, self.conv)
+
     def forward(self, input):
+        if self.merged:
+            return self.conv(input)
         return (
             self.conv(input)
             + self.dropout(self.lora_up(self.selector(self.lora_down(input))))
@@ -193,10 +261,27 @@ class LoraInjectedConv1d(torch.nn.Module):
         self.selector = torch.nn.Identity()
         self.scale = scale
 
+        # The original base weight, while the LoRA is merged into it.
+        self._unmerged_weight = None
+
         torch.nn.init.normal_(self.lora_down.weight, std=1 / r)
         torch.nn.init.zeros_(self.lora_up.weight)
 
+    @property
+    def merged(self) -> bool:
+        return self._unmerged_weight is not None
+
+    def merge(self):
+        """Folds the LoRA into the base weight, so forward is a single conv."""
+        _merge_lora(self, self.conv)
+
+    def unmerge(self):
+        """Restores the original base weight."""
+        _unmerge_lora(self, self.conv)
+
     def forward(self, input):
+        if self.merged:
+            return self.conv(input)
         return (
             self.conv(input)
             + self.dropout(self.lora_up(self.selector(self.lora_down(input))))
@@ -341,6 +426,86 @@ def load_lora_weights(model: torch.nn.Module, lora_path: str):
     _, _ = inject_trainable_lora(model, loras=lora_path)
 
 
+def _injected_loras(model, target_replace_module=DEFAULT_TARGET_REPLACE):
+    return [
+        _child_module
+        for _m, _n, _child_module in _find_modules(
+            model,
+            target_replace_module,
+            search_class=[LoraInjectedLinear, LoraInjectedConv1d, LoraInjectedConv2d],
+        )
+    ]
+
+
+def merge_loras(model, target_replace_module=DEFAULT_TARGET_REPLACE):
+    """Folds the injected LoRAs into the base weights, for inference.
+
+    Once merged, the injected layers run at the speed of the base layers. The
+    original base weights are kept, so unmerge_loras restores them exactly.
+    Changes to the LoRA weights or scale only take effect after unmerging.
+    """
+    for lora_module in _injected_loras(model, target_replace_module):
+        lora_module.merge()
+
+
+def unmerge_loras(model, target_replace_module=DEFAULT_TARGET_REPLACE):
+    """Restores the original base weights of merged LoRAs."""
+    for lora_module in _injected_loras(model, target_replace_module):
+        lora_module.unmerge()
+
+
+def set_lora_weights(
+    model: torch.nn.Module,
+    loras: Union[str, List[torch.Tensor]],
+    target_replace_module=DEFAULT_TARGET_REPLACE,
+):
+    """Copies saved LoRA weights into the already injected LoRA layers.
+
+    Args:
+        model: The model with injected LoRAs (of the same rank as the saved ones).
+        loras: The path to a file saved by save_lora_weights, or its contents.
+        target_replace_module: The modules the LoRAs were injected into.
+    """
+    if isinstance(loras, str):
+        loras = torch.load(loras, map_location="cpu")
+
+    injected = _injected_loras(model, target_replace_module)
+    if len(loras) != 2 * len(injected):
+        raise ValueError(
+            f"Expected {2 * len(injected)} LoRA weights, found {len(loras)}."
+        )
+
+    with torch.no_grad():
+        for idx, lora_module in enumerate(injected):
+            lora_module.lora_up.weight.copy_(loras[2 * idx])
+            lora_module.lora_down.weight.copy_(loras[2 * idx + 1])
+
+
+def swap_loras(
+    model: torch.nn.Module,
+    loras: Union[str, List[torch.Tensor]],
+    merge: bool = True,
+    target_replace_module=DEFAULT_TARGET_REPLACE,
+):
+    """Switches the model to a different set of LoRA weights.
+
+    The base weights are restored and the new LoRA weights are copied into
+    the injected layers, so switching does not reload the base checkpoint.
+    To switch between several LoRAs repeatedly, load each of them once with
+    torch.load and pass the loaded weights.
+
+    Args:
+        model: The model with injected LoRAs.
+        loras: The path to a file saved by save_lora_weights, or its contents.
+        merge: If True, merge the new LoRAs into the base weights.
+        target_replace_module: The modules the LoRAs were injected into.
+    """
+    unmerge_loras(model, target_replace_module)
+    set_lora_weights(model, loras, target_replace_module)
+    if merge:
+        merge_loras(model, target_replace_module)
+
+
 def disable_loras(model, target_replace_module=DEFAULT_TARGET_REPLACE):
     for _m, _n, _child_module in _find_modules(
         model,
@@ -1,6 +1,5 @@
 from abc import abstractmethod
 import math
-import random
 import torch
 from typing import Optional
 
@@ -79,72 +78,83 @@ class OpenSoraMaskGenerator(MaskGenerator):
         print(f"Training with mask ratios: {mask_ratios}")
         self.mask_ratios = mask_ratios
 
-    def get_masks(self, x):
-        masks = []
-        for _ in range(len(x)):
-            mask = self._get_mask(x)
-            masks.append(mask)
-        masks = torch.stack(masks, dim=0)
-        return masks
+    def get_masks(
+        self, x: torch.Tensor, config: Optional[DotConfig] = None
+    ) -> torch.Tensor:
+        """Samples a temporal mask for each element of the batch.
 
-    def _get_mask(self, x):
-        B, C, T, H, W = x.shape
+        The mask type of each element is sampled according to the mask ratios,
+        and all of the masks are generated together on the device of x.
 
-        mask_type = random.random()
-        mask_name = None
-        prob_acc = 0.0
-        for mask, mask_ratio in self.mask_ratios.items():
-            prob_acc += mask_ratio
-            if mask_type < prob_acc:
-                mask_name = mask
-                break
+        Args:
+            x: Tensor batch of videos, of shape (B, C, T, H, W).
+            config: Unused, for compatibility with the other mask generators.
 
-        num_frames = T
+        Returns:
+            Boolean tensor of shape (B, T), where False indicates a masked frame.
+        """
+        B, C, T, H, W = x.shape
+        device = x.device
+
+        # The temporal mask will be shape (B, T). Default is use all frames.
+        masks = torch.ones((B, T), dtype=torch.bool, device=device)
+        if T <= 1:
+            return masks
+
+        # Choose the mask type of each element. Elements which fall past the
+        # cumulative ratios (due to rounding) use all frames.
+        mask_names = list(self.mask_ratios.keys())
+        cumulative_ratios = torch.tensor(
+            list(self.mask_ratios.values()), dtype=torch.float64
+        ).cumsum(dim=0)
+        mask_types = torch.searchsorted(
+            cumulative_ratios, torch.rand(B, dtype=torch.float64), right=True
+        ).to(device)
+
+        def _is_type(*names):
+            selected = torch.zeros(B, dtype=torch.bool, device=device)
+            for name in names:
+                if name in mask_names:
+                    selected |= mask_types == mask_names.index(name)
+            return selected[:, None]
 
         # Hardcoded condition_frames
-        condition_frames_max = num_frames // 4
-
-        # The temporal mask will be shape (T,). Default is use all frames.
-        mask = torch.ones(num_frames, dtype=torch.bool, device=x.device)
-        if num_frames <= 1:
-            return mask
-
-        if mask_name == "quarter_random":
-            random_size = random.randint(1, condition_frames_max)
-            random_pos = random.randint(0, x.shape[2] - random_size)
-            mask[random_pos : random_pos + random_size] = 0
-        elif mask_name == "image_random":
-            random_size = 1
-            random_pos = random.randint(0, x.shape[2] - random_size)
-            mask[random_pos : random_pos + random_size] = 0
-        elif mask_name == "quarter_head":
-            random_size = random.randint(1, condition_frames_max)
-            mask[:random_size] = 0
-        elif mask_name == "image_head":
-            random_size = 1
-            mask[:random_size] = 0
-        elif mask_name == "quarter_tail":
-            random_size = random.randint(1, condition_frames_max)
-            mask[-random_size:] = 0
-        elif mask_name == "image_tail":
-            random_size = 1
-            mask[-random_size:] = 0
-        elif mask_name == "quarter_head_tail":
-            random_size = random.randint(1, condition_frames_max)
-            mask[:random_size] = 0
-            mask[-random_size:] = 0
-        elif mask_name == "image_head_tail":
-            random_size = 1
-            mask[:random_size] = 0
-            mask[-random_size:] = 0
-        elif mask_name == "interpolate":
-            random_start = random.randint(0, 1)
-            mask[random_start::2] = 0
-        elif mask_name == "random":
-            mask_ratio = random.uniform(0.1, 0.9)
-            mask = torch.rand(num_frames, device=x.device) > mask_ratio
-            # if mask is all False, set the last frame to True
-            if not mask.any():
-                mask[-1] = 1
-
-        return mask
+        condition_frames_max = max(T // 4, 1)
+        frames = torch.arange(T, device=device)[None, :]
+
+        # The number of masked frames, for the quarter and image masks.
+        is_quarter = _is_type(
+            "quarter_random", "quarter_head", "quarter_tail", "quarter_head_tail"
+        )
+        sizes = torch.where(
+            is_quarter,
+            torch.randint(1, condition_frames_max + 1, (B, 1), device=device),
+            1,
+        )
+
+        # Mask a block of frames at a random position, the head and/or the tail.
+        positions = (torch.rand((B, 1), device=device) * (T - sizes + 1)).long()
+        is_random = _is_type("quarter_random", "image_random")
+        is_head = _is_type(
+            "quarter_head", "image_head", "quarter_head_tail", "image_head_tail"
+        )
+        is_tail = _is_type(
+            "quarter_tail", "image_tail", "quarter_head_tail", "image_head_tail"
+        )
+        masked = (
+            (is_random & (frames >= positions) & (frames < positions + sizes))
+            | (is_head & (frames < sizes))
+            | (is_tail & (frames >= T - sizes))
+        )
+
+        # Mask every other frame, starting from the first or second frame.
+        interpolate_start = torch.randint(0, 2, (B, 1), device=device)
+        masked |= _is_type("interpolate") & ((frames % 2) == interpolate_start)
+
+        # Mask a random subset of frames, keeping at least the last frame.
+        mask_ratio = 0.1 + 0.8 * torch.rand((B, 1), device=device)
+        random_frames = torch.rand((B, T), device=device) > mask_ratio
+        random_frames[:, -1] |= ~random_frames.any(dim=1)
+        masked |= _is_type("random") & ~random_frames
+
+        return masks & ~masked
@@ -5,18 +5,31 @@ from typing import Dict, List, Optional, Tuple
 
 from xdiffusion.diffusion import PredictionType, DiffusionModel
 from xdiffusion.samplers.base import ReverseProcessSampler
-from xdiffusion.utils import dynamic_thresholding, broadcast_from_left
+from xdiffusion.utils import (
+    broadcast_from_left,
+    chunk_model_output,
+    concatenate_contexts,
+    dynamic_thresholding,
+)
 
 
 class AncestralSampler(ReverseProcessSampler):
     def __init__(
-        self, reconstruction_guidance: bool = False, omega: float = 2.0, **kwargs
+        self,
+        reconstruction_guidance: bool = False,
+        omega: float = 2.0,
+        batched_guidance: bool = False,
+        **kwargs,
     ):
         super().__init__()
 
         self._reconstruction_guidance = reconstruction_guidance
         self._reconstruction_omega = omega
 
+        # If True, classifier free guidance runs the conditional and unconditional
+        # branches through the score network as a single batch of size 2B.
+        self._batched_guidance = batched_guidance
+
     @torch.no_grad()
     def p_sample(
         self,
@@ -201,13 +214,6 @@ class AncestralSampler(ReverseProcessSampler):
         epsilon_v_param: Optional[List[torch.Tensor]] = None,
         classifier_free_guidance: Optional[float] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        epsilon_theta, variance, log_variance = self._pred_epsilon(
-            x=z_t,
-            context=context,
-            diffusion_model=diffusion_model,
-            epsilon_v_param=epsilon_v_param,
-        )
-
         # If we are using classifier free guidance, then calculate the unconditional
         # epsilon as well.
         cfg = (
@@ -215,14 +221,36 @@ class AncestralSampler(ReverseProcessSampler):
             if classifier_free_guidance is not None
             else diffusion_model.classifier_free_guidance()
         )
+        use_guidance = cfg >= 0.0 and unconditional_context is not None
+
+        if use_guidance and self._batched_guidance and epsilon_v_param is None:
+            # Run the conditional and unconditional branches as a single
+            # batch through the score network.
+            model_output, uncond_model_output = self._predict_score_batched(
+                x=z_t,
+                context=context,
+                unconditional_context=unconditional_context,
+                diffusion_model=diffusion_model,
+            )
+        else:
+            model_output = epsilon_v_param
+            uncond_model_output = epsilon_v_param
 
-        if cfg >= 0.0 and unconditional_context is not None:
+        epsilon_theta, variance, log_variance = self._pred_epsilon(
+            x=z_t,
+            context=context,
+            diffusion_model=diffusion_model,
+            epsilon_v_param=model_output,
+        )
+
+        if use_guidance:
             # Unconditionally sample the model
             uncond_epsilon_theta, uncond_variance, uncond_log_variance = (
                 self._pred_epsilon(
                     x=z_t,
                     context=unconditional_context,
-                    epsilon_v_param=epsilon_v_param,
+                    diffusion_model=diffusion_model,
+                    epsilon_v_param=uncond_model_output,
                 )
             )
             w = cfg
@@ -323,6 +351,32 @@ class AncestralSampler(ReverseProcessSampler):
             )
         return epsilon_theta, variance, log_variance
 
+    def _predict_score_batched(
+        self,
+        x,
+        context: Dict,
+        unconditional_context: Dict,
+        diffusion_model: DiffusionModel,
+    ):
+        """Predicts the conditional and unconditional score in a single batch.
+
+        Args:
+            x: The input images (or other data) at time t
+            context: The conditional context
+            unconditional_context: The unconditional context
+            diffusion_model: The diffusion model to sample from
+
+        Returns:
+            Tuple of the conditional and unconditional score network outputs.
+        """
+        B = x.shape[0]
+        batched_context = concatenate_contexts([context, unconditional_context], B)
+        batched_x = diffusion_model.process_input(
+            x=torch.cat([x, x], dim=0), context=batched_context
+        )
+        model_output = diffusion_model.predict_score(batched_x, context=batched_context)
+        return chunk_model_output(model_output, chunks=2)
+
     def _guidance_mean(self, guidance_fn, p_mean, p_var, x, t, y):
         """Classifier guidance for the mean estimate.
 
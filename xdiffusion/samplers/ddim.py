@@ -1,17 +1,26 @@
 """DDIM sampling, from DDPM."""
 
 import torch
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 from xdiffusion.diffusion import PredictionType, DiffusionModel
 from xdiffusion.samplers.base import ReverseProcessSampler
-from xdiffusion.utils import broadcast_from_left, dynamic_thresholding
+from xdiffusion.utils import (
+    broadcast_from_left,
+    chunk_model_output,
+    concatenate_contexts,
+    dynamic_thresholding,
+)
 
 
 class DDIMSampler(ReverseProcessSampler):
-    def __init__(self, **kwargs):
+    def __init__(self, batched_guidance: bool = False, **kwargs):
         super().__init__()
 
+        # If True, classifier free guidance runs the conditional and unconditional
+        # branches through the score network as a single batch of size 2B.
+        self._batched_guidance = batched_guidance
+
     @torch.no_grad()
     def p_sample(
         self,
@@ -39,16 +48,53 @@ class DDIMSampler(ReverseProcessSampler):
         Returns:
             Tensor batch of the distribution at timestep t-1.
         """
-        shape, dtype = x.shape, x.dtype
-        logsnr_t = context["logsnr_t"]
         logsnr_s = context["logsnr_s"]
-
-        epsilon_theta, variance, log_variance = self._pred_epsilon(
+        x_pred_t, eps_pred_t = self._predict_xstart_and_epsilon(
             x=x,
             context=context,
+            unconditional_context=unconditional_context,
             diffusion_model=diffusion_model,
+            classifier_free_guidance=classifier_free_guidance,
+            clip_denoised=clip_denoised,
+        )
+
+        stdv_s = broadcast_from_left(
+            torch.sqrt(torch.nn.functional.sigmoid(-logsnr_s)), eps_pred_t.shape
+        )
+        alpha_s = broadcast_from_left(
+            torch.sqrt(torch.nn.functional.sigmoid(logsnr_s)), x_pred_t.shape
         )
+        z_s_pred = alpha_s * x_pred_t + stdv_s * eps_pred_t
+
+        timestep_idx = context["timestep_idx"]
+        return torch.where(torch.tensor(timestep_idx == 0), x_pred_t, z_s_pred)
 
+    def _predict_xstart_and_epsilon(
+        self,
+        x: torch.Tensor,
+        context: Dict,
+        unconditional_context: Optional[Dict],
+        diffusion_model: DiffusionModel,
+        classifier_free_guidance: Optional[float] = None,
+        clip_denoised: bool = True,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Predicts the (guided) starting point and noise from the inputs.
+
+        Args:
+            x: Tensor batch of the distribution at time t.
+            context: The conditional context at time t.
+            unconditional_context: The unconditional context at time t, for
+                classifier free guidance.
+            diffusion_model: The diffusion model to sample from.
+            classifier_free_guidance: Classifier free guidance value
+            clip_denoised: True to clip (or dynamically threshold) the predicted
+                starting point.
+
+        Returns:
+            Tuple of:
+                pred_xstart: Tensor batch of the predicted x_0
+                pred_epsilon: Tensor batch of the predicted noise
+        """
         # If we are using classifier free guidance, then calculate the unconditional
         # epsilon as well.
         cfg = (
@@ -56,13 +102,36 @@ class DDIMSampler(ReverseProcessSampler):
             if classifier_free_guidance is not None
             else diffusion_model.classifier_free_guidance()
         )
+        use_guidance = cfg >= 0.0 and unconditional_context is not None
+
+        if use_guidance and self._batched_guidance:
+            # Run the conditional and unconditional branches as a single
+            # batch through the score network.
+            model_output, uncond_model_output = self._predict_score_batched(
+                x=x,
+                context=context,
+                unconditional_context=unconditional_context,
+                diffusion_model=diffusion_model,
+            )
+        else:
+            model_output = None
+            uncond_model_output = None
+
+        epsilon_theta, variance, log_variance = self._pred_epsilon(
+            x=x,
+            context=context,
+            diffusion_model=diffusion_model,
+            epsilon_v_param=model_output,
+        )
 
-        if cfg >= 0.0 and unconditional_context is not None:
+        if use_guidance:
             # Unconditionally sample the model
             uncond_epsilon_theta, uncond_variance, uncond_log_variance = (
                 self._pred_epsilon(
                     x=x,
                     context=unconditional_context,
+                    diffusion_model=diffusion_model,
+                    epsilon_v_param=uncond_model_output,
                 )
             )
             w = cfg
@@ -108,19 +177,7 @@ class DDIMSampler(ReverseProcessSampler):
                 )
         else:
             pred_xstart = _maybe_clip(pred_xstart)
-
-        x_pred_t = pred_xstart
-        eps_pred_t = pred_epsilon
-        stdv_s = broadcast_from_left(
-            torch.sqrt(torch.nn.functional.sigmoid(-logsnr_s)), eps_pred_t.shape
-        )
-        alpha_s = broadcast_from_left(
-            torch.sqrt(torch.nn.functional.sigmoid(logsnr_s)), x_pred_t.shape
-        )
-        z_s_pred = alpha_s * x_pred_t + stdv_s * eps_pred_t
-
-        timestep_idx = context["timestep_idx"]
-        return torch.where(torch.tensor(timestep_idx == 0), x_pred_t, z_s_pred)
+        return pred_xstart, pred_epsilon
 
     def _pred_epsilon(
         self,
@@ -173,3 +230,29 @@ class DDIMSampler(ReverseProcessSampler):
                 diffusion_model.noise_scheduler().variance_fixed_large(context, x.shape)
             )
         return epsilon_theta, variance, log_variance
+
+    def _predict_score_batched(
+        self,
+        x,
+        context: Dict,
+        unconditional_context: Dict,
+        diffusion_model: DiffusionModel,
+    ):
+        """Predicts the conditional and unconditional score in a single batch.
+
+        Args:
+            x: The input images (or other data) at time t
+            context: The conditional context
+            unconditional_context: The unconditional context
+            diffusion_model: The diffusion model to sample from
+
+        Returns:
+            Tuple of the conditional and unconditional score network outputs.
+        """
+        B = x.shape[0]
+        batched_context = concatenate_contexts([context, unconditional_context], B)
+        batched_x = diffusion_model.process_input(
+            x=torch.cat([x, x], dim=0), context=batched_context
+        )
+        model_output = diffusion_model.predict_score(batched_x, context=batched_context)
+        return chunk_model_output(model_output, chunks=2)
@@ -6,6 +6,35 @@ from typing import Dict, Optional
 from xdiffusion.samplers.base import ReverseProcessSampler
 from xdiffusion.diffusion import DiffusionModel
 
+PRECISION_TO_TYPE = {
+    "fp64": torch.float64,
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+
+def _denoise(
+    score_network: torch.nn.Module,
+    x: torch.Tensor,
+    sigma: torch.Tensor,
+    class_labels: Optional[torch.Tensor],
+    state_dtype: torch.dtype,
+    network_dtype: torch.dtype,
+) -> torch.Tensor:
+    """Evaluates the denoiser under the network precision of the sampler.
+
+    The ODE state is kept in state_dtype, while the network is evaluated
+    in float32, or under autocast if a reduced network precision is requested.
+    """
+    with torch.autocast(
+        device_type=x.device.type,
+        dtype=network_dtype,
+        enabled=network_dtype != torch.float32,
+    ):
+        denoised = score_network(x, sigma, class_labels)
+    return denoised.to(state_dtype)
+
 
 class StochasticSampler(ReverseProcessSampler):
     """EDM sampler (Algoritm 2 from the paper)."""
@@ -20,6 +49,8 @@ class StochasticSampler(ReverseProcessSampler):
         S_min: float = 0,
         S_max: float = float("inf"),
         S_noise: float = 1,
+        precision: str = "fp64",
+        network_precision: str = "fp32",
     ):
         super().__init__()
 
@@ -32,6 +63,18 @@ class StochasticSampler(ReverseProcessSampler):
         self._S_max = S_max
         self._S_noise = S_noise
 
+        # Precision policy. The ODE state is integrated in `precision`
+        # (fp64 or fp32), and the score network is evaluated in
+        # `network_precision` (fp32, or bf16/fp16 under autocast).
+        assert precision in ["fp32", "fp64"]
+        assert network_precision in ["fp32", "fp16", "bf16"]
+        self._state_dtype = PRECISION_TO_TYPE[precision]
+        self._network_dtype = PRECISION_TO_TYPE[network_precision]
+
+        # Cache of the time step discretization, keyed by
+        # (num_steps, sigma_min, sigma_max, rho, device).
+        self._t_steps_cache = {}
+
     @torch.no_grad()
     def p_sample_loop(
         self,
@@ -46,21 +89,15 @@ class StochasticSampler(ReverseProcessSampler):
         sigma_max = min(self._sigma_max, score_network.sigma_max)
 
         # Time step discretization.
-        step_indices = torch.arange(
-            self._num_steps, dtype=torch.float64, device=latents.device
-        )
-        t_steps = (
-            sigma_max ** (1 / self._rho)
-            + step_indices
-            / (self._num_steps - 1)
-            * (sigma_min ** (1 / self._rho) - sigma_max ** (1 / self._rho))
-        ) ** self._rho
-        t_steps = torch.cat(
-            [score_network.round_sigma(t_steps), torch.zeros_like(t_steps[:1])]
-        )  # t_N = 0
+        t_steps = self._karras_t_steps(
+            score_network=score_network,
+            sigma_min=sigma_min,
+            sigma_max=sigma_max,
+            device=latents.device,
+        ).to(self._state_dtype)
 
         # Main sampling loop.
-        x_next = latents.to(torch.float64) * t_steps[0]
+        x_next = latents.to(self._state_dtype) * t_steps[0]
         for i, (t_cur, t_next) in enumerate(
             tqdm(zip(t_steps[:-1], t_steps[1:]), total=self._num_steps, leave=False)
         ):  # 0, ..., N-1
@@ -79,6 +116,31 @@ class StochasticSampler(ReverseProcessSampler):
 
         return x_next
 
+    def _karras_t_steps(
+        self,
+        score_network: torch.nn.Module,
+        sigma_min: float,
+        sigma_max: float,
+        device: torch.device,
+    ) -> torch.Tensor:
+        """Computes (and caches) the time step discretization in float64."""
+        key = (self._num_steps, sigma_min, sigma_max, self._rho, device)
+        if key not in self._t_steps_cache:
+            step_indices = torch.arange(
+                self._num_steps, dtype=torch.float64, device=device
+            )
+            t_steps = (
+                sigma_max ** (1 / self._rho)
+                + step_indices
+                / (self._num_steps - 1)
+                * (sigma_min ** (1 / self._rho) - sigma_max ** (1 / self._rho))
+            ) ** self._rho
+            t_steps = torch.cat(
+                [score_network.round_sigma(t_steps), torch.zeros_like(t_steps[:1])]
+            )  # t_N = 0
+            self._t_steps_cache[key] = t_steps
+        return self._t_steps_cache[key]
+
     @torch.no_grad()
     def p_sample(
         self,
@@ -111,6 +173,14 @@ class StochasticSampler(ReverseProcessSampler):
         i = context["step"]
         score_network = diffusion_model._score_network
         x_cur = x
+        denoise = lambda x_, t_: _denoise(
+            score_network,
+            x_,
+            t_,
+            class_labels,
+            state_dtype=self._state_dtype,
+            network_dtype=self._network_dtype,
+        )
 
         # Increase noise temporarily.
         gamma = (
@@ -124,13 +194,13 @@ class StochasticSampler(ReverseProcessSampler):
         ).sqrt() * self._S_noise * torch.randn_like(x_cur)
 
         # Euler step.
-        denoised = score_network(x_hat, t_hat, class_labels).to(torch.float64)
+        denoised = denoise(x_hat, t_hat)
         d_cur = (x_hat - denoised) / t_hat
         x_next = x_hat + (t_next - t_hat) * d_cur
 
         # Apply 2nd order correction.
         if i < self._num_steps - 1:
-            denoised = score_network(x_next, t_next, class_labels).to(torch.float64)
+            denoised = denoise(x_next, t_next)
             d_prime = (x_next - denoised) / t_next
             x_next = x_hat + (t_next - t_hat) * (0.5 * d_cur + 0.5 * d_prime)
         return x_next
@@ -158,6 +228,8 @@ class GeneralizedStochasticSampler(ReverseProcessSampler):
         C_2: float = 0.008,
         M: int = 1000,
         alpha: float = 1,
+        precision: str = "fp64",
+        network_precision: str = "fp32",
     ):
         super().__init__()
 
@@ -179,6 +251,17 @@ class GeneralizedStochasticSampler(ReverseProcessSampler):
         self._M = M
         self._alpha = alpha
 
+        # Precision policy, see StochasticSampler.
+        assert precision in ["fp32", "fp64"]
+        assert network_precision in ["fp32", "fp16", "bf16"]
+        self._state_dtype = PRECISION_TO_TYPE[precision]
+        self._network_dtype = PRECISION_TO_TYPE[network_precision]
+
+        # Cache of the final time step discretization, keyed by
+        # (sigma_min, sigma_max, device). Everything else the discretization
+        # depends on is fixed at construction.
+        self._t_steps_cache = {}
+
     @torch.no_grad()
     def p_sample_loop(
         self,
@@ -241,46 +324,6 @@ class GeneralizedStochasticSampler(ReverseProcessSampler):
         )
         vp_beta_min = np.log(sigma_max**2 + 1) - 0.5 * vp_beta_d
 
-        # Define time steps in terms of noise level.
-        step_indices = torch.arange(
-            self._num_steps, dtype=torch.float64, device=latents.device
-        )
-        if self._discretization == "vp":
-            orig_t_steps = 1 + step_indices / (self._num_steps - 1) * (
-                self._epsilon_s - 1
-            )
-            sigma_steps = vp_sigma(vp_beta_d, vp_beta_min)(orig_t_steps)
-        elif self._discretization == "ve":
-            orig_t_steps = (sigma_max**2) * (
-                (sigma_min**2 / sigma_max**2) ** (step_indices / (self._num_steps - 1))
-            )
-            sigma_steps = ve_sigma(orig_t_steps)
-        elif self._discretization == "iddpm":
-            u = torch.zeros(M + 1, dtype=torch.float64, device=latents.device)
-            alpha_bar = (
-                lambda j: (0.5 * np.pi * j / self._M / (self._C_2 + 1)).sin() ** 2
-            )
-            for j in torch.arange(self._M, 0, -1, device=latents.device):  # M, ..., 1
-                u[j - 1] = (
-                    (u[j] ** 2 + 1)
-                    / (alpha_bar(j - 1) / alpha_bar(j)).clip(min=self._C_1)
-                    - 1
-                ).sqrt()
-            u_filtered = u[torch.logical_and(u >= sigma_min, u <= sigma_max)]
-            sigma_steps = u_filtered[
-                ((len(u_filtered) - 1) / (self._num_steps - 1) * step_indices)
-                .round()
-                .to(torch.int64)
-            ]
-        else:
-            assert self._discretization == "edm"
-            sigma_steps = (
-                sigma_max ** (1 / self._rho)
-                + step_indices
-                / (self._num_steps - 1)
-                * (sigma_min ** (1 / self._rho) - sigma_max ** (1 / self._rho))
-            ) ** self._rho
-
         # Define noise level schedule.
         if self._schedule == "vp":
             sigma = vp_sigma(vp_beta_d, vp_beta_min)
@@ -305,13 +348,61 @@ class GeneralizedStochasticSampler(ReverseProcessSampler):
             s = lambda t: 1
             s_deriv = lambda t: 0
 
-        # Compute final time steps based on the corresponding noise levels.
-        t_steps = sigma_inv(score_network.round_sigma(sigma_steps))
-        t_steps = torch.cat([t_steps, torch.zeros_like(t_steps[:1])])  # t_N = 0
+        # Define time steps in terms of noise level. The discretization only
+        # depends on the noise level range, so cache it across calls.
+        key = (sigma_min, sigma_max, latents.device)
+        if key not in self._t_steps_cache:
+            step_indices = torch.arange(
+                self._num_steps, dtype=torch.float64, device=latents.device
+            )
+            if self._discretization == "vp":
+                orig_t_steps = 1 + step_indices / (self._num_steps - 1) * (
+                    self._epsilon_s - 1
+                )
+                sigma_steps = vp_sigma(vp_beta_d, vp_beta_min)(orig_t_steps)
+            elif self._discretization == "ve":
+                orig_t_steps = (sigma_max**2) * (
+                    (sigma_min**2 / sigma_max**2)
+                    ** (step_indices / (self._num_steps - 1))
+                )
+                sigma_steps = ve_sigma(orig_t_steps)
+            elif self._discretization == "iddpm":
+                u = torch.zeros(self._M + 1, dtype=torch.float64, device=latents.device)
+                alpha_bar = (
+                    lambda j: (0.5 * np.pi * j / self._M / (self._C_2 + 1)).sin() ** 2
+                )
+                for j in torch.arange(
+                    self._M, 0, -1, device=latents.device
+                ):  # M, ..., 1
+                    u[j - 1] = (
+                        (u[j] ** 2 + 1)
+                        / (alpha_bar(j - 1) / alpha_bar(j)).clip(min=self._C_1)
+                        - 1
+                    ).sqrt()
+                u_filtered = u[torch.logical_and(u >= sigma_min, u <= sigma_max)]
+                sigma_steps = u_filtered[
+                    ((len(u_filtered) - 1) / (self._num_steps - 1) * step_indices)
+                    .round()
+                    .to(torch.int64)
+                ]
+            else:
+                assert self._discretization == "edm"
+                sigma_steps = (
+                    sigma_max ** (1 / self._rho)
+                    + step_indices
+                    / (self._num_steps - 1)
+                    * (sigma_min ** (1 / self._rho) - sigma_max ** (1 / self._rho))
+                ) ** self._rho
+
+            # Compute final time steps based on the corresponding noise levels.
+            t_steps = sigma_inv(score_network.round_sigma(sigma_steps))
+            t_steps = torch.cat([t_steps, torch.zeros_like(t_steps[:1])])  # t_N = 0
+            self._t_steps_cache[key] = t_steps
+        t_steps = self._t_steps_cache[key].to(self._state_dtype)
 
         # Main sampling loop.
         t_next = t_steps[0]
-        x_next = latents.to(torch.float64) * (sigma(t_next) * s(t_next))
+        x_next = latents.to(self._state_dtype) * (sigma(t_next) * s(t_next))
         for i, (t_cur, t_next) in enumerate(
             tqdm(zip(t_steps[:-1], t_steps[1:]), total=len(t_steps) - 1, leave=False)
         ):  # 0, ..., N-1
@@ -371,6 +462,14 @@ class GeneralizedStochasticSampler(ReverseProcessSampler):
         s_deriv = context["s_deriv"]
         score_network = diffusion_model._score_network
         x_cur = x
+        denoise = lambda x_, t_: _denoise(
+            score_network,
+            x_,
+            t_,
+            class_labels,
+            state_dtype=self._state_dtype,
+            network_dtype=self._network_dtype,
+        )
 
         # Increase noise temporarily.
         gamma = (
@@ -387,9 +486,7 @@ class GeneralizedStochasticSampler(ReverseProcessSampler):
 
         # Euler step.
         h = t_next - t_hat
-        denoised = score_network(x_hat / s(t_hat), sigma(t_hat), class_labels).to(
-            torch.float64
-        )
+        denoised = denoise(x_hat / s(t_hat), sigma(t_hat))
         d_cur = (
             sigma_deriv(t_hat) / sigma(t_hat) + s_deriv(t_hat) / s(t_hat)
         ) * x_hat - sigma_deriv(t_hat) * s(t_hat) / sigma(t_hat) * denoised
@@ -401,9 +498,7 @@ class GeneralizedStochasticSampler(ReverseProcessSampler):
             x_next = x_hat + h * d_cur
         else:
             assert self._solver == "heun"
-            denoised = score_network(
-                x_prime / s(t_prime), sigma(t_prime), class_labels
-            ).to(torch.float64)
+            denoised = denoise(x_prime / s(t_prime), sigma(t_prime))
             d_prime = (
                 sigma_deriv(t_prime) / sigma(t_prime) + s_deriv(t_prime) / s(t_prime)
             ) * x_prime - sigma_deriv(t_prime) * s(t_prime) / sigma(t_prime) * denoised
@@ -0,0 +1,263 @@
+"""Long video generation from a sampling scheme.
+
+Generates videos longer than the model context by repeatedly sampling windows
+of frames, as directed by a sampling scheme (see schemes.py), where each window
+is conditioned on frames which were observed or generated before it.
+
+The whole video is kept in a frame buffer on the device of the diffusion model,
+so that the observed frames of each window are gathered, and the generated
+frames scattered back, with a single indexing operation. If the model is a
+latent diffusion model, the encoded latents of each window are cached, and
+reused if the same window (with the same frame contents) is observed again.
+Intermediate outputs are optionally written as GIFs on a background thread.
+"""
+
+from collections import OrderedDict
+import os
+import threading
+import torch
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+from xdiffusion.diffusion import DiffusionModel
+from xdiffusion.samplers.base import ReverseProcessSampler
+from xdiffusion.samplers.schemes import SamplingSchemeBase
+from xdiffusion.utils import normalize_to_neg_one_to_one, video_tensor_to_gif
+
+
+class AsyncGifWriter:
+    """Writes videos as GIFs on a background thread, one at a time."""
+
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+
+    def write(self, outputs: Dict[str, torch.Tensor]):
+        """Writes GIFs in the background.
+
+        Args:
+            outputs: Dictionary of output paths to the videos to write there,
+                of shape (B, C, F, H, W) in the range [0,1].
+        """
+        # Only one set of GIFs is in flight at a time.
+        self.wait()
+
+        # The device to host copies are asynchronous, so the writer waits for
+        # them on this event rather than stalling the caller.
+        snapshots = {}
+        for path, videos in outputs.items():
+            snapshots[path] = torch.empty(
+                videos.shape, dtype=videos.dtype, pin_memory=videos.is_cuda
+            )
+            snapshots[path].copy_(videos.detach(), non_blocking=True)
+
+        copy_done = None
+        if any(videos.is_cuda for videos in outputs.values()):
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+
+        def _write():
+            try:
+                if copy_done is not None:
+                    copy_done.synchronize()
+                for path, videos in snapshots.items():
+                    video_tensor_to_gif(videos, path)
+            except BaseException as e:
+                self._error = e
+
+        self._thread = threading.Thread(target=_write, daemon=False)
+        self._thread.start()
+
+    def wait(self):
+        """Waits for the GIF in flight to finish writing."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise RuntimeError("Failed to write GIF.") from error
+
+
+class LongVideoGenerator:
+    """Generates long videos, one window of frames at a time."""
+
+    def __init__(
+        self,
+        diffusion_model: DiffusionModel,
+        encode_fn: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+        intermediate_output_path: Optional[str] = None,
+        latent_cache_size: int = 16,
+    ):
+        """Initializes the generator.
+
+        Args:
+            diffusion_model: The video diffusion model to sample windows from.
+            encode_fn: For latent diffusion models, encodes pixel frames in the
+                range [0,1] of shape (B, C, F, H, W) into the latent space of the
+                model, for example GaussianDiffusion_DDPM.encode_to_latents.
+            intermediate_output_path: If set, the generated window and the
+                video so far are written as GIFs to this directory after every
+                step, on a background thread.
+            latent_cache_size: The maximum number of cached window latents.
+        """
+        self._diffusion_model = diffusion_model
+        self._encode_fn = encode_fn
+        self._intermediate_output_path = intermediate_output_path
+        self._latent_cache_size = latent_cache_size
+        self._latent_cache: OrderedDict[Hashable, torch.Tensor] = OrderedDict()
+        self._gif_writer = AsyncGifWriter()
+
+    def generate(
+        self,
+        sampling_scheme: SamplingSchemeBase,
+        num_samples: int,
+        frame_shape: Tuple[int, int, int],
+        context: Optional[Dict] = None,
+        sampler: Optional[ReverseProcessSampler] = None,
+        initial_frames: Optional[torch.Tensor] = None,
+        num_sampling_steps: Optional[int] = None,
+    ) -> torch.Tensor:
+        """Generates a batch of videos following the sampling scheme.
+
+        Args:
+            sampling_scheme: A new sampling scheme, which chooses the observed
+                and generated frames of each window. Schemes can only be
+                iterated once.
+            num_samples: The number of videos to generate.
+            frame_shape: The (C, H, W) shape of each frame.
+            context: Conditioning shared by every window, for example the
+                text prompts or classes.
+            sampler: The reverse process sampler to use.
+            initial_frames: The observed frames at the start of the video, of
+                shape (B, C, num_observations, H, W) in the range [0,1]. Required
+                if the sampling scheme has observations.
+            num_sampling_steps: The number of sampling steps of each window.
+
+        Returns:
+            Tensor batch of videos of shape (B, C, F, H, W) in the range [0,1],
+            on the device of the diffusion model.
+        """
+        device = next(self._diffusion_model.parameters()).device
+        B = num_samples
+        context = context if context is not None else {}
+        self._latent_cache.clear()
+
+        # The frame buffer of the whole video, which is (B, T, C, H, W) so that
+        # the frames of each window can be gathered and scattered in one step.
+        frames = torch.zeros(
+            (B, sampling_scheme.video_length) + tuple(frame_shape), device=device
+        )
+        num_observations = sampling_scheme.num_observations
+        if num_observations > 0:
+            assert initial_frames is not None, "The scheme requires initial frames."
+            assert initial_frames.shape[2] == num_observations
+            frames[:, :num_observations] = initial_frames.to(device).permute(
+                0, 2, 1, 3, 4
+            )
+
+        # The number of times each frame has been generated, which identifies
+        # the contents of the frames for the latent cache.
+        frame_versions = [0] * sampling_scheme.video_length
+        batch_indices = torch.arange(B, device=device)[:, None]
+
+        frame_indices_iterator = iter(sampling_scheme)
+        step = 0
+        while True:
+            # ignored for non-adaptive sampling schemes
+            frame_indices_iterator.set_videos(frames)
+            try:
+                obs_frame_indices, latent_frame_indices, temporal_mask = next(
+                    frame_indices_iterator
+                )
+            except StopIteration:
+                break
+
+            num_obs = len(obs_frame_indices[0])
+            window_indices = [
+                o + l for o, l in zip(obs_frame_indices, latent_frame_indices)
+            ]
+            frame_indices = torch.tensor(window_indices, dtype=torch.long).to(device)
+            num_frames = frame_indices.shape[1]
+
+            # Gather the frames of the window, and the observation masks of shape
+            # (B, 1, num_frames, 1, 1), where the observed frames come first.
+            x0 = frames[batch_indices, frame_indices].permute(0, 2, 1, 3, 4)
+            observed_mask = (
+                (torch.arange(num_frames, device=device) < num_obs)
+                .float()
+                .view(1, 1, num_frames, 1, 1)
+                .expand(B, 1, num_frames, 1, 1)
+            )
+
+            window_context = context.copy()
+            window_context["x0"] = self._encode_window(
+                x0, window_indices, frame_versions
+            )
+            window_context["frame_indices"] = frame_indices
+            window_context["observed_mask"] = observed_mask
+            window_context["latent_mask"] = 1.0 - observed_mask
+            window_context["video_mask"] = temporal_mask.to(device)
+
+            window_samples, _ = self._diffusion_model.sample(
+                num_samples=B,
+                context=window_context,
+                sampler=sampler,
+                num_sampling_steps=num_sampling_steps,
+            )
+
+            # Scatter the generated frames back into the video.
+            num_latents = num_frames - num_obs
+            if num_latents > 0:
+                generated = window_samples.permute(0, 2, 1, 3, 4)[:, -num_latents:]
+                frames[batch_indices, frame_indices[:, num_obs:]] = generated.to(
+                    frames.dtype
+                )
+            for idx in set(i for row in latent_frame_indices for i in row):
+                frame_versions[idx] += 1
+
+            if self._intermediate_output_path is not None:
+                path = self._intermediate_output_path
+                self._gif_writer.write(
+                    {
+                        os.path.join(path, f"interim_sample_step_{step}.gif"): (
+                            window_samples
+                        ),
+                        os.path.join(path, f"sample_step_{step}.gif"): frames.permute(
+                            0, 2, 1, 3, 4
+                        ),
+                    }
+                )
+            step += 1
+
+        self._gif_writer.wait()
+        self._latent_cache.clear()
+        return frames.permute(0, 2, 1, 3, 4)
+
+    def _encode_window(
+        self,
+        x0: torch.Tensor,
+        window_indices,
+        frame_versions,
+    ) -> torch.Tensor:
+        if self._encode_fn is None:
+            return normalize_to_neg_one_to_one(x0)
+
+        # The window can only be cached if every row uses the same frames.
+        key = None
+        if all(row == window_indices[0] for row in window_indices):
+            key = (
+                tuple(window_indices[0]),
+                tuple(frame_versions[i] for i in window_indices[0]),
+            )
+            if key in self._latent_cache:
+                self._latent_cache.move_to_end(key)
+                return self._latent_cache[key]
+
+        with torch.no_grad():
+            latents = self._encode_fn(x0)
+
+        if key is not None and self._latent_cache_size > 0:
+            self._latent_cache[key] = latents
+            while len(self._latent_cache) > self._latent_cache_size:
+                self._latent_cache.popitem(last=False)
+        return latents
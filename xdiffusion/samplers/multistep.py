@@ -0,0 +1,358 @@
+"""Multistep high order samplers: DPM-Solver++ and UniPC.
+
+DPM-Solver++ (https://arxiv.org/abs/2211.01095) and UniPC
+(https://arxiv.org/abs/2302.04867) solve the probability flow ODE in the
+data prediction (x_0) parameterization, with the half log-SNR
+lambda = log(alpha / sigma) as the time variable. The model outputs of the
+previous steps are kept in a history buffer, so each step still uses a single
+network evaluation while reaching second or third order accuracy, which gives
+good samples in 10-20 steps.
+
+Both samplers plug into the sampling loop of GaussianDiffusion_DDPM. With a
+ContinuousNoiseScheduler, the steps use the logsnr_t and logsnr_s of the
+sampling loop. With a DiscreteNoiseScheduler, the N sampling steps are spread
+evenly over the training timesteps, and the alphas are taken from
+alphas_cumprod.
+"""
+
+import torch
+from typing import Dict, List, Optional, Tuple
+
+from xdiffusion.diffusion import DiffusionModel
+from xdiffusion.samplers.ddim import DDIMSampler
+
+
+class MultistepSolverSampler(DDIMSampler):
+    """Base class for the multistep data prediction solvers."""
+
+    def __init__(
+        self,
+        order: int = 2,
+        lower_order_final: bool = True,
+        clip_denoised: bool = True,
+        batched_guidance: bool = False,
+        **kwargs,
+    ):
+        """Initializes the sampler.
+
+        Args:
+            order: The order of the solver, 1, 2 or 3.
+            lower_order_final: If True, use lower order steps at the end of
+                sampling, which is more stable for small numbers of steps.
+            clip_denoised: True to clip (or dynamically threshold) the predicted x_0.
+            batched_guidance: If True, classifier free guidance runs the conditional
+                and unconditional branches through the score network as a single batch.
+        """
+        super().__init__(batched_guidance=batched_guidance)
+        assert order in [1, 2, 3], f"Solver order {order} is not supported."
+        self._order = order
+        self._lower_order_final = lower_order_final
+        self._clip_denoised = clip_denoised
+        self._reset()
+
+    def _reset(self):
+        # The half log-SNR and predicted x_0 of the most recent steps.
+        self._lambdas: List[torch.Tensor] = []
+        self._outputs: List[torch.Tensor] = []
+        self._last_timestep_idx = None
+        self._timesteps: Optional[List[int]] = None
+
+    @torch.no_grad()
+    def p_sample(
+        self,
+        x: torch.Tensor,
+        context: Dict,
+        unconditional_context: Optional[Dict],
+        diffusion_model: DiffusionModel,
+        guidance_fn=None,
+        classifier_free_guidance: Optional[float] = None,
+    ):
+        """Reverse process single step.
+
+        Args:
+            x: Tensor batch of the distribution at time t.
+            context: The conditional context at time t.
+            unconditional_context: The unconditional context at time t, for
+                classifier free guidance.
+            diffusion_model: The diffusion model to sample from.
+            guidance_fn: Unused.
+            classifier_free_guidance: Classifier free guidance value
+
+        Returns:
+            Tensor batch of the distribution at the next timestep.
+        """
+        timestep_idx = context["timestep_idx"]
+        if self._last_timestep_idx is None or timestep_idx >= self._last_timestep_idx:
+            # The start of a new sampling loop.
+            self._reset()
+        self._last_timestep_idx = timestep_idx
+
+        noise_scheduler = diffusion_model.noise_scheduler()
+        if noise_scheduler.continuous():
+            logsnr_t = context["logsnr_t"][0]
+            logsnr_s = context["logsnr_s"][0]
+        else:
+            # Discrete models are conditioned on the training timestep.
+            if self._timesteps is None:
+                self._timesteps = (
+                    torch.linspace(
+                        noise_scheduler.num_timesteps - 1, 0, timestep_idx + 1
+                    )
+                    .round()
+                    .long()
+                    .flip(0)
+                    .tolist()
+                )
+            t = self._timesteps[timestep_idx]
+            context = _with_timestep(context, t)
+            if unconditional_context is not None:
+                unconditional_context = _with_timestep(unconditional_context, t)
+
+            alphas_cumprod = noise_scheduler.alphas_cumprod.to(x.device)
+            logsnr_t = _logsnr_from_alphas_cumprod(alphas_cumprod[t])
+            logsnr_s = (
+                _logsnr_from_alphas_cumprod(
+                    alphas_cumprod[self._timesteps[timestep_idx - 1]]
+                )
+                if timestep_idx > 0
+                else None
+            )
+
+        x0_pred, _ = self._predict_xstart_and_epsilon(
+            x=x,
+            context=context,
+            unconditional_context=unconditional_context,
+            diffusion_model=diffusion_model,
+            classifier_free_guidance=classifier_free_guidance,
+            clip_denoised=self._clip_denoised,
+        )
+
+        if timestep_idx == 0:
+            # The last step returns the prediction of x_0 directly.
+            self._reset()
+            return x0_pred
+
+        lambda_t = logsnr_t / 2
+        x = self._correct(x, x0_pred, lambda_t)
+        self._lambdas = (self._lambdas + [lambda_t])[-self._order :]
+        self._outputs = (self._outputs + [x0_pred])[-self._order :]
+
+        order = min(self._order, len(self._outputs))
+        if self._lower_order_final:
+            order = min(order, timestep_idx)
+        return self._predict(x, logsnr_s / 2, order)
+
+    def _correct(
+        self, x: torch.Tensor, x0_pred: torch.Tensor, lambda_t: torch.Tensor
+    ) -> torch.Tensor:
+        """Corrects the current sample using the current model output.
+
+        Args:
+            x: Tensor batch of the distribution at time t.
+            x0_pred: The predicted x_0 at time t, which is not yet in the history.
+            lambda_t: The half log-SNR at time t.
+
+        Returns:
+            The corrected tensor batch at time t.
+        """
+        return x
+
+    def _predict(
+        self, x: torch.Tensor, lambda_s: torch.Tensor, order: int
+    ) -> torch.Tensor:
+        """Steps from the most recent history entry to lambda_s.
+
+        Args:
+            x: Tensor batch of the distribution at time t.
+            lambda_s: The half log-SNR of the next timestep.
+            order: The order of the step.
+
+        Returns:
+            Tensor batch of the distribution at the next timestep.
+        """
+        raise NotImplementedError()
+
+
+class DPMSolverPlusPlusSampler(MultistepSolverSampler):
+    """Multistep DPM-Solver++ (2M and 3M), from https://arxiv.org/abs/2211.01095."""
+
+    def _predict(
+        self, x: torch.Tensor, lambda_s: torch.Tensor, order: int
+    ) -> torch.Tensor:
+        lambda_t = self._lambdas[-1]
+        m0 = self._outputs[-1]
+        alpha_s, sigma_s = _alpha_sigma(lambda_s)
+        _, sigma_t = _alpha_sigma(lambda_t)
+
+        h = lambda_s - lambda_t
+        phi_1 = torch.expm1(-h)
+        x_s = (sigma_s / sigma_t) * x - (alpha_s * phi_1) * m0
+        if order == 1:
+            return x_s
+
+        lambda_t1 = self._lambdas[-2]
+        r0 = (lambda_t - lambda_t1) / h
+        D1_0 = (m0 - self._outputs[-2]) / r0
+        if order == 2:
+            return x_s - (0.5 * alpha_s * phi_1) * D1_0
+
+        r1 = (lambda_t1 - self._lambdas[-3]) / h
+        D1_1 = (self._outputs[-2] - self._outputs[-3]) / r1
+        D1 = D1_0 + (r0 / (r0 + r1)) * (D1_0 - D1_1)
+        D2 = (D1_0 - D1_1) / (r0 + r1)
+        return (
+            x_s
+            + (alpha_s * (phi_1 / h + 1.0)) * D1
+            - (alpha_s * ((phi_1 + h) / h**2 - 0.5)) * D2
+        )
+
+
+class UniPCSampler(MultistepSolverSampler):
+    """Multistep UniPC predictor-corrector, from https://arxiv.org/abs/2302.04867.
+
+    The corrector (UniC) refines each sample with the model output at that sample,
+    which the predictor (UniP) then reuses, so it adds no network evaluations.
+    """
+
+    def __init__(
+        self,
+        order: int = 2,
+        variant: str = "bh2",
+        lower_order_final: bool = True,
+        clip_denoised: bool = True,
+        batched_guidance: bool = False,
+        **kwargs,
+    ):
+        """Initializes the sampler.
+
+        Args:
+            order: The order of the solver, 1, 2 or 3.
+            variant: The B(h) function of the solver, "bh1" or "bh2".
+            lower_order_final: If True, use lower order steps at the end of
+                sampling, which is more stable for small numbers of steps.
+            clip_denoised: True to clip (or dynamically threshold) the predicted x_0.
+            batched_guidance: If True, classifier free guidance runs the conditional
+                and unconditional branches through the score network as a single batch.
+        """
+        assert variant in ["bh1", "bh2"], f"UniPC variant {variant} is not supported."
+        self._variant = variant
+        super().__init__(
+            order=order,
+            lower_order_final=lower_order_final,
+            clip_denoised=clip_denoised,
+            batched_guidance=batched_guidance,
+        )
+
+    def _reset(self):
+        super()._reset()
+        # The sample and order of the last predictor step, for the corrector.
+        self._last_sample: Optional[torch.Tensor] = None
+        self._last_order = 0
+
+    def _correct(
+        self, x: torch.Tensor, x0_pred: torch.Tensor, lambda_t: torch.Tensor
+    ) -> torch.Tensor:
+        if self._last_sample is None:
+            return x
+
+        order = self._last_order
+        lambda_0 = self._lambdas[-1]
+        m0 = self._outputs[-1]
+        alpha_t, sigma_t = _alpha_sigma(lambda_t)
+        _, sigma_0 = _alpha_sigma(lambda_0)
+
+        h = lambda_t - lambda_0
+        rks, D1s = self._differences(h, order)
+        hh = -h
+        h_phi_1 = torch.expm1(hh)
+        B_h = h_phi_1 if self._variant == "bh2" else hh
+
+        if order == 1:
+            rhos_c = [0.5]
+        else:
+            R, b = _unipc_coefficients(rks, hh, B_h, order)
+            rhos_c = torch.linalg.solve(R, b)
+
+        x_t = (sigma_t / sigma_0) * self._last_sample - (alpha_t * h_phi_1) * m0
+        correction = sum(rhos_c[k] * D1 for k, D1 in enumerate(D1s))
+        correction = correction + rhos_c[-1] * (x0_pred - m0)
+        return x_t - (alpha_t * B_h) * correction
+
+    def _predict(
+        self, x: torch.Tensor, lambda_s: torch.Tensor, order: int
+    ) -> torch.Tensor:
+        self._last_sample = x
+        self._last_order = order
+
+        lambda_0 = self._lambdas[-1]
+        m0 = self._outputs[-1]
+        alpha_s, sigma_s = _alpha_sigma(lambda_s)
+        _, sigma_0 = _alpha_sigma(lambda_0)
+
+        h = lambda_s - lambda_0
+        rks, D1s = self._differences(h, order)
+        hh = -h
+        h_phi_1 = torch.expm1(hh)
+        B_h = h_phi_1 if self._variant == "bh2" else hh
+
+        x_s = (sigma_s / sigma_0) * x - (alpha_s * h_phi_1) * m0
+        if order == 1:
+            return x_s
+
+        if order == 2:
+            rhos_p = [0.5]
+        else:
+            R, b = _unipc_coefficients(rks, hh, B_h, order)
+            rhos_p = torch.linalg.solve(R[:-1, :-1], b[:-1])
+        prediction = sum(rhos_p[k] * D1 for k, D1 in enumerate(D1s))
+        return x_s - (alpha_s * B_h) * prediction
+
+    def _differences(
+        self, h: torch.Tensor, order: int
+    ) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """Returns the step ratios and scaled differences of the history."""
+        lambda_0 = self._lambdas[-1]
+        m0 = self._outputs[-1]
+        rks = []
+        D1s = []
+        for i in range(1, order):
+            rk = (self._lambdas[-(i + 1)] - lambda_0) / h
+            rks.append(rk)
+            D1s.append((self._outputs[-(i + 1)] - m0) / rk)
+        rks.append(torch.ones_like(h))
+        return torch.stack(rks), D1s
+
+
+def _unipc_coefficients(
+    rks: torch.Tensor, hh: torch.Tensor, B_h: torch.Tensor, order: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """The linear system for the UniPC coefficients, from Eq. 8."""
+    h_phi_k = torch.expm1(hh) / hh - 1.0
+    factorial_i = 1
+    R = []
+    b = []
+    for i in range(1, order + 1):
+        R.append(torch.pow(rks, i - 1))
+        b.append(h_phi_k * factorial_i / B_h)
+        factorial_i *= i + 1
+        h_phi_k = h_phi_k / hh - 1.0 / factorial_i
+    return torch.stack(R), torch.stack(b)
+
+
+def _alpha_sigma(lambda_t: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Returns alpha_t and sigma_t from the half log-SNR lambda_t."""
+    return (
+        torch.sqrt(torch.sigmoid(2.0 * lambda_t)),
+        torch.sqrt(torch.sigmoid(-2.0 * lambda_t)),
+    )
+
+
+def _logsnr_from_alphas_cumprod(alphas_cumprod: torch.Tensor) -> torch.Tensor:
+    return torch.log(alphas_cumprod) - torch.log1p(-alphas_cumprod)
+
+
+def _with_timestep(context: Dict, timestep: int) -> Dict:
+    """Returns a copy of the context at the discrete training timestep."""
+    context = context.copy()
+    context["timestep"] = torch.full_like(context["timestep"], timestep)
+    return context
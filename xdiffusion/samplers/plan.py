@@ -0,0 +1,89 @@
+"""Precomputed per-step state for the reverse process sampling loop."""
+
+import torch
+from typing import Dict, Optional
+
+from xdiffusion.scheduler import NoiseScheduler
+
+
+class SamplingPlan:
+    """The timestep state for every step of a sampling trajectory.
+
+    The sampling loop needs the batched timestep (and for continuous noise
+    schedulers, logsnr_s and logsnr_t) at each step. Rather than building these
+    from Python lists and calling into the noise scheduler at every step, the
+    whole trajectory is computed in a single vectorized pass on the device, and
+    the sampling loop only indexes into it.
+    """
+
+    def __init__(
+        self,
+        noise_scheduler: NoiseScheduler,
+        batch_size: int,
+        num_sampling_steps: int,
+        initial_timestep: int,
+        device: torch.device,
+    ):
+        """Builds the plan.
+
+        Args:
+            noise_scheduler: The noise scheduler of the diffusion model.
+            batch_size: The batch size of the samples.
+            num_sampling_steps: The number of sampling steps.
+            initial_timestep: The timestep index to stop sampling at.
+            device: The device of the sampling loop.
+        """
+        self.num_sampling_steps = num_sampling_steps
+
+        # The timestep indices of the trajectory, in sampling order.
+        self.timestep_indices = list(
+            reversed(range(initial_timestep, num_sampling_steps))
+        )
+        steps = torch.tensor(self.timestep_indices, device=device)
+
+        # Discrete timesteps are integer indices, continuous timesteps are in [0,1].
+        self.timesteps = steps[:, None].expand(-1, batch_size).contiguous()
+        self.logsnr_s: Optional[torch.Tensor] = None
+        self.logsnr_t: Optional[torch.Tensor] = None
+        if noise_scheduler.continuous():
+            s = steps / num_sampling_steps
+            t = (steps + 1) / num_sampling_steps
+
+            # The logsnr does not depend on the batch, so only compute it
+            # once per step and broadcast it over the batch.
+            self.logsnr_s = (
+                noise_scheduler.logsnr(s)[:, None].expand(-1, batch_size).contiguous()
+            )
+            self.logsnr_t = (
+                noise_scheduler.logsnr(t)[:, None].expand(-1, batch_size).contiguous()
+            )
+            self.timesteps = self.timesteps / num_sampling_steps
+
+    def __len__(self) -> int:
+        return len(self.timestep_indices)
+
+    def step_context(self, step: int, context: Optional[Dict]) -> Optional[Dict]:
+        """Creates the context for a step of the trajectory.
+
+        Some of the score network preprocessors can update the context at
+        each call, so a new dictionary is returned at each step to preserve
+        the original context.
+
+        Args:
+            step: The step of the trajectory, in sampling order.
+            context: The context to add the timestep state to.
+
+        Returns:
+            A copy of context with the timestep state, or None if context
+            is None.
+        """
+        if context is None:
+            return None
+
+        context_for_step = context.copy()
+        context_for_step["timestep_idx"] = self.timestep_indices[step]
+        context_for_step["timestep"] = self.timesteps[step]
+        if self.logsnr_s is not None:
+            context_for_step["logsnr_s"] = self.logsnr_s[step]
+            context_for_step["logsnr_t"] = self.logsnr_t[step]
+        return context_for_step
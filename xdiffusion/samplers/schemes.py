@@ -73,13 +73,16 @@ class SamplingSchemeBase:
         temporal_mask = torch.ones(
             (len(obs_frame_indices), self._max_frames), dtype=torch.bool
         )
-        for batch_idx in range(len(obs_frame_indices)):
-            for frame_idx in obs_frame_indices[batch_idx]:
-                # Convert from absolute frame index to relative
-                frame_idx = frame_idx - (self._step_size) * (self._current_step - 1)
-
-                assert frame_idx >= 0 and frame_idx < self._max_frames
-                temporal_mask[batch_idx][frame_idx] = False
+        if len(obs_frame_indices) > 0 and len(obs_frame_indices[0]) > 0:
+            # Convert from absolute frame index to relative
+            relative_indices = torch.tensor(
+                obs_frame_indices, dtype=torch.long
+            ) - self._step_size * (self._current_step - 1)
+
+            assert (relative_indices >= 0).all() and (
+                relative_indices < self._max_frames
+            ).all()
+            temporal_mask.scatter_(1, relative_indices, False)
         return obs_frame_indices, latent_frame_indices, temporal_mask
 
     def is_done(self):
@@ -157,7 +157,9 @@ class Chewie(nn.Module):
         txt = self.txt_in(txt)
 
         ids = torch.cat((txt_ids, img_ids), dim=1)
-        pe = self.pe_embedder(ids)
+        pe = self.pe_embedder(
+            ids, cache_key=(B, H // self.patch_size, W // self.patch_size, txt.shape[1])
+        )
 
         for block in self.double_blocks:
             img, txt = block(img=img, txt=txt, vec=vec, pe=pe)
@@ -4,6 +4,7 @@ import torch
 from typing import Dict
 
 from xdiffusion.layers.attention import MultiHeadSelfAttention as Attention
+from xdiffusion.layers.block_cache import run_cached_blocks
 from xdiffusion.layers.embedding import PatchEmbed
 from xdiffusion.layers.mlp import Mlp
 from xdiffusion.layers.utils import get_2d_sincos_pos_embed
@@ -145,6 +146,10 @@ class DiT(torch.nn.Module):
         self.final_layer = FinalLayer(hidden_size, patch_size, self.out_channels)
         self.initialize_weights()
 
+        # Optional cache of the block outputs across sampling steps,
+        # set with configure_block_cache.
+        self.block_cache = None
+
     def initialize_weights(self):
         # Initialize transformer layers:
         def _basic_init(module):
@@ -222,8 +227,25 @@ class DiT(torch.nn.Module):
             self.x_embedder(x) + self.pos_embed
         )  # (N, T, D), where T = H * W / patch_size ** 2
         c = context["timestep_embedding"]  # (N, D)
-        for block in self.blocks:
-            x = block(x, c)  # (N, T, D)
+
+        def run_blocks(x):
+            for block in self.blocks:
+                x = block(x, c)  # (N, T, D)
+            return x
+
+        def modulated_input():
+            shift_msa, scale_msa = (
+                self.blocks[0].adaLN_modulation(c).chunk(6, dim=1)[:2]
+            )
+            return modulate(self.blocks[0].norm1(x), shift_msa, scale_msa)
+
+        x = run_cached_blocks(
+            self.block_cache,
+            x,
+            run_blocks,
+            modulated_input=modulated_input,
+            timestep_embedding=c,
+        )
         x = self.final_layer(x, c)  # (N, T, patch_size ** 2 * out_channels)
         x = self.unpatchify(x)  # (N, out_channels, H, W)
         return x
@@ -461,7 +461,8 @@ class VPPrecond(torch.nn.Module):
             class_labels=class_labels,
             **model_kwargs,
         )
-        assert F_x.dtype == dtype
+        # Under autocast, the model output can be in reduced precision.
+        assert F_x.dtype == dtype or F_x.dtype in (torch.float16, torch.bfloat16)
         D_x = c_skip * x + c_out * F_x.to(torch.float32)
         return D_x
 
@@ -536,7 +537,8 @@ class VEPrecond(torch.nn.Module):
             class_labels=class_labels,
             **model_kwargs,
         )
-        assert F_x.dtype == dtype
+        # Under autocast, the model output can be in reduced precision.
+        assert F_x.dtype == dtype or F_x.dtype in (torch.float16, torch.bfloat16)
         D_x = c_skip * x + c_out * F_x.to(torch.float32)
         return D_x
 
@@ -614,7 +616,8 @@ class iDDPMPrecond(torch.nn.Module):
             class_labels=class_labels,
             **model_kwargs,
         )
-        assert F_x.dtype == dtype
+        # Under autocast, the model output can be in reduced precision.
+        assert F_x.dtype == dtype or F_x.dtype in (torch.float16, torch.bfloat16)
         D_x = c_skip * x + c_out * F_x[:, : self.img_channels].to(torch.float32)
         return D_x
 
@@ -689,7 +692,8 @@ class EDMPrecond(torch.nn.Module):
             class_labels=class_labels,
             **model_kwargs,
         )
-        assert F_x.dtype == dtype
+        # Under autocast, the model output can be in reduced precision.
+        assert F_x.dtype == dtype or F_x.dtype in (torch.float16, torch.bfloat16)
         D_x = c_skip * x + c_out * F_x.to(torch.float32)
         return D_x
 
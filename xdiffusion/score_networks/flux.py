@@ -12,6 +12,7 @@ from torch import Tensor, nn
 from typing import Dict
 
 from xdiffusion.utils import DotConfig
+from xdiffusion.layers.block_cache import run_cached_blocks
 from xdiffusion.layers.flux import (
     DoubleStreamBlock,
     EmbedND,
@@ -113,6 +114,10 @@ class Flux(nn.Module):
 
         self.final_layer = LastLayer(self.hidden_size, 1, self.out_channels)
 
+        # Optional cache of the block outputs across sampling steps,
+        # set with configure_block_cache.
+        self.block_cache = None
+
     def forward(self, x: Tensor, context: Dict, **kwargs) -> Tensor:
         # Pull out internal entries from the context
         guidance = (
@@ -166,15 +171,32 @@ class Flux(nn.Module):
         txt = self.txt_in(txt)
 
         ids = torch.cat((txt_ids, img_ids), dim=1)
-        pe = self.pe_embedder(ids)
+        pe = self.pe_embedder(
+            ids, cache_key=(B, H // self.patch_size, W // self.patch_size, txt.shape[1])
+        )
+
+        def run_blocks(img):
+            block_txt = txt
+            for block in self.double_blocks:
+                img, block_txt = block(img=img, txt=block_txt, vec=vec, pe=pe)
 
-        for block in self.double_blocks:
-            img, txt = block(img=img, txt=txt, vec=vec, pe=pe)
+            img = torch.cat((block_txt, img), 1)
+            for block in self.single_blocks:
+                img = block(img, vec=vec, pe=pe)
+            return img[:, block_txt.shape[1] :, ...]
 
-        img = torch.cat((txt, img), 1)
-        for block in self.single_blocks:
-            img = block(img, vec=vec, pe=pe)
-        img = img[:, txt.shape[1] :, ...]
+        def modulated_input():
+            first_block = self.double_blocks[0]
+            img_mod1, _ = first_block.img_mod(vec)
+            return (1 + img_mod1.scale) * first_block.img_norm1(img) + img_mod1.shift
+
+        img = run_cached_blocks(
+            self.block_cache,
+            img,
+            run_blocks,
+            modulated_input=modulated_input,
+            timestep_embedding=vec,
+        )
 
         img = self.final_layer(img, vec)  # (N, T, patch_size ** 2 * out_channels)
 
@@ -6,6 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from xdiffusion.layers.activation import get_activation
+from xdiffusion.layers.block_cache import run_cached_blocks
 from xdiffusion.layers.flux import MLPEmbedder
 from xdiffusion.layers.hunyuan_video.attention import (
     attention,
@@ -563,6 +564,10 @@ class HYVideoDiffusionTransformer(torch.nn.Module):
             get_activation("silu", return_cls=True),
         )
 
+        # Optional cache of the block outputs across sampling steps,
+        # set with configure_block_cache.
+        self.block_cache = None
+
     def enable_deterministic(self):
         for block in self.double_blocks:
             block.enable_deterministic()
@@ -643,38 +648,53 @@ class HYVideoDiffusionTransformer(torch.nn.Module):
 
         freqs_cis = (freqs_cos, freqs_sin) if freqs_cos is not None else None
         # --------------------- Pass through DiT blocks ------------------------
-        for block_idx, block in enumerate(self.double_blocks):
-            double_block_args = [
-                img,
-                txt,
-                vec,
-                cu_seqlens_q,
-                cu_seqlens_kv,
-                max_seqlen_q,
-                max_seqlen_kv,
-                freqs_cis,
-            ]
-
-            img, txt = block(*double_block_args)
-
-        # Merge txt and img to pass through single stream blocks.
-        x = torch.cat((img, txt), 1)
-        if len(self.single_blocks) > 0:
-            for block_idx, block in enumerate(self.single_blocks):
-                single_block_args = [
-                    x,
+        def run_blocks(img):
+            block_txt = txt
+            for block_idx, block in enumerate(self.double_blocks):
+                double_block_args = [
+                    img,
+                    block_txt,
                     vec,
-                    txt_seq_len,
                     cu_seqlens_q,
                     cu_seqlens_kv,
                     max_seqlen_q,
                     max_seqlen_kv,
-                    (freqs_cos, freqs_sin),
+                    freqs_cis,
                 ]
 
-                x = block(*single_block_args)
-
-        img = x[:, :img_seq_len, ...]
+                img, block_txt = block(*double_block_args)
+
+            # Merge txt and img to pass through single stream blocks.
+            x = torch.cat((img, block_txt), 1)
+            if len(self.single_blocks) > 0:
+                for block_idx, block in enumerate(self.single_blocks):
+                    single_block_args = [
+                        x,
+                        vec,
+                        txt_seq_len,
+                        cu_seqlens_q,
+                        cu_seqlens_kv,
+                        max_seqlen_q,
+                        max_seqlen_kv,
+                        (freqs_cos, freqs_sin),
+                    ]
+
+                    x = block(*single_block_args)
+
+            return x[:, :img_seq_len, ...]
+
+        def modulated_input():
+            first_block = self.double_blocks[0]
+            shift, scale = first_block.img_mod(vec).chunk(6, dim=-1)[:2]
+            return modulate(first_block.img_norm1(img), shift=shift, scale=scale)
+
+        img = run_cached_blocks(
+            self.block_cache,
+            img,
+            run_blocks,
+            modulated_input=modulated_input,
+            timestep_embedding=vec,
+        )
 
         # ---------------------------- Final layer ------------------------------
         img = self.final_layer(img, vec)  # (N, T, patch_size ** 2 * out_channels)
@@ -16,7 +16,9 @@ import torch
 from torch import nn
 from safetensors import safe_open
 
+from xdiffusion.layers.block_cache import run_cached_blocks
 from xdiffusion.layers.embedding import PixArtAlphaTextProjection
+from xdiffusion.layers.frequency_cache import cached_frequencies
 from xdiffusion.layers.ltx import BasicTransformerBlock, SkipLayerStrategy
 from xdiffusion.layers.norm import AdaLayerNormSingle
 from xdiffusion.layers.utils import get_3d_sincos_pos_embed
@@ -150,6 +152,10 @@ class LTXVideoTransformer(torch.nn.Module):
 
         self.gradient_checkpointing = False
 
+        # Optional cache of the block outputs across sampling steps,
+        # set with configure_block_cache.
+        self.block_cache = None
+
     def create_skip_layer_mask(
         self,
         skip_block_list: List[int],
@@ -369,7 +375,21 @@ class LTXVideoTransformer(torch.nn.Module):
             hidden_states = (hidden_states + pos_embed).to(hidden_states.dtype)
             freqs_cis = None
         elif self.positional_embedding_type == "rope":
-            freqs_cis = self.precompute_freqs_cis(indices_grid, hidden_states.dtype)
+            # The frequencies only depend on the grid, so they are cached
+            # across the sampling steps.
+            freqs_cis = cached_frequencies(
+                (
+                    "ltx_video",
+                    (B, F, H, W),
+                    self.inner_dim,
+                    self.positional_embedding_theta,
+                    tuple(self.positional_embedding_max_pos),
+                    "exp",
+                    hidden_states.dtype,
+                    hidden_states.device,
+                ),
+                lambda: self.precompute_freqs_cis(indices_grid, hidden_states.dtype),
+            )
 
         batch_size = hidden_states.shape[0]
         timestep, embedded_timestep = self.adaln_single(
@@ -397,19 +417,46 @@ class LTXVideoTransformer(torch.nn.Module):
                 batch_size, -1, hidden_states.shape[-1]
             )
 
-        for block_idx, block in enumerate(self.transformer_blocks):
-            hidden_states = block(
-                hidden_states,
-                freqs_cis=freqs_cis,
-                attention_mask=attention_mask,
-                encoder_hidden_states=encoder_hidden_states,
-                encoder_attention_mask=encoder_attention_mask,
-                timestep=timestep,
-                cross_attention_kwargs=cross_attention_kwargs,
-                class_labels=class_labels,
-                skip_layer_mask=skip_layer_mask[block_idx],
-                skip_layer_strategy=skip_layer_strategy,
+        def run_blocks(hidden_states):
+            for block_idx, block in enumerate(self.transformer_blocks):
+                hidden_states = block(
+                    hidden_states,
+                    freqs_cis=freqs_cis,
+                    attention_mask=attention_mask,
+                    encoder_hidden_states=encoder_hidden_states,
+                    encoder_attention_mask=encoder_attention_mask,
+                    timestep=timestep,
+                    cross_attention_kwargs=cross_attention_kwargs,
+                    class_labels=class_labels,
+                    skip_layer_mask=skip_layer_mask[block_idx],
+                    skip_layer_strategy=skip_layer_strategy,
+                )
+            return hidden_states
+
+        def modulated_input():
+            # The modulated input of the first block, as in BasicTransformerBlock.
+            first_block = self.transformer_blocks[0]
+            norm_hidden_states = first_block.norm1(hidden_states)
+            if first_block.adaptive_norm == "none":
+                return norm_hidden_states
+            ada_values = first_block.scale_shift_table[None, None] + timestep.reshape(
+                batch_size,
+                timestep.shape[1],
+                first_block.scale_shift_table.shape[0],
+                -1,
             )
+            if first_block.adaptive_norm == "single_scale_shift":
+                shift_msa, scale_msa = ada_values[:, :, 0], ada_values[:, :, 1]
+                return norm_hidden_states * (1 + scale_msa) + shift_msa
+            return norm_hidden_states * (1 + ada_values[:, :, 0])
+
+        hidden_states = run_cached_blocks(
+            self.block_cache,
+            hidden_states,
+            run_blocks,
+            modulated_input=modulated_input,
+            timestep_embedding=timestep,
+        )
 
         # 3. Output
         scale_shift_values = (
@@ -7,6 +7,7 @@ from xdiffusion.layers.attention import (
     MultiHeadSelfAttention,
     LastChannelCrossAttention,
 )
+from xdiffusion.layers.block_cache import run_cached_blocks
 from xdiffusion.layers.drop import DropPath
 from xdiffusion.layers.embedding import PatchEmbed
 from xdiffusion.layers.mlp import Mlp
@@ -222,6 +223,10 @@ class PixArtAlpha(torch.nn.Module):
             hidden_size, patch_size, self.out_channels
         )
 
+        # Optional cache of the block outputs across sampling steps,
+        # set with configure_block_cache.
+        self.block_cache = None
+
         self.initialize_weights()
 
     def forward(self, x, context: Dict, **kwargs):
@@ -261,8 +266,24 @@ class PixArtAlpha(torch.nn.Module):
         #     # y comes in a (B, text_seq_len, text_context_dimension=hidden_size).
         #     # We squeeze y here into (1, text_seq_len*batch_size, hidden_size)
         #     y = y.view(1, -1, x.shape[-1])
-        for block in self.blocks:
-            x = block(x, y, t0, y_lens)  # (N, T, D)
+        def run_blocks(x):
+            for block in self.blocks:
+                x = block(x, y, t0, y_lens)  # (N, T, D)
+            return x
+
+        def modulated_input():
+            shift_msa, scale_msa = (
+                self.blocks[0].scale_shift_table[None] + t0.reshape(x.shape[0], 6, -1)
+            ).chunk(6, dim=1)[:2]
+            return t2i_modulate(self.blocks[0].norm1(x), shift_msa, scale_msa)
+
+        x = run_cached_blocks(
+            self.block_cache,
+            x,
+            run_blocks,
+            modulated_input=modulated_input,
+            timestep_embedding=t,
+        )
         x = self.final_layer(x, t)  # (N, T, patch_size ** 2 * out_channels)
         x = self.unpatchify(x)  # (N, out_channels, H, W)
         return x
@@ -1,5 +1,5 @@
 import torch
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 
 from xdiffusion.layers.attention_diffusers import Attention, AttnProcessor2_0
 from xdiffusion.layers.embedding import PixArtAlphaTextProjection
@@ -113,6 +113,140 @@ class SanaLinearAttnProcessor2_0:
         return hidden_states
 
 
+def linear_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    chunk_size: int = 4096,
+    causal: bool = False,
+    state: Optional[torch.Tensor] = None,
+    eps: float = 1e-15,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Memory bounded ReLU linear attention.
+
+    Computes out_n = (q_n @ sum_m k_m^T v_m) / (q_n @ sum_m k_m^T), summing over
+    all tokens m (or m <= n if causal). The sums are a (D, D + 1) state per head,
+    where the last column is the normalization, which is accumulated over chunks
+    of tokens in float32 while the per-chunk matmuls run in the input precision.
+
+    Args:
+        query: Tensor batch of shape (B, heads, N, D), after the ReLU kernel.
+        key: Tensor batch of shape (B, heads, N, D), after the ReLU kernel.
+        value: Tensor batch of shape (B, heads, N, D).
+        chunk_size: The number of tokens processed at a time.
+        causal: True if each token only attends to itself and previous tokens.
+        state: Optional state of shape (B, heads, D, D + 1) from previous tokens,
+            for streaming.
+        eps: Added to the normalization to avoid division by zero.
+
+    Returns:
+        Tuple of the attention output of shape (B, heads, N, D), and the state
+        after all of the tokens.
+    """
+    B, H, N, D = query.shape
+    if state is None:
+        state = torch.zeros((B, H, D, D + 1), dtype=torch.float32, device=query.device)
+
+    def _accumulate(state, k, v):
+        kv = torch.matmul(k.transpose(-1, -2), v).float()
+        k_sum = k.sum(dim=-2, dtype=torch.float32).unsqueeze(-1)
+        return state + torch.cat([kv, k_sum], dim=-1)
+
+    def _normalize(hidden_states):
+        return hidden_states[..., :-1] / (hidden_states[..., -1:] + eps)
+
+    if not causal:
+        # Accumulate the state over every token first, then apply it to every query.
+        for start in range(0, N, chunk_size):
+            state = _accumulate(
+                state,
+                key[:, :, start : start + chunk_size],
+                value[:, :, start : start + chunk_size],
+            )
+
+        # The output is invariant to the scale of the state, so normalize it
+        # by the token count before applying it in the input precision.
+        scaled_state = (state / N).to(query.dtype)
+        outputs = []
+        for start in range(0, N, chunk_size):
+            hidden_states = torch.matmul(
+                query[:, :, start : start + chunk_size], scaled_state
+            )
+            outputs.append(_normalize(hidden_states.float()).to(value.dtype))
+        return torch.cat(outputs, dim=2), state
+
+    outputs = []
+    for start in range(0, N, chunk_size):
+        q = query[:, :, start : start + chunk_size]
+        k = key[:, :, start : start + chunk_size]
+        v = value[:, :, start : start + chunk_size]
+
+        # Contribution of the previous chunks, plus the causal
+        # contribution within the chunk.
+        hidden_states = torch.matmul(q.float(), state)
+        scores = torch.matmul(q, k.transpose(-1, -2)).float().tril()
+        hidden_states[..., :-1] += torch.matmul(scores, v.float())
+        hidden_states[..., -1] += scores.sum(dim=-1)
+
+        outputs.append(_normalize(hidden_states).to(value.dtype))
+        state = _accumulate(state, k, v)
+    return torch.cat(outputs, dim=2), state
+
+
+class SanaChunkedLinearAttnProcessor:
+    """Linear attention processor used in Sana, using chunked linear attention.
+
+    Equivalent to SanaLinearAttnProcessor2_0, without upcasting the full
+    query, key and value to float32, and without padding the value tensor.
+    """
+
+    def __init__(self, chunk_size: int = 4096, causal: bool = False):
+        self._chunk_size = chunk_size
+        self._causal = causal
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        original_dtype = hidden_states.dtype
+
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        # (B, N, heads * D) -> (B, heads, N, D)
+        query = query.unflatten(-1, (attn.heads, -1)).transpose(1, 2)
+        key = key.unflatten(-1, (attn.heads, -1)).transpose(1, 2)
+        value = value.unflatten(-1, (attn.heads, -1)).transpose(1, 2)
+
+        query = torch.nn.functional.relu(query)
+        key = torch.nn.functional.relu(key)
+
+        hidden_states, _ = linear_attention(
+            query,
+            key,
+            value,
+            chunk_size=self._chunk_size,
+            causal=self._causal,
+        )
+        hidden_states = hidden_states.transpose(1, 2).flatten(2)
+        hidden_states = hidden_states.to(original_dtype)
+
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if original_dtype == torch.float16:
+            hidden_states = hidden_states.clip(-65504, 65504)
+
+        return hidden_states
+
+
 class SanaTransformerBlock(torch.nn.Module):
     """SANA transformer block from https://arxiv.org/abs/2410.10629v3.
 
@@ -133,6 +267,7 @@ class SanaTransformerBlock(torch.nn.Module):
         norm_eps: float = 1e-6,
         attention_out_bias: bool = True,
         mlp_ratio: float = 2.5,
+        linear_attention_chunk_size: Optional[int] = 4096,
     ) -> None:
         super().__init__()
 
@@ -145,7 +280,11 @@ class SanaTransformerBlock(torch.nn.Module):
             dropout=dropout,
             bias=attention_bias,
             cross_attention_dim=None,
-            processor=SanaLinearAttnProcessor2_0(),
+            processor=(
+                SanaChunkedLinearAttnProcessor(chunk_size=linear_attention_chunk_size)
+                if linear_attention_chunk_size is not None
+                else SanaLinearAttnProcessor2_0()
+            ),
         )
         self.norm2 = torch.nn.LayerNorm(
             dim, elementwise_affine=norm_elementwise_affine, eps=norm_eps
@@ -242,6 +381,14 @@ class SanaScoreNetwork(torch.nn.Module):
         num_layers = config.num_layers
         inner_dim = num_attention_heads * attention_head_dim
 
+        # The number of tokens per chunk in the linear attention, or None
+        # to use the original (unchunked) linear attention.
+        linear_attention_chunk_size = (
+            config.linear_attention_chunk_size
+            if "linear_attention_chunk_size" in config
+            else 4096
+        )
+
         # Bias in the attention layer
         attention_bias = False
         norm_eps = 1e-6
@@ -287,6 +434,7 @@ class SanaScoreNetwork(torch.nn.Module):
                     norm_elementwise_affine=norm_elementwise_affine,
                     norm_eps=norm_eps,
                     mlp_ratio=mlp_ratio,
+                    linear_attention_chunk_size=linear_attention_chunk_size,
                 )
                 for _ in range(num_layers)
             ]
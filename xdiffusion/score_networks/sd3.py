@@ -3,6 +3,7 @@ from typing import Any, Dict, List, Optional, Union
 import torch
 import torch.nn as nn
 
+from xdiffusion.layers.block_cache import run_cached_blocks
 from xdiffusion.layers.embedding import CombinedTimestepTextProjEmbeddings
 from xdiffusion.layers.sd3 import MMDiTBlock, AdaLayerNormContinuous, PatchEmbed
 from xdiffusion.utils import DotConfig
@@ -81,6 +82,10 @@ class SD3Transformer2DModel(torch.nn.Module):
             bias=True,
         )
 
+        # Optional cache of the block outputs across sampling steps,
+        # set with configure_block_cache.
+        self.block_cache = None
+
     def forward(
         self, x: torch.FloatTensor, context: Dict, **kwargs
     ) -> Union[torch.FloatTensor]:
@@ -123,12 +128,25 @@ class SD3Transformer2DModel(torch.nn.Module):
         temb = self.time_text_embed(timestep, pooled_projections)
         encoder_hidden_states = self.context_embedder(encoder_hidden_states)
 
-        for block in self.transformer_blocks:
-            encoder_hidden_states, hidden_states = block(
-                x=hidden_states,
-                c=encoder_hidden_states,
-                y=temb,
-            )
+        def run_blocks(hidden_states):
+            block_encoder_hidden_states = encoder_hidden_states
+            for block in self.transformer_blocks:
+                block_encoder_hidden_states, hidden_states = block(
+                    x=hidden_states,
+                    c=block_encoder_hidden_states,
+                    y=temb,
+                )
+            return hidden_states
+
+        hidden_states = run_cached_blocks(
+            self.block_cache,
+            hidden_states,
+            run_blocks,
+            modulated_input=lambda: self.transformer_blocks[0].norm1(
+                hidden_states, emb=temb
+            )[0],
+            timestep_embedding=temb,
+        )
 
         hidden_states = self.norm_out(hidden_states, temb)
         hidden_states = self.proj_out(hidden_states)
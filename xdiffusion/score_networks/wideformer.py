@@ -167,7 +167,9 @@ class WideFormer(nn.Module):
         txt = self.txt_in(txt)
 
         ids = torch.cat((txt_ids, img_ids), dim=1)
-        pe = self.pe_embedder(ids)
+        pe = self.pe_embedder(
+            ids, cache_key=(B, H // self.patch_size, W // self.patch_size, txt.shape[1])
+        )
 
         # Apply the first layer
         B, L, D = img.shape
@@ -0,0 +1,161 @@
+"""Content-addressed cache for frozen text encoder outputs.
+
+The text encoders (CLIP, T5) are frozen during both training and sampling,
+so the embeddings of a given prompt never change. Entries are keyed on the
+encoder name(s), the maximum sequence length and the prompt (or its tokens),
+and are held in an in-memory LRU tier, with an optional on-disk tier of
+memory-mapped numpy files which persists across runs.
+"""
+
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import os
+import torch
+from typing import Callable, List, Optional, Sequence, Tuple
+
+
+class TextEmbeddingCache:
+    def __init__(
+        self,
+        max_entries: int = 128,
+        cache_dir: Optional[str] = None,
+        offload_to_cpu: bool = False,
+    ):
+        """Initializes the cache.
+
+        Args:
+            max_entries: The maximum number of entries in the in-memory tier.
+            cache_dir: If not None, the directory of the on-disk tier.
+            offload_to_cpu: If True, the in-memory tier is kept in host memory,
+                and entries are moved to the device when they are looked up.
+        """
+        self._max_entries = max_entries
+        self._cache_dir = cache_dir
+        self._offload_to_cpu = offload_to_cpu
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if self._cache_dir is not None:
+            os.makedirs(self._cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Creates a content address from strings, numbers and tensors."""
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, torch.Tensor):
+                part = part.detach().cpu().numpy().tobytes()
+            elif not isinstance(part, bytes):
+                part = str(part).encode("utf-8")
+            h.update(len(part).to_bytes(8, "little"))
+            h.update(part)
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[torch.Tensor, ...]]:
+        """Returns the cached tensors for a key, or None if they do not exist."""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+        if self._cache_dir is not None:
+            entry = self._load(key)
+            if entry is not None:
+                self.hits += 1
+                self._insert(key, entry)
+                return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, tensors: Sequence[torch.Tensor]):
+        """Adds the (unbatched) tensors for a key to the cache."""
+        # Copy the tensors, since they are usually views into a batch, which
+        # would otherwise be kept alive for as long as the entry is cached.
+        tensors = tuple(
+            (
+                t.detach().to("cpu", copy=True)
+                if self._offload_to_cpu
+                else t.detach().clone()
+            )
+            for t in tensors
+        )
+        self._insert(key, tensors)
+        if self._cache_dir is not None:
+            self._save(key, tensors)
+
+    def lookup(
+        self,
+        keys: List[str],
+        encode_fn: Callable[[List[int]], Sequence[torch.Tensor]],
+        device: torch.device,
+        dtype: Optional[torch.dtype] = None,
+    ) -> Tuple[torch.Tensor, ...]:
+        """Gathers the embeddings for a batch of keys.
+
+        All of the cache misses are encoded together in a single call to
+        encode_fn, which receives the batch indices of the misses and returns
+        a tuple of batched tensors for them.
+
+        Args:
+            keys: The cache key for each entry in the batch.
+            encode_fn: Encodes the batch entries at the given indices.
+            device: The device of the returned tensors.
+            dtype: Optional dtype of the returned tensors.
+
+        Returns:
+            Tuple of batched tensors, one per output of encode_fn.
+        """
+        entries = [self.get(key) for key in keys]
+
+        # Encode each missing key only once, even if it is repeated in the batch.
+        missing = {}
+        for idx, entry in enumerate(entries):
+            if entry is None and keys[idx] not in missing:
+                missing[keys[idx]] = idx
+
+        if len(missing) > 0:
+            encoded = encode_fn(list(missing.values()))
+            positions = {key: i for i, key in enumerate(missing)}
+            for key, i in positions.items():
+                self.put(key, tuple(t[i] for t in encoded))
+            for idx, entry in enumerate(entries):
+                if entry is None:
+                    entries[idx] = tuple(t[positions[keys[idx]]] for t in encoded)
+
+        return tuple(
+            torch.stack([t.to(device=device, dtype=dtype) for t in outputs], dim=0)
+            for outputs in zip(*entries)
+        )
+
+    def _insert(self, key: str, tensors: Tuple[torch.Tensor, ...]):
+        if self._max_entries <= 0:
+            return
+        self._entries[key] = tensors
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def _path(self, key: str, idx: int) -> str:
+        return os.path.join(self._cache_dir, f"{key}_{idx}.npy")
+
+    def _save(self, key: str, tensors: Tuple[torch.Tensor, ...]):
+        # Write the tensors in reverse order, so that the existence of the
+        # first file means the entry is complete.
+        for idx in reversed(range(len(tensors))):
+            path = self._path(key, idx)
+            if os.path.isfile(path):
+                continue
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as fp:
+                np.save(fp, tensors[idx].float().cpu().numpy(), allow_pickle=False)
+            os.replace(tmp_path, path)
+
+    def _load(self, key: str) -> Optional[Tuple[torch.Tensor, ...]]:
+        tensors = []
+        while os.path.isfile(self._path(key, len(tensors))):
+            data = np.load(self._path(key, len(tensors)), mmap_mode="r")
+            tensors.append(torch.from_numpy(np.array(data)))
+        return tuple(tensors) if len(tensors) > 0 else None
@@ -1,17 +1,40 @@
 """
 Byte pair encoding utilities adapted from:
 https://github.com/openai/gpt-2/blob/master/src/encoder.py
+
+The merges are applied to token ids rather than strings, with the merge ranks
+keyed on the (first, second) token id pair. Both the merged tokens and whole
+prompts are cached, so tokenizing the (typically small set of) training prompts
+is mostly a cache lookup.
+
+The parsed vocabulary and merges are loaded from vocab.bin, a compact binary
+version of encoder.json.gz and vocab.bpe.gz created with
+tools/create_bpe_vocab.py, falling back to the original files if it is missing.
 """
 
 import gzip
 import json
+import numpy as np
 import os
 from functools import lru_cache
+import struct
 import torch
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
+import zlib
 
 import regex as re
 
+BINARY_VOCAB_FILE_NAME = "vocab.bin"
+
+# Header of the binary vocabulary: magic, version, number of tokens and number of merges.
+_BINARY_VOCAB_HEADER = struct.Struct("<4sIII")
+_BINARY_VOCAB_MAGIC = b"XBPE"
+_BINARY_VOCAB_VERSION = 1
+
+# Merge ranks keyed on first_id * n_vocab + second_id, and the merged token
+# id of each rank.
+MergeTable = Tuple[Dict[int, int], List[int]]
+
 
 @lru_cache()
 def bytes_to_unicode():
@@ -52,15 +75,56 @@ def get_pairs(word):
     return pairs
 
 
+def build_merge_table(
+    encoder: Dict[str, int], bpe_merges: List[Tuple[str, str]]
+) -> MergeTable:
+    """Converts the (first, second) string merges into a merge table of token ids."""
+    n_vocab = len(encoder)
+    merge_ranks = {}
+    merged_ids = []
+    for rank, (first, second) in enumerate(bpe_merges):
+        if first + second not in encoder:
+            raise ValueError(f"Merged token {first + second} is not in the vocabulary.")
+        merge_ranks[encoder[first] * n_vocab + encoder[second]] = rank
+        merged_ids.append(encoder[first + second])
+    return merge_ranks, merged_ids
+
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors="replace"):
+    def __init__(
+        self,
+        encoder: Dict[str, int],
+        bpe_merges: Optional[List[Tuple[str, str]]] = None,
+        errors="replace",
+        merge_table: Optional[MergeTable] = None,
+        bpe_cache_size: int = 2**16,
+        prompt_cache_size: int = 2**14,
+    ):
+        """Initializes the encoder.
+
+        Args:
+            encoder: Dictionary of token strings to token ids.
+            bpe_merges: List of (first, second) merges, in rank order. Not needed
+                if merge_table is provided.
+            errors: How to handle errors in decoding.
+            merge_table: The precomputed merge table, from build_merge_table
+                or load_binary_vocab.
+            bpe_cache_size: The maximum number of cached merged words.
+            prompt_cache_size: The maximum number of cached tokenized prompts.
+        """
         self.encoder = encoder
         self.decoder = {v: k for k, v in self.encoder.items()}
         self.errors = errors  # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        if merge_table is None:
+            merge_table = build_merge_table(encoder, bpe_merges)
+        self._merge_ranks, self._merged_ids = merge_table
+
+        # Bounded caches of the merged words, and of the padded token rows
+        # of whole prompts.
+        self._cached_bpe = lru_cache(maxsize=bpe_cache_size)(self._bpe_ids)
+        self._cached_row = lru_cache(maxsize=prompt_cache_size)(self._tokenize_row)
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(
@@ -84,55 +148,45 @@ class Encoder:
         mask = [True] * len(tokens) + [False] * padding
         return padded_tokens, mask
 
-    def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
-
-        if not pairs:
-            return token
+    def _bpe_ids(self, token: str) -> Tuple[int, ...]:
+        n_vocab = len(self.encoder)
+        word = [self.encoder[c] for c in token]
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
-            if bigram not in self.bpe_ranks:
+        while len(word) > 1:
+            # Find the lowest rank merge of all of the adjacent pairs.
+            best_rank = None
+            for first, second in zip(word, word[1:]):
+                rank = self._merge_ranks.get(first * n_vocab + second)
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best_rank = rank
+                    best_pair = (first, second)
+            if best_rank is None:
                 break
-            first, second = bigram
+
+            # Merge every occurrence of the pair.
+            first, second = best_pair
+            merged = self._merged_ids[best_rank]
             new_word = []
             i = 0
             while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:  # pylint: disable=bare-except
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
+                if i < len(word) - 1 and word[i] == first and word[i + 1] == second:
+                    new_word.append(merged)
                     i += 2
                 else:
                     new_word.append(word[i])
                     i += 1
-            new_word = tuple(new_word)
             word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = " ".join(word)
-        self.cache[token] = word
-        return word
+        return tuple(word)
+
+    def bpe(self, token):
+        return " ".join(self.decoder[t] for t in self._cached_bpe(token))
 
     def encode(self, text):
         text = text.lower()
         bpe_tokens = []
         for token in re.findall(self.pat, text):
             token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
-            bpe_tokens.extend(
-                self.encoder[bpe_token] for bpe_token in self.bpe(token).split(" ")
-            )
+            bpe_tokens.extend(self._cached_bpe(token))
         return bpe_tokens
 
     def decode(self, tokens):
@@ -142,34 +196,122 @@ class Encoder:
         )
         return text
 
+    def _tokenize_row(
+        self, text: str, context_length: int, truncate_text: bool
+    ) -> torch.Tensor:
+        tokens = self.encode(text)
+        if len(tokens) > context_length:
+            if truncate_text:
+                tokens = tokens[:context_length]
+            else:
+                raise RuntimeError(
+                    f"Input {text} is too long for context length {context_length}"
+                )
+        row = torch.zeros(context_length, dtype=torch.long)
+        row[: len(tokens)] = torch.tensor(tokens, dtype=torch.long)
+        return row
+
     def tokenize(self, texts, context_length=256, truncate_text=False):
         if isinstance(texts, str):
             texts = [texts]
 
-        all_tokens = [self.encode(text) for text in texts]
-        result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
-
-        for i, tokens in enumerate(all_tokens):
-            if len(tokens) > context_length:
-                if truncate_text:
-                    tokens = tokens[:context_length]
-                else:
-                    raise RuntimeError(
-                        f"Input {texts[i]} is too long for context length {context_length}"
-                    )
-            result[i, : len(tokens)] = torch.tensor(tokens)
-
+        # The padded rows of each prompt are cached, so the batch is a single
+        # copy of the cached rows into the result.
+        result = torch.empty(len(texts), context_length, dtype=torch.long)
+        if len(texts) > 0:
+            torch.stack(
+                [
+                    self._cached_row(text, context_length, truncate_text)
+                    for text in texts
+                ],
+                out=result,
+            )
         return result
 
 
-def get_encoder() -> Encoder:
-    root_dir = os.path.dirname(os.path.abspath(__file__))
+def load_text_vocab(
+    root_dir: Optional[str] = None,
+) -> Tuple[Dict[str, int], List[Tuple[str, str]]]:
+    """Loads the vocabulary and merges from encoder.json.gz and vocab.bpe.gz."""
+    root_dir = root_dir or os.path.dirname(os.path.abspath(__file__))
     with gzip.open(os.path.join(root_dir, "encoder.json.gz"), "r") as f:
         encoder = json.load(f)
     with gzip.open(os.path.join(root_dir, "vocab.bpe.gz"), "r") as f:
         bpe_data = str(f.read(), "utf-8")
     bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split("\n")[1:-1]]
-    return Encoder(
-        encoder=encoder,
-        bpe_merges=bpe_merges,
+    return encoder, bpe_merges
+
+
+def save_binary_vocab(
+    path: str, encoder: Dict[str, int], bpe_merges: List[Tuple[str, str]]
+):
+    """Saves the vocabulary and merges in the compact binary format.
+
+    The file is a header, followed by the zlib compressed int32 arrays of the
+    first, second and merged token ids of each merge (in rank order), and then
+    the newline separated token strings, in token id order. The byte level
+    token strings never contain newlines.
+    """
+    tokens = sorted(encoder, key=encoder.get)
+    if [encoder[t] for t in tokens] != list(range(len(tokens))):
+        raise ValueError("Token ids must be contiguous from zero.")
+    if any("\n" in t for t in tokens):
+        raise ValueError("Token strings cannot contain newlines.")
+
+    merge_ids = np.array(
+        [
+            [encoder[first] for first, _ in bpe_merges],
+            [encoder[second] for _, second in bpe_merges],
+            [encoder[first + second] for first, second in bpe_merges],
+        ],
+        dtype="<i4",
+    )
+    body = merge_ids.tobytes() + "\n".join(tokens).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(
+            _BINARY_VOCAB_HEADER.pack(
+                _BINARY_VOCAB_MAGIC,
+                _BINARY_VOCAB_VERSION,
+                len(tokens),
+                len(bpe_merges),
+            )
+        )
+        f.write(zlib.compress(body, 9))
+
+
+def load_binary_vocab(path: str) -> Tuple[Dict[str, int], MergeTable]:
+    """Loads the vocabulary and merge table saved by save_binary_vocab."""
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, n_tokens, n_merges = _BINARY_VOCAB_HEADER.unpack_from(data)
+    if magic != _BINARY_VOCAB_MAGIC or version != _BINARY_VOCAB_VERSION:
+        raise ValueError(f"{path} is not a version {_BINARY_VOCAB_VERSION} vocab.")
+
+    body = zlib.decompress(data[_BINARY_VOCAB_HEADER.size :])
+    merge_ids = np.frombuffer(body, dtype="<i4", count=3 * n_merges).reshape(
+        3, n_merges
     )
+    tokens = body[merge_ids.nbytes :].decode("utf-8").split("\n")
+    assert len(tokens) == n_tokens
+
+    encoder = dict(zip(tokens, range(n_tokens)))
+    merge_keys = merge_ids[0].astype(np.int64) * n_tokens + merge_ids[1]
+    merge_ranks = dict(zip(merge_keys.tolist(), range(n_merges)))
+    return encoder, (merge_ranks, merge_ids[2].tolist())
+
+
+@lru_cache(maxsize=1)
+def _load_vocab() -> Tuple[Dict[str, int], MergeTable]:
+    root_dir = os.path.dirname(os.path.abspath(__file__))
+    binary_vocab_path = os.path.join(root_dir, BINARY_VOCAB_FILE_NAME)
+    if os.path.exists(binary_vocab_path):
+        return load_binary_vocab(binary_vocab_path)
+
+    encoder, bpe_merges = load_text_vocab(root_dir)
+    return encoder, build_merge_table(encoder, bpe_merges)
+
+
+def get_encoder() -> Encoder:
+    # The parsed vocabulary is shared by all of the encoders, which only read it.
+    encoder, merge_table = _load_vocab()
+    return Encoder(encoder=encoder, merge_table=merge_table)
@@ -0,0 +1,190 @@
+"""Data pipeline construction for the training loops.
+
+The data loaders for all of the training entry points are created from the
+(optional) training.data_loader section of the config file, for example:
+
+training:
+  data_loader:
+    # The number of data loading worker processes.
+    num_workers: 8
+    # Collate the batches into page-locked memory, which allows the host to
+    # device copies to run asynchronously.
+    pin_memory: True
+    # Keep the worker processes alive between epochs, instead of respawning
+    # them every time the (cycled) data loader restarts.
+    persistent_workers: True
+    # The number of batches loaded in advance by each worker.
+    prefetch_factor: 4
+    # Drop the last incomplete batch of each epoch.
+    drop_last: False
+    # Copy the next batch to the device on a side stream while the current
+    # batch is being trained on.
+    device_prefetch: True
+
+Any missing entries keep the previous behavior of the training loops.
+"""
+
+import time
+import torch
+from torch.utils.data import DataLoader, Dataset
+from typing import Any, Dict, Iterable
+
+from xdiffusion.utils import DotConfig
+
+
+def get_data_loader_params(config: DotConfig) -> Dict[str, Any]:
+    """Returns the training.data_loader section of the config, if it exists."""
+    if "training" in config and "data_loader" in config.training:
+        return config.training.data_loader.to_dict()
+    return {}
+
+
+def create_data_loader(
+    dataset: Dataset,
+    config: DotConfig,
+    batch_size: int,
+    shuffle: bool = True,
+    num_workers: int = 1,
+) -> DataLoader:
+    """Creates a DataLoader configured from the training.data_loader section.
+
+    Args:
+        dataset: The dataset to load from.
+        config: The configuration file.
+        batch_size: The batch size to load.
+        shuffle: True to shuffle the dataset.
+        num_workers: The default number of workers, if the config file
+            does not specify them.
+
+    Returns:
+        The configured DataLoader.
+    """
+    params = get_data_loader_params(config)
+    num_workers = params.get("num_workers", num_workers)
+
+    kwargs = {}
+    if num_workers > 0:
+        # These options are only valid with worker processes.
+        kwargs["persistent_workers"] = params.get("persistent_workers", False)
+        if params.get("prefetch_factor", None) is not None:
+            kwargs["prefetch_factor"] = params["prefetch_factor"]
+
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        pin_memory=params.get("pin_memory", False),
+        drop_last=params.get("drop_last", False),
+        **kwargs,
+    )
+
+
+def _to_device(batch: Any, device: torch.device) -> Any:
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=True)
+    elif isinstance(batch, (list, tuple)):
+        return type(batch)(_to_device(b, device) for b in batch)
+    elif isinstance(batch, dict):
+        return {k: _to_device(v, device) for k, v in batch.items()}
+    return batch
+
+
+def _record_stream(batch: Any, stream: torch.cuda.Stream):
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for b in batch:
+            _record_stream(b, stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            _record_stream(v, stream)
+
+
+class DevicePrefetcher:
+    """Iterates over batches, copying the next batch to the device in advance.
+
+    On CUDA devices, the next batch is fetched (and copied to the device) on a
+    side stream as soon as the current batch is handed out, so the host to device
+    copy overlaps with the training step on the current batch. This works best
+    with pinned memory batches. On other devices the batches are passed through.
+
+    In both cases, the time spent blocked on the underlying data loader is
+    accumulated, which is the time the training loop stalled waiting for data.
+    """
+
+    def __init__(self, iterable: Iterable, device: torch.device, enabled: bool = True):
+        """Initializes the prefetcher.
+
+        Args:
+            iterable: The batches to iterate over, for example a cycled DataLoader.
+            device: The device to copy the batches to.
+            enabled: False to pass the batches through without prefetching.
+        """
+        self._iterator = iter(iterable)
+        self._device = torch.device(device)
+        self._stream = (
+            torch.cuda.Stream(device=self._device)
+            if enabled and self._device.type == "cuda"
+            else None
+        )
+        self._stall_time = 0.0
+        self._next_batch = None
+        self._exhausted = False
+
+        if self._stream is not None:
+            self._preload()
+
+    def _fetch(self) -> Any:
+        start_time = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self._stall_time += time.perf_counter() - start_time
+
+    def _preload(self):
+        try:
+            with torch.cuda.stream(self._stream):
+                self._next_batch = _to_device(self._fetch(), self._device)
+        except StopIteration:
+            self._next_batch = None
+            self._exhausted = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Any:
+        if self._stream is None:
+            return self._fetch()
+
+        if self._exhausted:
+            raise StopIteration
+
+        # The batch was produced on the side stream, so make sure it is ready
+        # before the current stream uses it, and that its memory is not reused
+        # until the current stream is finished with it.
+        current_stream = torch.cuda.current_stream(self._device)
+        current_stream.wait_stream(self._stream)
+        batch = self._next_batch
+        _record_stream(batch, current_stream)
+
+        self._preload()
+        return batch
+
+    def pop_stall_time(self) -> float:
+        """Returns the seconds spent waiting on the data loader since the last call."""
+        stall_time = self._stall_time
+        self._stall_time = 0.0
+        return stall_time
+
+
+def create_device_prefetcher(
+    iterable: Iterable, config: DotConfig, device: torch.device
+) -> DevicePrefetcher:
+    """Wraps the batches in a DevicePrefetcher configured from the config file."""
+    return DevicePrefetcher(
+        iterable,
+        device=device,
+        enabled=get_data_loader_params(config).get("device_prefetch", False),
+    )
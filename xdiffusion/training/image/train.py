@@ -2,6 +2,7 @@ from accelerate import cpu_offload, Accelerator, DataLoaderConfiguration
 from accelerate.utils import GradientAccumulationPlugin
 from accelerate import DistributedDataParallelKwargs
 from datetime import datetime
+import functools
 import math
 import os
 from pathlib import Path
@@ -14,12 +15,20 @@ from torchvision import transforms, utils
 from tqdm import tqdm
 from typing import Callable, List, Optional
 
+from xdiffusion.checkpoint import (
+    CheckpointWriter,
+    create_checkpoint_writer,
+    load_training_state,
+)
+from xdiffusion.datasets.batch_transforms import get_batch_transform
 from xdiffusion.datasets.utils import load_dataset
 from xdiffusion.diffusion.ddpm import GaussianDiffusion_DDPM
 from xdiffusion.diffusion import DiffusionModel
 from xdiffusion.diffusion.cascade import GaussianDiffusionCascade
 from xdiffusion.layers.ema import create_ema_and_scales_fn
 from xdiffusion.lora import inject_trainable_lora, save_lora_weights
+from xdiffusion.training.data_loader import create_data_loader, create_device_prefetcher
+from xdiffusion.training.sampling_worker import create_sampling_worker
 from xdiffusion.utils import (
     cycle,
     freeze,
@@ -161,7 +170,10 @@ def train(
     with accelerator.main_process_first():
         if "training" in config and "dataset" in config.training:
             dataset, convert_labels_to_prompts = load_dataset(
-                dataset_name=config.training.dataset, config=config.data, split="train"
+                dataset_name=config.training.dataset,
+                config=config.data,
+                split="train",
+                batch_transforms=True,
             )
             validation_dataset, _ = load_dataset(
                 dataset_name=config.training.dataset,
@@ -171,18 +183,27 @@ def train(
 
         else:
             dataset, convert_labels_to_prompts = load_dataset(
-                dataset_name=dataset_name, config=config.data, split="train"
+                dataset_name=dataset_name,
+                config=config.data,
+                split="train",
+                batch_transforms=True,
             )
             validation_dataset, _ = load_dataset(
                 dataset_name=dataset_name, config=config.data, split="validation"
             )
 
+    # Datasets that support it return raw batches, which are resized and
+    # scaled on the device.
+    batch_transform = get_batch_transform(dataset)
+
     # Create the dataloader for the MNIST dataset
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=1)
+    dataloader = create_data_loader(
+        dataset, config=config, batch_size=batch_size, shuffle=True
+    )
 
     num_samples = 64
-    validation_dataloader = DataLoader(
-        validation_dataset, batch_size=num_samples, shuffle=True, num_workers=1
+    validation_dataloader = create_data_loader(
+        validation_dataset, config=config, batch_size=num_samples, shuffle=True
     )
 
     # Now create the optimizer. The optimizer choice and parameters come from
@@ -198,13 +219,15 @@ def train(
 
     # Load the optimizers and step counter if we have them from the checkpoint
     if resume_from:
-        checkpoint = torch.load(resume_from, map_location="cpu")
-        num_optimizers = checkpoint["num_optimizers"]
+        training_state = load_training_state(resume_from)
+        num_optimizers = training_state["num_optimizers"]
         for i in range(num_optimizers):
-            optimizers[i].load_state_dict(checkpoint["optimizer_state_dicts"][i])
+            optimizers[i].load_state_dict(training_state["optimizer_state_dicts"][i])
+        step = training_state["step"]
 
-        if "step" in checkpoint:
-            step = checkpoint["step"]
+    # Checkpoints are written in the background, so that saving does
+    # not stall the training loop.
+    checkpoint_writer = create_checkpoint_writer(config, OUTPUT_NAME)
 
     # Configure the learning rate schedule
     learning_rate_schedules = diffusion_model.configure_learning_rate_schedule(
@@ -229,8 +252,22 @@ def train(
     ), "Optimizers and learning rate schedules are not the same length!"
 
     # We are going to train for a fixed number of steps, so set the dataloader
-    # to repeat indefinitely over the entire dataset.
-    dataloader = cycle(dataloader)
+    # to repeat indefinitely over the entire dataset. The prefetcher copies the
+    # next batch to the device while training on the current one.
+    dataloader = create_device_prefetcher(
+        cycle(dataloader), config=config, device=accelerator.device
+    )
+
+    # Periodic sampling can run on a background worker, on a snapshot of the
+    # training weights, so that training continues while sampling.
+    background_sampling = (
+        "training" in config and "background_sampling" in config.training
+    )
+    sampling_worker = (
+        create_sampling_worker(config, accelerator.unwrap_model(diffusion_model))
+        if accelerator.is_main_process
+        else None
+    )
 
     # If there is a separate sampling section, create the prompt encoder
     # here, and put it on the CPU.
@@ -305,6 +342,7 @@ def train(
                         images, classes, context_data = example_data
                         context = {"classes": classes}
                         context.update(context_data)
+                    images = batch_transform(images)
 
                     context["step"] = step
                     context["total_steps"] = num_training_steps
@@ -387,12 +425,15 @@ def train(
             )
             average_loss_cumulative += stage_loss
             tensorboard_writer.add_scalar("loss", stage_loss, step)
+            tensorboard_writer.add_scalar(
+                "data_loader/stall_ms", 1000.0 * dataloader.pop_stall_time(), step
+            )
 
             # To help visualize training, periodically sample from the
             # diffusion model to see how well its doing.
             if step % save_and_sample_every_n == 0:
-                sample(
-                    diffusion_model=diffusion_model,
+                sample_fn = functools.partial(
+                    sample,
                     step=step,
                     config=config,
                     num_samples=num_samples,
@@ -404,6 +445,10 @@ def train(
                     prompt_encoder=prompt_encoder,
                     tensorboard_writer=tensorboard_writer,
                 )
+                if sampling_worker is not None:
+                    sampling_worker.submit(step, sample_fn)
+                elif not background_sampling:
+                    sample_fn(diffusion_model)
 
                 if accelerator.is_main_process:
                     save(
@@ -413,6 +458,7 @@ def train(
                         optimizers=optimizers,
                         config=config,
                         output_path=OUTPUT_NAME,
+                        checkpoint_writer=checkpoint_writer,
                         save_lora=use_lora_training,
                     )
                 average_loss = average_loss_cumulative / float(save_and_sample_every_n)
@@ -430,8 +476,8 @@ def train(
     progress_bar.set_description(f"loss: {stage_loss:.4f} avg_loss: {average_loss:.4f}")
 
     # Save and sample the final step.
-    sample(
-        diffusion_model=diffusion_model,
+    sample_fn = functools.partial(
+        sample,
         step=step,
         config=config,
         num_samples=num_samples,
@@ -443,6 +489,10 @@ def train(
         prompt_encoder=prompt_encoder,
         tensorboard_writer=tensorboard_writer,
     )
+    if sampling_worker is not None:
+        sampling_worker.submit(step, sample_fn)
+    elif not background_sampling:
+        sample_fn(diffusion_model)
     if accelerator.is_main_process:
         save(
             diffusion_model=accelerator.unwrap_model(diffusion_model),
@@ -451,8 +501,12 @@ def train(
             optimizers=optimizers,
             config=config,
             output_path=OUTPUT_NAME,
+            checkpoint_writer=checkpoint_writer,
             save_lora=use_lora_training,
         )
+    if sampling_worker is not None:
+        sampling_worker.wait()
+    checkpoint_writer.wait()
     accelerator.end_training()
 
 
@@ -586,21 +640,16 @@ def save(
     output_path: str,
     optimizers: List[torch.optim.Optimizer],
     config: DotConfig,
+    checkpoint_writer: CheckpointWriter,
     save_lora: bool = False,
 ):
     # Save a corresponding model checkpoint.
-    torch.save(
-        {
-            "step": step,
-            "model_state_dict": diffusion_model.state_dict(),
-            "num_optimizers": len(optimizers),
-            "optimizer_state_dicts": [
-                optimizer.state_dict() for optimizer in optimizers
-            ],
-            "loss": loss,
-            "config": config.to_dict(),
-        },
-        f"{output_path}/diffusion-{step}.pt",
+    checkpoint_writer.save(
+        step=step,
+        diffusion_model=diffusion_model,
+        optimizers=optimizers,
+        loss=loss,
+        config=config,
     )
 
     # Save the lora weights separately
@@ -0,0 +1,136 @@
+"""Background sampling during training.
+
+The training loops periodically sample from the model to visualize the
+training progress, which (especially when sweeping several guidance values)
+stalls training for the full length of every sampling loop. The SamplingWorker
+instead runs the sampling on a background thread, using a separate copy of the
+diffusion model which receives a snapshot of the training weights (including
+any EMA weights, which are part of the model state). On CUDA devices, the
+sampling runs on its own stream, so it is overlapped with the training kernels,
+and can also be placed on a different device altogether.
+
+To enable background sampling, add the following to the config file:
+
+training:
+  background_sampling:
+    # Optional, the device to sample on. Defaults to the training device.
+    device: "cuda:1"
+"""
+
+import copy
+import threading
+import torch
+from typing import Callable, Optional
+
+from xdiffusion.diffusion import DiffusionModel
+from xdiffusion.utils import DotConfig
+
+
+class SamplingWorker:
+    def __init__(self, diffusion_model: DiffusionModel, device: Optional[str] = None):
+        """Initializes the worker.
+
+        Args:
+            diffusion_model: The (unwrapped) diffusion model being trained.
+            device: The device to sample on. Defaults to the device of the
+                diffusion model.
+        """
+        self._source_model = diffusion_model
+        self._device = (
+            torch.device(device)
+            if device is not None
+            else next(diffusion_model.parameters()).device
+        )
+
+        # The copy of the model used for sampling, which never needs gradients.
+        self._model = copy.deepcopy(diffusion_model).to(self._device)
+        _remove_forward_wrappers(self._model)
+        self._model.requires_grad_(False)
+        self._model.eval()
+
+        self._stream = (
+            torch.cuda.Stream(device=self._device)
+            if self._device.type == "cuda"
+            else None
+        )
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+
+    def submit(self, step: int, sample_fn: Callable[[DiffusionModel], None]):
+        """Snapshots the training weights and samples from them in the background.
+
+        Args:
+            step: The current training step.
+            sample_fn: Samples from the diffusion model it is given, and writes
+                the outputs (image grids, TensorBoard, etc).
+        """
+        # Only one sampling job is in flight, so the snapshot is never
+        # overwritten while it is being sampled from.
+        self.wait()
+
+        # Copy the current weights into the sampling model. These copies are
+        # ordered on the training stream, so they see a consistent snapshot.
+        with torch.no_grad():
+            source_state = self._source_model.state_dict()
+            for k, v in self._model.state_dict().items():
+                v.copy_(source_state[k], non_blocking=True)
+
+        snapshot_done = None
+        if self._stream is not None:
+            snapshot_done = torch.cuda.Event()
+            snapshot_done.record()
+
+        def _run():
+            try:
+                with torch.no_grad():
+                    if self._stream is not None:
+                        self._stream.wait_event(snapshot_done)
+                        with torch.cuda.stream(self._stream):
+                            sample_fn(self._model)
+                        self._stream.synchronize()
+                    else:
+                        sample_fn(self._model)
+            except BaseException as e:
+                self._error = e
+
+        self._thread = threading.Thread(target=_run, daemon=True)
+        self._thread.start()
+
+    def wait(self):
+        """Waits for the sampling job in flight to finish."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise RuntimeError("Background sampling failed.") from error
+
+
+def _remove_forward_wrappers(model: torch.nn.Module):
+    """Removes the instance level forward wrappers from a copied model.
+
+    Accelerate wraps the forward method of prepared modules (for example with
+    mixed precision autocast) by assigning a closure over the bound forward of the
+    original module. The deep copy keeps that closure, which would run the
+    training module instead of the copy, so fall back to the class forward.
+    """
+    for module in model.modules():
+        if "forward" in module.__dict__:
+            del module.forward
+        if "_original_forward" in module.__dict__:
+            del module._original_forward
+
+
+def create_sampling_worker(
+    config: DotConfig, diffusion_model: DiffusionModel
+) -> Optional[SamplingWorker]:
+    """Creates the sampling worker, if background sampling is configured."""
+    if "training" not in config or "background_sampling" not in config.training:
+        return None
+
+    params = config.training.background_sampling.to_dict()
+    return SamplingWorker(
+        diffusion_model=diffusion_model,
+        device=params.get("device", None),
+    )
@@ -6,7 +6,6 @@ import math
 import os
 from pathlib import Path
 import torch
-from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from torchinfo import summary
 from torchvision import utils
@@ -14,7 +13,9 @@ from tqdm import tqdm
 from typing import Optional
 
 from xdiffusion import masking
+from xdiffusion.datasets.batch_transforms import get_batch_transform
 from xdiffusion.datasets.utils import load_dataset
+from xdiffusion.training.data_loader import create_data_loader, create_device_prefetcher
 from xdiffusion.training_utils import preprocess_training_videos
 from xdiffusion.utils import (
     cycle,
@@ -146,16 +147,28 @@ def train(
     with accelerator.main_process_first():
         if "training" in config and "dataset" in config.training:
             dataset, convert_labels_to_prompts = load_dataset(
-                dataset_name=config.training.dataset, config=config.data, split="train"
+                dataset_name=config.training.dataset,
+                config=config.data,
+                split="train",
+                batch_transforms=True,
             )
 
         else:
             dataset, convert_labels_to_prompts = load_dataset(
-                dataset_name=dataset_name, config=config.data, split="train"
+                dataset_name=dataset_name,
+                config=config.data,
+                split="train",
+                batch_transforms=True,
             )
 
+    # Datasets that support it return raw batches, which are resized and
+    # scaled on the device.
+    batch_transform = get_batch_transform(dataset)
+
     # Create the dataloader for the given dataset
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=1)
+    dataloader = create_data_loader(
+        dataset, config=config, batch_size=batch_size, shuffle=True
+    )
 
     # Now create the optimizer. The optimizer choice and parameters come from
     # the paper:
@@ -227,8 +240,11 @@ def train(
         )
 
     # We are going to train for a fixed number of steps, so set the dataloader
-    # to repeat indefinitely over the entire dataset.
-    dataloader = cycle(dataloader)
+    # to repeat indefinitely over the entire dataset. The prefetcher copies the
+    # next batch to the device while training on the current one.
+    dataloader = create_device_prefetcher(
+        cycle(dataloader), config=config, device=accelerator.device
+    )
 
     # Not mentioned in the DDPM paper, but the original implementation
     # used gradient clipping during training.
@@ -273,6 +289,7 @@ def train(
                     videos, classes, context_data = example_data
                     context = {"classes": classes}
                     context.update(context_data)
+                videos = batch_transform(videos)
 
                 videos, masks, context = preprocess_training_videos(
                     source_videos=videos,
@@ -343,6 +360,9 @@ def train(
             tensorboard_writer.add_scalar("d_loss", current_loss[1], step)
             tensorboard_writer.add_scalar("d_avg_loss", average_losses[1], step)
             tensorboard_writer.add_scalar("KL", posterior.kl().detach().mean(), step)
+            tensorboard_writer.add_scalar(
+                "data_loader/stall_ms", 1000.0 * dataloader.pop_stall_time(), step
+            )
             tensorboard_writer.add_scalar(
                 "Posterior Mean", posterior.mean.detach().mean().to(torch.float32), step
             )
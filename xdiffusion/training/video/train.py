@@ -5,11 +5,11 @@ from accelerate import (
 )
 from accelerate.utils import GradientAccumulationPlugin
 from datetime import datetime
+import functools
 import math
 import os
 from pathlib import Path
 import torch
-from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from torchvision import utils as torchvision_utils
 from torchvision.transforms import v2
@@ -17,10 +17,19 @@ from tqdm import tqdm
 from typing import Callable, List, Optional
 
 from xdiffusion import masking
+from xdiffusion.checkpoint import (
+    CheckpointWriter,
+    create_checkpoint_writer,
+    load_training_state,
+)
 from xdiffusion.diffusion.ddpm import GaussianDiffusion_DDPM
 from xdiffusion.diffusion.cascade import GaussianDiffusionCascade
 from xdiffusion.diffusion import DiffusionModel
+from xdiffusion.datasets.precomputed_latents import PrecomputedLatentsDataset
+from xdiffusion.datasets.batch_transforms import get_batch_transform
 from xdiffusion.datasets.utils import load_dataset
+from xdiffusion.training.data_loader import create_data_loader, create_device_prefetcher
+from xdiffusion.training.sampling_worker import create_sampling_worker
 from xdiffusion.training_utils import get_training_batch, preprocess_training_videos
 from xdiffusion.utils import (
     load_yaml,
@@ -181,23 +190,51 @@ def train(
     # Build context to display the model summary.
     source_diffusion_model.print_model_summary()
 
+    # Train directly on precomputed latents if they exist.
+    precomputed_latents = (
+        "training" in config and "precomputed_latents" in config.training
+    )
+
     # Now load the dataset. Do it on the main process first in case we have to download
     # it.
     with accelerator.main_process_first():
-        dataset, convert_labels_to_prompts = load_dataset(
-            dataset_name=dataset_name, config=config.data, split="train"
-        )
         # Technically this is not correct, as the val set is the same as the train set
         # TODO: Create a real validation set for Moving MNIST.
-        validation_dataset, _ = load_dataset(
+        validation_dataset, convert_labels_to_prompts = load_dataset(
             dataset_name=dataset_name, config=config.data, split="train"
         )
 
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=1)
+        # The pixel training set is not needed when training on precomputed latents.
+        if not precomputed_latents:
+            dataset, _ = load_dataset(
+                dataset_name=dataset_name,
+                config=config.data,
+                split="train",
+                batch_transforms=True,
+            )
+
+    if precomputed_latents:
+        assert (
+            joint_image_video_training_step <= 0
+        ), "Joint image/video training is not supported with precomputed latents."
+        dataset = PrecomputedLatentsDataset(config.training.precomputed_latents.path)
+        for model in source_diffusion_model.models():
+            model.set_latent_scale_factor(dataset.latent_scale_factor)
+        accelerator.print(
+            f"Training on precomputed latents from {config.training.precomputed_latents.path}."
+        )
+
+    # Datasets that support it return raw batches, which are resized and
+    # scaled on the device.
+    batch_transform = get_batch_transform(dataset)
+
+    dataloader = create_data_loader(
+        dataset, config=config, batch_size=batch_size, shuffle=True
+    )
 
     num_samples = 16
-    validation_dataloader = DataLoader(
-        validation_dataset, batch_size=num_samples, shuffle=False, num_workers=1
+    validation_dataloader = create_data_loader(
+        validation_dataset, config=config, batch_size=num_samples, shuffle=False
     )
 
     # Now create the optimizer. The optimizer choice and parameters come from
@@ -210,16 +247,18 @@ def train(
 
     # step counter to keep track of training
     step = 0
-    
+
     # Load the optimizers and step counter if we have them from the checkpoint
     if resume_from:
-        checkpoint = torch.load(resume_from, map_location="cpu")
-        num_optimizers = checkpoint["num_optimizers"]
+        training_state = load_training_state(resume_from)
+        num_optimizers = training_state["num_optimizers"]
         for i in range(num_optimizers):
-            optimizers[i].load_state_dict(checkpoint["optimizer_state_dicts"][i])
+            optimizers[i].load_state_dict(training_state["optimizer_state_dicts"][i])
+        step = training_state["step"]
 
-        if "step" in checkpoint:
-            step = checkpoint["step"]
+    # Checkpoints are written in the background, so that saving does
+    # not stall the training loop.
+    checkpoint_writer = create_checkpoint_writer(config, OUTPUT_NAME)
 
     # Configure the learning rate schedule
     learning_rate_schedules = source_diffusion_model.configure_learning_rate_schedule(
@@ -248,8 +287,22 @@ def train(
     ), "Optimizers and learning rate schedules are not the same length!"
 
     # We are going to train for a fixed number of steps, so set the dataloader
-    # to repeat indefinitely over the entire dataset.
-    dataloader = cycle(dataloader)
+    # to repeat indefinitely over the entire dataset. The prefetcher copies the
+    # next batch to the device while training on the current one.
+    dataloader = create_device_prefetcher(
+        cycle(dataloader), config=config, device=accelerator.device
+    )
+
+    # Periodic sampling can run on a background worker, on a snapshot of the
+    # training weights, so that training continues while sampling.
+    background_sampling = (
+        "training" in config and "background_sampling" in config.training
+    )
+    sampling_worker = (
+        create_sampling_worker(config, source_diffusion_model)
+        if accelerator.is_main_process
+        else None
+    )
 
     # Create a mask generation strategy for each model (if a cascade)
     mask_generators = []
@@ -299,6 +352,7 @@ def train(
                         dataloader,
                         is_image_batch=is_image_batch,
                     )
+                    source_videos = batch_transform(source_videos)
                     context = {"labels": labels}
                     context["is_image_batch"] = is_image_batch
 
@@ -328,17 +382,23 @@ def train(
                         ).config()
                         context_for_layer = context.copy()
 
-                        # Preprocess the training videos (e.g. clip or skip frames to match the setup)
-                        videos_for_layer, mask_for_layer, context = (
-                            preprocess_training_videos(
-                                source_videos=source_videos,
-                                config=config_for_layer,
-                                context=context_for_layer,
-                                mask_generator=mask_generator,
-                                batch_size=batch_size,
-                                is_image_batch=is_image_batch,
+                        if precomputed_latents:
+                            # The latents were preprocessed before they were encoded,
+                            # so only the frame masks (in latent frames) are needed.
+                            videos_for_layer = source_videos
+                            mask_for_layer = mask_generator.get_masks(source_videos)
+                        else:
+                            # Preprocess the training videos (e.g. clip or skip frames to match the setup)
+                            videos_for_layer, mask_for_layer, context = (
+                                preprocess_training_videos(
+                                    source_videos=source_videos,
+                                    config=config_for_layer,
+                                    context=context_for_layer,
+                                    mask_generator=mask_generator,
+                                    batch_size=batch_size,
+                                    is_image_batch=is_image_batch,
+                                )
                             )
-                        )
                         context_for_layer["video_mask"] = mask_for_layer
 
                         # Make sure the text prompts are are the same length as the batch size
@@ -394,12 +454,15 @@ def train(
             average_loss_cumulative += stage_loss
 
             tensorboard_writer.add_scalar("loss", stage_loss, step)
+            tensorboard_writer.add_scalar(
+                "data_loader/stall_ms", 1000.0 * dataloader.pop_stall_time(), step
+            )
 
             # To help visualize training, periodically sample from the
             # diffusion model to see how well its doing.
             if step % save_and_sample_every_n == 0:
-                sample(
-                    diffusion_model=source_diffusion_model,
+                sample_fn = functools.partial(
+                    sample,
                     step=step,
                     config=config,
                     num_samples=num_samples,
@@ -409,6 +472,10 @@ def train(
                     convert_labels_to_prompts=convert_labels_to_prompts,
                     tensorboard_writer=tensorboard_writer,
                 )
+                if sampling_worker is not None:
+                    sampling_worker.submit(step, sample_fn)
+                elif not background_sampling:
+                    sample_fn(source_diffusion_model)
                 if accelerator.is_main_process:
                     save(
                         source_diffusion_model,
@@ -417,6 +484,7 @@ def train(
                         optimizers,
                         config,
                         output_path=OUTPUT_NAME,
+                        checkpoint_writer=checkpoint_writer,
                     )
                 average_loss = average_loss_cumulative / float(save_and_sample_every_n)
                 average_loss_cumulative = 0.0
@@ -428,8 +496,8 @@ def train(
             progress_bar.update(1)
 
     # Save and sample the final step.
-    sample(
-        diffusion_model=source_diffusion_model,
+    sample_fn = functools.partial(
+        sample,
         step=step,
         config=config,
         num_samples=num_samples,
@@ -439,6 +507,10 @@ def train(
         convert_labels_to_prompts=convert_labels_to_prompts,
         tensorboard_writer=tensorboard_writer,
     )
+    if sampling_worker is not None:
+        sampling_worker.submit(step, sample_fn)
+    elif not background_sampling:
+        sample_fn(source_diffusion_model)
     if accelerator.is_main_process:
         save(
             source_diffusion_model,
@@ -447,7 +519,11 @@ def train(
             optimizers,
             config,
             output_path=OUTPUT_NAME,
+            checkpoint_writer=checkpoint_writer,
         )
+    if sampling_worker is not None:
+        sampling_worker.wait()
+    checkpoint_writer.wait()
     accelerator.end_training()
 
 
@@ -673,18 +749,13 @@ def save(
     optimizers: List[torch.optim.Optimizer],
     config: DotConfig,
     output_path: str,
+    checkpoint_writer: CheckpointWriter,
 ):
     # Save a corresponding model checkpoint.
-    torch.save(
-        {
-            "step": step,
-            "model_state_dict": diffusion_model.state_dict(),
-            "num_optimizers": len(optimizers),
-            "optimizer_state_dicts": [
-                optimizer.state_dict() for optimizer in optimizers
-            ],
-            "loss": loss,
-            "config": config.to_dict(),
-        },
-        f"{output_path}/diffusion-{step}.pt",
+    checkpoint_writer.save(
+        step=step,
+        diffusion_model=diffusion_model,
+        optimizers=optimizers,
+        loss=loss,
+        config=config,
     )
@@ -1,7 +1,5 @@
 """Utilities for training."""
 
-import numpy as np
-import random
 import torch
 from torch.utils.data import DataLoader
 from torchvision.transforms import v2
@@ -71,34 +69,45 @@ def sample_masks_for_training_batch(
 
     # Following code assumes shapes of (B, T, C, H, W)
     video_batch = video_batch.permute(0, 2, 1, 3, 4)
-
-    # Base mask, of shape (B, 1, T, 1, 1) - all frames
+    device = video_batch.device
+
+    # The masks of every row are sampled together, with each row following
+    # the same steps until it is finished.
+    obs_mask = torch.zeros((B, T), dtype=torch.bool, device=device)
+    latent_mask = torch.zeros((B, T), dtype=torch.bool, device=device)
+
+    # First sample some frames to use for training/generation (latent frames).
+    indices, valid = _sample_some_indices_batch(B, max_indices=N, T=T, device=device)
+    latent_mask |= _indices_to_mask(indices, valid, T)
+
+    # From the frames that are left, use some for conditioning (observed frames)
+    # or for training (latent frames).
+    active = torch.ones(B, dtype=torch.bool, device=device)
+    while active.any():
+        # Select whether we are adding a latent or observed mask
+        use_obs = torch.rand(B, device=device) < 0.5
+        # Grab some random indices for this mask (latent or observed)
+        indices, valid = _sample_some_indices_batch(
+            B, max_indices=N, T=T, device=device
+        )
+        # Remove indices that are already used in a mask
+        taken = (obs_mask | latent_mask).gather(1, indices)
+        valid &= ~taken
+        # If we have used all of the frames, the row is finished.
+        remaining = N - obs_mask.sum(dim=1) - latent_mask.sum(dim=1)
+        finished = valid.sum(dim=1) > remaining
+        # Otherwise update the indices
+        update = _indices_to_mask(indices, valid, T) & (active & ~finished)[:, None]
+        obs_mask |= update & use_obs[:, None]
+        latent_mask |= update & ~use_obs[:, None]
+        active &= ~finished
+
+    # Masks of shape (B, T, 1, 1, 1), in the dtype of the videos.
     masks = {
-        k: torch.zeros_like(video_batch[:, :, :1, :1, :1]) for k in ["obs", "latent"]
+        k: m.to(video_batch.dtype).view(B, T, 1, 1, 1)
+        for k, m in [("obs", obs_mask), ("latent", latent_mask)]
     }
 
-    for obs_row, latent_row in zip(*[masks[k] for k in ["obs", "latent"]]):
-        # First sample some frames to use for training/generation (latent frames).
-        latent_row[_sample_some_indices(max_indices=N, T=T)] = 1.0
-
-        # From the frames that are left, use some for conditioning (observed frames)
-        # or for training (latent frames).
-        while True:
-            # Select whether we are adding a latent or observed mask
-            mask = obs_row if torch.rand(()) < 0.5 else latent_row
-            # Grab some random indices for this mask (latent or observed)
-            indices = torch.tensor(
-                _sample_some_indices(max_indices=N, T=T), device=video_batch.device
-            )
-            taken = (obs_row[indices] + latent_row[indices]).view(-1)
-            # Remove indices that are already used in a mask
-            indices = indices[taken == 0]
-            # If we have used all of the frames, break.
-            if len(indices) > N - sum(obs_row) - sum(latent_row):
-                break
-            # Otherwise update the indices
-            mask[indices] = 1.0
-
     any_mask = (masks["obs"] + masks["latent"]).clip(max=1)
     batch, (obs_mask, latent_mask), frame_indices = _prepare_training_batch(
         any_mask, video_batch, (masks["obs"], masks["latent"]), max_frames=N
@@ -124,27 +133,25 @@ def get_training_batch(dataloader: DataLoader, is_image_batch: bool):
     B, C, F, H, W = source_videos.shape
 
     # Now we need to pull items to fill out the training batch. In this case,
-    # the training batch will be batch size (B * F) with each entry a frame count of 1.
+    # the training batch will be batch size (B * F) with each entry a frame count of 1,
+    # using a random frame from each item of the following batches.
     image_frames = []
     image_labels = []
-    f = 0
-    b = 0
-    video_batch, label_batch = next(dataloader)
-
-    # We need to fill out F independent frames for each batch item
-    while f < B * F:
-        b = 0
-        while b < video_batch.shape[0] and f < B * F:
-            # Choose a random frame from this batch item
-            frame_idx = random.randint(0, F - 1)
-            image_frames.append(video_batch[b, :, frame_idx, :, :][None, :, None, :, :])
-            image_labels.append(label_batch[b])
-            f += 1
-            b += 1
-        # Done with this batch, go to the next
+    num_frames = 0
+    while num_frames < B * F:
         video_batch, label_batch = next(dataloader)
-    source_videos = torch.cat(image_frames, dim=0)
-    labels = torch.stack(image_labels, dim=0)
+        num_items = min(video_batch.shape[0], B * F - num_frames)
+        frame_indices = torch.randint(
+            0, F, size=(num_items,), device=video_batch.device
+        )
+        item_indices = torch.arange(num_items, device=video_batch.device)
+        image_frames.append(video_batch[item_indices, :, frame_indices])
+        image_labels.append(label_batch[:num_items])
+        num_frames += num_items
+
+    # Frames of shape (B * F, C, 1, H, W)
+    source_videos = torch.cat(image_frames, dim=0)[:, :, None, :, :]
+    labels = torch.cat(image_labels, dim=0)
 
     assert source_videos.shape[0] == labels.shape[0]
     assert source_videos.shape[0] == B * F
@@ -247,22 +254,49 @@ def preprocess_training_videos(
     return videos, masks, context
 
 
-def _sample_some_indices(max_indices: int, T: int):
-    s = torch.randint(low=1, high=max_indices + 1, size=())
-    max_scale = T / (s - 0.999)
-    scale = np.exp(np.random.rand() * np.log(max_scale))
-    pos = torch.rand(()) * (T - scale * (s - 1))
-    indices = [int(pos + i * scale) for i in range(s)]
-    # do some recursion if we have somehow failed to satisfy the consrtaints
-    if all(i < T and i >= 0 for i in indices):
-        return indices
-    else:
-        print(
-            "warning: sampled invalid indices",
-            [int(pos + i * scale) for i in range(s)],
-            "trying again",
-        )
-        return _sample_some_indices(max_indices, T)
+def _sample_some_indices_batch(
+    B: int, max_indices: int, T: int, device: torch.device
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Samples some frame indices for each row of the batch.
+
+    Each row samples a random number of indices, evenly spaced with a random
+    (log uniform) spacing and offset.
+
+    Returns:
+        Tuple of:
+            indices: Tensor of shape (B, max_indices) of frame indices.
+            valid: Boolean tensor of shape (B, max_indices), which is True for
+                the sampled indices of each row.
+    """
+    indices = torch.zeros((B, max_indices), dtype=torch.int64, device=device)
+    valid = torch.zeros((B, max_indices), dtype=torch.bool, device=device)
+    offsets = torch.arange(max_indices, device=device)[None, :]
+
+    # Resample any rows which have somehow failed to satisfy the constraints.
+    resample = torch.ones(B, dtype=torch.bool, device=device)
+    while resample.any():
+        s = torch.randint(low=1, high=max_indices + 1, size=(B, 1), device=device)
+        max_scale = T / (s - 0.999)
+        scale = torch.exp(torch.rand((B, 1), device=device) * torch.log(max_scale))
+        pos = torch.rand((B, 1), device=device) * (T - scale * (s - 1))
+        row_valid = offsets < s
+        row_indices = torch.where(row_valid, (pos + offsets * scale).long(), 0)
+
+        in_range = (row_indices >= 0) & (row_indices < T)
+        accept = resample & in_range.all(dim=1)
+        indices[accept] = row_indices[accept]
+        valid[accept] = row_valid[accept]
+        resample &= ~accept
+    return indices, valid
+
+
+def _indices_to_mask(indices: torch.Tensor, valid: torch.Tensor, T: int):
+    """Converts (B, N) indices, where valid, into a (B, T) boolean mask."""
+    counts = torch.zeros(
+        (indices.shape[0], T), dtype=torch.int32, device=indices.device
+    )
+    counts.scatter_add_(1, indices, valid.to(torch.int32))
+    return counts > 0
 
 
 def _prepare_training_batch(
@@ -287,22 +321,25 @@ def _prepare_training_batch(
     # to fill it out.
     effective_T = max_frames if pad_with_random_frames else mask.sum(dim=1).max().int()
 
-    indices = torch.zeros_like(mask[:, :effective_T], dtype=torch.int64)
-    new_batch = torch.zeros_like(video_batch[:, :effective_T])
-    new_tensors = [torch.zeros_like(t[:, :effective_T]) for t in tensors]
-
-    for b in range(B):
-        instance_T = mask[b].sum().int()
-        indices[b, :instance_T] = mask[b].nonzero().flatten()
-        indices[b, instance_T:] = (
-            torch.randint_like(indices[b, instance_T:], high=T)
-            if pad_with_random_frames
-            else 0
-        )
-        new_batch[b, :instance_T] = video_batch[b][mask[b] == 1]
-        new_batch[b, instance_T:] = video_batch[b][indices[b, instance_T:]]
-        for new_t, t in zip(new_tensors, tensors):
-            new_t[b, :instance_T] = t[b][mask[b] == 1]
-            new_t[b, instance_T:] = t[b][indices[b, instance_T:]]
+    effective_T = min(int(effective_T), T)
+    instance_T = mask.sum(dim=1, keepdim=True)
+
+    # The (ascending) indices of the masked frames, followed by the padding.
+    # A stable sort of the unmasked flags moves the masked frames to the front.
+    indices = torch.sort((mask == 0).to(torch.uint8), dim=1, stable=True).indices
+    indices = indices[:, :effective_T]
+    padding = (
+        torch.randint_like(indices, high=T)
+        if pad_with_random_frames
+        else torch.zeros_like(indices)
+    )
+    indices = torch.where(
+        torch.arange(effective_T, device=mask.device)[None, :] < instance_T,
+        indices,
+        padding,
+    )
 
+    batch_indices = torch.arange(B, device=mask.device)[:, None]
+    new_batch = video_batch[batch_indices, indices]
+    new_tensors = [t[batch_indices, indices] for t in tensors]
     return (new_batch, new_tensors, indices)
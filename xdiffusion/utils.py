@@ -345,6 +345,41 @@ def broadcast_from_left(x, shape):
     return torch.broadcast_to(x.reshape(x.shape + (1,) * (len(shape) - x.ndim)), shape)
 
 
+def concatenate_contexts(contexts: List[Dict], batch_size: int) -> Dict:
+    """Concatenates context dictionaries along the batch dimension.
+
+    Tensors with a leading batch dimension and lists of length batch_size are
+    concatenated, nested dictionaries (e.g. text tokens) are concatenated recursively,
+    and all other values (e.g. the integer timestep index) are taken from the
+    first context.
+    """
+    batched_context = {}
+    for key, value in contexts[0].items():
+        values = [c[key] if key in c else value for c in contexts]
+        if (
+            isinstance(value, torch.Tensor)
+            and value.ndim > 0
+            and value.shape[0] == batch_size
+        ):
+            batched_context[key] = torch.cat(values, dim=0)
+        elif isinstance(value, list) and len(value) == batch_size:
+            batched_context[key] = [v for vs in values for v in vs]
+        elif isinstance(value, dict):
+            batched_context[key] = concatenate_contexts(values, batch_size)
+        else:
+            batched_context[key] = value
+    return batched_context
+
+
+def chunk_model_output(
+    model_output: Union[torch.Tensor, Tuple[torch.Tensor, ...]], chunks: int
+) -> List:
+    """Splits a (possibly tuple-valued) score network output along the batch."""
+    if isinstance(model_output, (list, tuple)):
+        return list(zip(*[o.chunk(chunks, dim=0) for o in model_output]))
+    return list(model_output.chunk(chunks, dim=0))
+
+
 def append_dims(x, target_dims):
     """Appends dimensions to the end of a tensor until it has target_dims dimensions."""
     dims_to_append = target_dims - x.ndim